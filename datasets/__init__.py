@@ -3,10 +3,21 @@
 #
 import os
 os.environ['TF_CPP_MIN_LOG_LEVEL'] = '3'
+import io
 import re
-import spacy
-import tflearn
+import glob
+import json
+import time
+import queue
+import locale
+import shutil
+import hashlib
+import functools
+import itertools
+import threading
 import collections
+import multiprocessing
+import concurrent.futures
 import numpy as np
 import progressbar
 
@@ -30,29 +41,117 @@ test_split_small = 0.2
 data_root_directory = os.path.join('/', 'scratch', 'OSA', 'data', 'datasets')
 
 
-spacy_nlp = None
-spacy_nlp_de = None
+# spaCy models used for each language. The pipelines are only loaded when
+# they are first needed (see `get_spacy`), so that importing this package
+# does not pay for loading models that a job might never use.
+spacy_models = {'en': 'en_core_web_md', 'de': 'de_core_news_md'}
+
+# The components of the spaCy pipeline that each kind of call needs.
+#  * 'tokenizer': only the tokenizer (no tagger, parser, NER or vectors). On
+#                 spaCy 2+ it is a blank pipeline of the language
+#  * 'ner'      : the tokenizer plus the entity recognizer
+#  * 'document' : the tokenizer, the entity recognizer and the rule-based
+#                 sentencizer, which splits sentences much faster than the
+#                 dependency parser (spaCy 1.x has no sentencizer, so the
+#                 parser is used there)
+#  * 'vectors'  : the tokenizer plus the word vectors
+#  * 'full'     : the complete pipeline
+spacy_components = {
+    'tokenizer': {'tagger': False, 'parser': False, 'entity': False,
+                  'vectors': False, 'sentencizer': False},
+    'ner':       {'tagger': False, 'parser': False, 'entity': True,
+                  'vectors': False, 'sentencizer': False},
+    'document':  {'tagger': False, 'parser': False, 'entity': True,
+                  'vectors': False, 'sentencizer': True},
+    'vectors':   {'tagger': False, 'parser': False, 'entity': False,
+                  'vectors': True, 'sentencizer': False},
+    'full':      {'tagger': True, 'parser': True, 'entity': True,
+                  'vectors': True, 'sentencizer': False},
+}
+
+_spacy_pipelines = {}
+_spacy_lock = threading.Lock()
+
+
+def _load_spacy(lang, components):
+    import spacy
+
+    model = spacy_models.get(lang, spacy_models['en'])
+    enabled = spacy_components[components]
+    major = int(spacy.__version__.split('.')[0])
+    if major < 2:
+        overrides = {k: v for k, v in enabled.items()
+                     if k not in ['vectors', 'sentencizer'] and not v}
+        if enabled['sentencizer']:
+            overrides.pop('parser', None)
+        if not enabled['vectors']:
+            overrides['add_vectors'] = False
+        return spacy.load(model, **overrides)
+
+    if not any(enabled.values()):
+        # `disable` keeps the vectors of the model, which take most of its
+        # loading time. The tokenizer comes from the language defaults
+        # anyway, so a blank pipeline tokenizes the same way
+        return spacy.blank(lang)
+
+    names = {'tagger': 'tagger', 'parser': 'parser', 'entity': 'ner'}
+    nlp = spacy.load(model, disable=[names[k] for k in names
+                                     if not enabled[k]])
+    if enabled['sentencizer']:
+        if major < 3:
+            nlp.add_pipe(nlp.create_pipe('sentencizer'), first=True)
+        else:
+            nlp.add_pipe('sentencizer', first=True)
+    return nlp
 
-def get_spacy(lang='en'):
-    """
-    Returns the spaCy pipeline for the specified language.
 
-    Keyword arguments:
-    lang -- the language whose pipeline will be returned.
-    """
-    global spacy_nlp
-    global spacy_nlp_de
+def _cached_spacy(lang, components):
+    if (lang, components) in _spacy_pipelines:
+        return _spacy_pipelines[(lang, components)]
+    if (lang, 'full') in _spacy_pipelines:
+        return _spacy_pipelines[(lang, 'full')]
+    return None
 
-    if spacy_nlp is None:
-        # TODO: support other spaCy English models
-        spacy_nlp = spacy.load('en_core_web_md')
-    if spacy_nlp_de is None:
-        spacy_nlp_de = spacy.load('de_core_news_md')
 
-    return spacy_nlp if lang == 'en' else spacy_nlp_de
+def get_spacy(lang='en', components='full'):
+    """
+    Returns the spaCy pipeline for the specified language. The pipeline is
+    loaded the first time it is requested and cached afterwards. Loading is
+    thread-safe, so data workers can share the same pipeline.
 
-spacy_tokenizer = get_spacy(lang='en').tokenizer
-spacy_tokenizer_de = get_spacy(lang='de').tokenizer
+    Keyword arguments:
+    lang       -- the language whose pipeline will be returned.
+    components -- which components of the pipeline are needed. Possible
+                  values are 'tokenizer', 'ner', 'vectors' and 'full' (see
+                  `spacy_components`). If a pipeline with more components
+                  was loaded already, that pipeline is returned instead.
+    """
+    if lang not in spacy_models:
+        lang = 'en'
+    if components not in spacy_components:
+        raise ValueError('Unknown spaCy components {}. Possible values '
+                         'are {}'.format(components,
+                                         list(spacy_components.keys())))
+
+    # Fast path: no locking if a suitable pipeline is already loaded
+    nlp = _cached_spacy(lang, components)
+    if nlp is not None:
+        return nlp
+
+    with _spacy_lock:
+        nlp = _cached_spacy(lang, components)
+        if nlp is None:
+            nlp = _load_spacy(lang, components)
+            _spacy_pipelines[(lang, components)] = nlp
+    return nlp
+
+
+def get_tokenizer(lang='en'):
+    """
+    Returns the spaCy tokenizer for the specified language. Only the
+    tokenizer is loaded, not the rest of the pipeline.
+    """
+    return get_spacy(lang, components='tokenizer').tokenizer
 
 
 def pad_sentences(data, pad=0, raw=False):
@@ -73,10 +172,7 @@ def pad_sentences(data, pad=0, raw=False):
         return data[:pad]
 
     pad_vec = [0 if not raw else 'PAD' for _ in range(len(data[-1]))]
-    for i in range(pad - len(data)):
-        data.append(pad_vec)
-
-    return data
+    return data + [pad_vec] * (pad - len(data))
 
 
 def padseq(data, pad=0, raw=False):
@@ -94,8 +190,53 @@ def padseq(data, pad=0, raw=False):
                 padded_data.append(d[:pad])
         return padded_data
     else:
-        return tflearn.data_utils.pad_sequences(data, maxlen=pad,
-                dtype='int32', padding='post', truncating='post', value=0)
+        padded_data = np.zeros((len(data), pad), dtype=np.int32)
+        for i, d in enumerate(data):
+            d = d[:pad]
+            padded_data[i, :len(d)] = d
+        return padded_data
+
+
+# IDs of the special tokens that are left out when decoding: 'PAD',
+# 'SEQ_BEGIN' and 'SEQ_END'
+special_ids = (0, 1, 2)
+
+_i2w_arrays = collections.OrderedDict()
+
+
+def i2w_array(i2w):
+    """
+    Returns two arrays built from the vocabulary `i2w`: `words[i]` is the
+    word with ID `i`, and `known[i]` tells if `i` is in `i2w` and is not one
+    of the `special_ids`. The arrays of the last few vocabularies are cached.
+    """
+    cached = _i2w_arrays.get(id(i2w))
+    if cached is not None and cached[0] is i2w and cached[1] == len(i2w):
+        return cached[2], cached[3]
+
+    size = max(i2w) + 1 if len(i2w) > 0 else 0
+    words = np.empty(size, dtype=object)
+    known = np.zeros(size, dtype=bool)
+    ids = np.fromiter(i2w.keys(), dtype=np.int64, count=len(i2w))
+    words[ids] = list(i2w.values())
+    known[ids] = True
+    known[[i for i in special_ids if i < size]] = False
+
+    _i2w_arrays[id(i2w)] = (i2w, len(i2w), words, known)
+    while len(_i2w_arrays) > 8:
+        _i2w_arrays.popitem(last=False)
+    return words, known
+
+
+def known_ids_mask(ids, known):
+    """
+    Returns a boolean array with the shape of `ids` telling which IDs are in
+    the vocabulary and are not special (see `i2w_array`).
+    """
+    if len(known) == 0:
+        return np.zeros(ids.shape, dtype=bool)
+    in_range = (ids >= 0) & (ids < len(known))
+    return in_range & known[np.where(in_range, ids, 0)]
 
 
 def id2seq(data, i2w):
@@ -115,20 +256,21 @@ def id2seq(data, i2w):
      ['the', 'boy',  'kicked', 'the', 'girl'],
      ['the', 'girl', 'chased', 'the', 'boy' ]]
 
+    IDs that are not in `i2w`, and the IDs of 'PAD', 'SEQ_BEGIN' and
+    'SEQ_END', are left out. `data` can also be a 2-D array of IDs (e.g., a
+    padded batch), which is decoded without a Python loop over the tokens.
+
     For a function that transforms the abovementioned list of words back into
     IDs, see `seq2id`.
     """
-    buff = []
-    for seq in data:
-        w_seq = []
-        for term in seq:
-            if term in i2w:
-                if term == 0 or term == 1 or term == 2:
-                    continue
-                w_seq.append(i2w[term])
-        sent = ' '.join(w_seq)
-        buff.append(sent)
-    return buff
+    words, known = i2w_array(i2w)
+    if isinstance(data, np.ndarray) and data.ndim == 2:
+        rows = data.astype(np.int64, copy=False)
+        masks = known_ids_mask(rows, known)
+    else:
+        rows = [np.asarray(seq, dtype=np.int64) for seq in data]
+        masks = [known_ids_mask(row, known) for row in rows]
+    return [' '.join(words[row[mask]]) for row, mask in zip(rows, masks)]
 
 
 def seq2id(data, w2i, seq_begin=False, seq_end=False):
@@ -157,15 +299,14 @@ def seq2id(data, w2i, seq_begin=False, seq_end=False):
     seq_end   -- If True, insert the ID corresponding to 'SEQ_END' in the end
                  of each sequence
     """
+    unk = w2i['UNK']
+    get = w2i.get
     buff = []
     for seq in data:
-        id_seq = []
+        id_seq = [get(term, unk) for term in seq]
 
         if seq_begin:
-            id_seq.append(w2i['SEQ_BEGIN'])
-
-        for term in seq:
-            id_seq.append(w2i[term] if term in w2i else w2i['UNK'])
+            id_seq.insert(0, w2i['SEQ_BEGIN'])
 
         if seq_end:
             id_seq.append(w2i['SEQ_END'])
@@ -174,19 +315,109 @@ def seq2id(data, w2i, seq_begin=False, seq_end=False):
     return buff
 
 
+def encode_batch(data, w2i, pad=0, seq_begin=False, seq_end=False,
+                 drop_ids=None):
+    """
+    Does the same as `padseq(seq2id(data, w2i, seq_begin, seq_end), pad)`,
+    but writes the IDs directly into a preallocated int32 array of shape
+    [len(data), pad], without building the intermediate lists. If `pad` is
+    0, the sequences are padded to the length of the longest one.
+
+    Returns the array of IDs and an int32 array with the length of each
+    sequence (counting the 'SEQ_BEGIN' and 'SEQ_END' markers, and at most
+    `pad`).
+
+    Keyword arguments:
+    seq_begin -- If True, insert the ID corresponding to 'SEQ_BEGIN' in the
+                 beginning of each sequence
+    seq_end   -- If True, insert the ID corresponding to 'SEQ_END' in the end
+                 of each sequence
+    drop_ids  -- IDs that are removed from the sequences (with a vectorized
+                 mask, see `pad_ragged`) before they are padded.
+    """
+    if drop_ids is not None:
+        flat_ids, offsets = encode_ragged(data, w2i)
+        return pad_ragged(flat_ids, offsets, np.arange(len(data)), pad,
+                          seq_begin, seq_end, drop_ids)
+
+    offset = 1 if seq_begin else 0
+    seq_lengths = np.array([len(seq) for seq in data], dtype=np.int32)
+    lengths = seq_lengths + offset + (1 if seq_end else 0)
+    if pad == 0:
+        pad = int(lengths.max()) if len(data) > 0 else 0
+    np.minimum(lengths, pad, out=lengths)
+
+    ids = np.zeros((len(data), pad), dtype=np.int32)
+    if pad == 0:
+        return ids, lengths
+
+    # Tokens that fit into the array after the 'SEQ_BEGIN' marker
+    n_tokens = np.minimum(seq_lengths, pad - offset)
+    unk = w2i['UNK']
+    get = w2i.get
+    flat_ids = np.fromiter((get(term, unk) for seq, n in zip(data, n_tokens)
+                            for term in itertools.islice(seq, int(n))),
+                           dtype=np.int32, count=int(n_tokens.sum()))
+    positions = np.arange(pad)
+    ids[(positions >= offset) &
+        (positions < (n_tokens + offset)[:, None])] = flat_ids
+
+    if seq_begin:
+        ids[:, 0] = w2i['SEQ_BEGIN']
+    if seq_end:
+        end_positions = seq_lengths + offset
+        fits = end_positions < pad
+        ids[fits, end_positions[fits]] = w2i['SEQ_END']
+    return ids, lengths
+
+
+def encode_ragged(data, w2i):
+    """
+    Encodes the sequences `data` once, as a flat int32 array with the IDs of
+    all their tokens and an int64 array with the offset of each sequence in
+    it (with one more offset at the end), like the columns of
+    `build_encoded_cache`. The rows of a batch are then sliced and padded
+    with `pad_ragged`, without looking up the tokens in `w2i` again.
+    """
+    lengths = np.array([len(seq) for seq in data], dtype=np.int64)
+    unk = w2i['UNK']
+    get = w2i.get
+    ids = np.fromiter((get(term, unk) for seq in data for term in seq),
+                      dtype=np.int32, count=int(lengths.sum()))
+    return ids, np.concatenate([[0], np.cumsum(lengths)])
+
+
+def onehot2id(data):
+    """
+    `data` is a batch of one-hot encoded (or probability) sequences with
+    shape [batch, time, classes]. Returns the int32 array [batch, time] with
+    the ID of the most likely class of each element, computed with a single
+    `argmax` over the whole batch. The IDs can be used to compute metrics
+    before (or without) decoding them with `id2seq`.
+    """
+    return np.argmax(np.asarray(data), axis=-1).astype(np.int32)
+
+
+def id2onehot(data, n_classes):
+    """
+    The inverse of `onehot2id`: returns the float32 one-hot encoding, with
+    shape [batch, time, n_classes], of the batch of padded IDs `data`, built
+    with a single lookup instead of one `to_categorical` per sequence. Models
+    that one-hot encode the labels in the graph (the `sparse_labels` option
+    of the NER models) can be fed `data` itself, which is `n_classes` times
+    smaller. Like `to_categorical`, it accepts labels of any type that can
+    be cast to an integer, such as the strings read from a split file.
+    """
+    return np.eye(n_classes, dtype=np.float32)[np.asarray(data,
+                                                          dtype=np.int64)]
+
+
 def onehot2seq(data, i2w):
-    buff = []
-    for seq in data:
-        w_seq = []
-        for term in seq:
-            arg = np.argmax(term)
-            if arg in i2w:
-                if arg == 0 or arg == 1 or arg == 2:
-                    continue
-                w_seq.append(i2w[arg])
-        sent = ' '.join(w_seq)
-        buff.append(sent)
-    return buff
+    """
+    Same as `id2seq`, but for a batch of one-hot encoded sequences (see
+    `onehot2id`).
+    """
+    return id2seq(onehot2id(data), i2w)
 
 
 def append_seq_markers(data, seq_begin=True, seq_end=True):
@@ -221,7 +452,74 @@ def append_seq_markers(data, seq_begin=True, seq_end=True):
     return data_
 
 
-def mark_entities(data, lang='en'):
+# Tokens that mark the named entities in the sentences (see `mark_entities`):
+# the types of the entities of spaCy, and BOE and EOE around each entity.
+# Every vocabulary has them (see `new_vocabulary`)
+entity_tokens = ['PERSON', 'NORP', 'FACILITY', 'ORG', 'GPE', 'LOC', 'PRODUCT',
+                 'EVENT', 'WORK_OF_ART', 'LANGUAGE', 'DATE', 'TIME', 'PERCENT',
+                 'MONEY', 'QUANTITY', 'ORDINAL', 'CARDINAL', 'BOE', 'EOE']
+
+# Maximum number of lines whose marked entities are kept in memory
+entity_cache_size = 100000
+
+
+class LRUCache(object):
+    """
+    A thread-safe dictionary that holds at most `size` entries. When it is
+    full, the least recently used entry is dropped.
+    """
+    def __init__(self, size):
+        self.size = size
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            if key not in self._entries:
+                return default
+            value = self._entries.pop(key)
+            self._entries[key] = value
+            return value
+
+    def put(self, key, value):
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = value
+            while len(self._entries) > self.size:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+
+_entity_cache = LRUCache(entity_cache_size)
+
+
+def ner_pipe(spacy_nlp, lines, batch_size=1000):
+    """
+    Runs the components of the spaCy pipeline `spacy_nlp` on `lines`, a list
+    of lists of tokens, in batches of `batch_size` lines. The tokens are used
+    as they are, so the n-th token of each returned doc is the n-th token of
+    its line.
+    """
+    from spacy.tokens import Doc
+
+    docs = (Doc(spacy_nlp.vocab, words=line) for line in lines)
+    for component in spacy_nlp.pipeline:
+        # spaCy 2+ keeps (name, component) tuples in the pipeline
+        proc = component[1] if isinstance(component, tuple) else component
+        if hasattr(proc, 'pipe'):
+            docs = proc.pipe(docs, batch_size=batch_size)
+        else:
+            docs = (proc(doc) or doc for doc in docs)
+    return docs
+
+
+def mark_entities(data, lang='en', batch_size=1000):
     """
     `data` is a list of text lines. Each text line is a string composed of one
     or more words. For example:
@@ -243,28 +541,43 @@ def mark_entities(data, lang='en'):
     PERSON indicates the type of the Entity
     EOE indicates the beginning of an Entity
 
+    The lines are streamed through the NER of spaCy (see `ner_pipe`), so
+    entities are found with the context of the whole line. The marked lines
+    are kept in a LRU cache of `entity_cache_size` lines, so lines seen in a
+    previous epoch are not processed again.
+
     Keyword arguments:
-    lang -- The language in which the sentences are (used to choose which spaCy
-            pipeline to call).
-    """
-    marked_data = []
-    spacy_nlp = get_spacy()
-    for line in data:
-        marked_line = []
-        for token in line:
-            tok = spacy_nlp(token, lang)[0]
-            if tok.ent_type_ != '':
-                marked_line.append('BOE')
-                marked_line.append(token)
-                marked_line.append(tok.ent_type_)
-                marked_line.append('EOE')
-            else:
-                marked_line.append(token)
-        marked_data.append(marked_line)
-    return marked_data
+    lang       -- The language in which the sentences are (used to choose
+                  which spaCy pipeline to call).
+    batch_size -- Number of lines given to spaCy at a time.
+    """
+    keys = [(lang, tuple(line)) for line in data]
+    marked_data = [_entity_cache.get(key) for key in keys]
+
+    missing = collections.OrderedDict((key, None) for key, marked in
+                                      zip(keys, marked_data) if marked is None)
+    if len(missing) > 0:
+        spacy_nlp = get_spacy(lang, components='ner')
+        docs = ner_pipe(spacy_nlp, [list(key[1]) for key in missing],
+                        batch_size)
+        for key, doc in zip(list(missing), docs):
+            marked_line = []
+            for token, tok in zip(key[1], doc):
+                if tok.ent_type_ != '':
+                    marked_line.append('BOE')
+                    marked_line.append(token)
+                    marked_line.append(tok.ent_type_)
+                    marked_line.append('EOE')
+                else:
+                    marked_line.append(token)
+            missing[key] = tuple(marked_line)
+            _entity_cache.put(key, missing[key])
+        marked_data = [missing[key] if marked is None else marked
+                       for key, marked in zip(keys, marked_data)]
+    return [list(marked) for marked in marked_data]
 
 
-def sentence_tokenizer(line):
+def sentence_tokenizer(line, lang='en'):
     """
     `line` is a string containing potentially multiple sentences. For each
     sentence, this function produces a list of tokens. The output of this
@@ -277,17 +590,38 @@ def sentence_tokenizer(line):
     [['I',   'ate', 'chocolate'],
      ['She', 'ate', 'cake']]
     """
-    sentences = []
-    doc = get_spacy()(line)
-    for sent in doc.sents:
-        sentence_tokens = []
-        for token in sent:
-            if token.ent_type_ == '':
-                sentence_tokens.append(token.text.lower())
-            else:
-                sentence_tokens.append(token.text)
-        sentences.append(sentence_tokens)
-    return sentences
+    return next(process_documents([line], lang))[1]
+
+
+def process_documents(lines, lang='en', batch_size=1000):
+    """
+    Parses each string in `lines` once with spaCy and yields, for each line,
+    a tuple (tokens, sentences, entities) where:
+
+    tokens    -- the tokens of the line, as `tokenize` returns them.
+    sentences -- the tokens of each sentence of the line, as
+                 `sentence_tokenizer` returns them.
+    entities  -- a list with the (start, end, label) of each Named Entity,
+                 where `start` and `end` are indexes in `tokens`.
+
+    Sentences are split by the sentencizer instead of the dependency parser
+    (see the 'document' components in `spacy_components`).
+
+    Keyword arguments:
+    lang       -- Possible values are 'en' and 'de'
+    batch_size -- Number of lines given to spaCy at a time.
+    """
+    spacy_nlp = get_spacy(lang, components='document')
+    for doc in spacy_nlp.pipe(lines, batch_size=batch_size):
+        # `tokenize` only runs the tokenizer, so it knows of no entities
+        tokens = [token.text.lower() if lang == 'en' else token.text
+                  for token in doc]
+        sentences = [[token.text.lower() if token.ent_type_ == ''
+                      else token.text for token in sent]
+                     for sent in doc.sents]
+        entities = [(ent.start, ent.end, ent.label_) for ent in doc.ents]
+        yield tokens, sentences, entities
+
 
 def default_tokenize(sentence):
     """
@@ -306,22 +640,7 @@ def tokenize(line, tokenizer='spacy', lang='en'):
     """
     tokens = []
     if tokenizer == 'spacy':
-        if lang == 'en':
-            doc = spacy_tokenizer(line)
-        elif lang == 'de':
-            doc = spacy_tokenizer_de(line)
-        else:
-            doc = spacy_tokenizer(line)
-        for token in doc:
-            if token.ent_type_ == '':
-                if lang == 'en':
-                    text = token.text.lower()
-                else:
-                    # German is case sensitive
-                    text = token.text
-                tokens.append(text)
-            else:
-                tokens.append(token.text)
+        tokens = spacy_tokens(get_tokenizer(lang)(line), lang)
     elif tokenizer == 'nltk':
         tokens = nltk_tokenizer(line)
     elif tokenizer == 'split':
@@ -331,23 +650,1572 @@ def tokenize(line, tokenizer='spacy', lang='en'):
     return tokens
 
 
+def spacy_tokens(doc, lang='en'):
+    """
+    Returns a list of strings containing each token in the spaCy `doc`.
+    English tokens that are not part of an entity are downcased.
+    """
+    tokens = []
+    for token in doc:
+        if token.ent_type_ == '' and lang == 'en':
+            tokens.append(token.text.lower())
+        else:
+            # German is case sensitive
+            tokens.append(token.text)
+    return tokens
+
+
+def chunks(iterable, size):
+    """
+    Splits `iterable` into lists of at most `size` elements.
+    """
+    chunk = []
+    for item in iterable:
+        chunk.append(item)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if len(chunk) > 0:
+        yield chunk
+
+
+def _tokenize_chunk(args):
+    lines, tokenizer, lang, batch_size = args
+    return tokenize_batch(lines, tokenizer, lang, n_process=1,
+                          batch_size=batch_size)
+
+
+def iter_tokenize(lines, tokenizer='spacy', lang='en', n_process=1,
+                  batch_size=1000):
+    """
+    Same as `tokenize_batch`, but yields the list of tokens of each line as
+    soon as it is ready instead of returning all of them at once. `lines` can
+    be any iterable (e.g., an open file), so that big corpora can be streamed.
+    """
+    if n_process <= 1:
+        for line_chunk in chunks(lines, batch_size):
+            for tokens in tokenize_batch(line_chunk, tokenizer, lang,
+                                         batch_size=batch_size):
+                yield tokens
+        return
+
+    jobs = ((line_chunk, tokenizer, lang, batch_size)
+            for line_chunk in chunks(lines, batch_size))
+    with multiprocessing.Pool(n_process) as pool:
+        # `imap` keeps the order of the lines
+        for tokens_chunk in pool.imap(_tokenize_chunk, jobs):
+            for tokens in tokens_chunk:
+                yield tokens
+
+
+def tokenize_batch(lines, tokenizer='spacy', lang='en', n_process=1,
+                   batch_size=1000):
+    """
+    Tokenizes all strings in `lines` at once. Returns a list containing one
+    list of tokens for each line, exactly as `tokenize` would.
+
+    With the spaCy tokenizer, the lines are streamed through
+    `tokenizer.pipe`, which is much faster than tokenizing one line at a time.
+
+    Keyword arguments:
+    tokenizer  -- Possible values are 'spacy', 'nltk', 'split' and 'other'.
+    lang       -- Possible values are 'en' and 'de'
+    n_process  -- If bigger than 1, the lines are split into chunks of
+                  `batch_size` lines and tokenized by a pool of `n_process`
+                  worker processes.
+    batch_size -- Number of lines given to spaCy (or to a worker) at a time.
+    """
+    if n_process > 1:
+        return list(iter_tokenize(lines, tokenizer, lang, n_process,
+                                  batch_size))
+
+    if tokenizer == 'spacy':
+        spacy_tokenizer = get_tokenizer(lang)
+        return [spacy_tokens(doc, lang) for doc in
+                spacy_tokenizer.pipe(lines, batch_size=batch_size)]
+    return [tokenize(line, tokenizer, lang) for line in lines]
+
+
+# Name of the directory (next to each data file) where the token caches are
+# stored. See `build_token_cache`.
+token_cache_directory = 'token_cache'
+
+
+# The hashes computed by `file_hash`, keyed by the path, size and
+# modification time of each file
+_file_hashes = {}
+
+
+def file_hash(path, block_size=1 << 20):
+    """
+    Returns the SHA1 hex digest of the contents of the file `path`. The file
+    is read only the first time; afterwards, the hash is reused for as long
+    as its size and modification time don't change, so that opening the
+    same dataset again (a new epoch, another shard) doesn't read it all.
+    """
+    stat = os.stat(path)
+    key = (os.path.abspath(path), stat.st_size, stat.st_mtime_ns)
+    if key not in _file_hashes:
+        sha1 = hashlib.sha1()
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(block_size), b''):
+                sha1.update(block)
+        _file_hashes[key] = sha1.hexdigest()
+    return _file_hashes[key]
+
+
+def token_cache_path(path, tokenizer='spacy', lang='en', downcase=False,
+                     name='tokens', content_hash=None):
+    """
+    Returns the path of the token cache of the file `path`. The name of the
+    cache contains the tokenizer settings and the hash of the contents of
+    `path`, so a cache is never reused after the source file changes.
+    """
+    if content_hash is None:
+        content_hash = file_hash(path)
+    return os.path.join(os.path.dirname(path), token_cache_directory,
+                        '{}_{}_{}_{}_{}_{}.jsonl'.format(
+                            os.path.basename(path), name.replace(' ', '_'),
+                            tokenizer, lang, downcase, content_hash[:16]))
+
+
+def build_token_cache(path, processor, tokenizer='spacy', lang='en',
+                      downcase=False, name='tokens'):
+    """
+    Builds (if it does not exist yet) the token cache of the file `path` and
+    returns the path to it. The cache has exactly one line for each line of
+    `path`. Each line is the JSON encoding of whatever `processor` produced
+    for the corresponding line of `path` (normally, lists of tokens). Caches
+    of older versions of `path` are removed.
+
+    Keyword arguments:
+    processor -- a function that receives an iterable with the lines of
+                 `path` and yields one JSON-serializable entry for each line.
+    tokenizer -- the tokenizer used by `processor`. Part of the cache key.
+    lang      -- the language used by `processor`. Part of the cache key.
+    downcase  -- whether `processor` downcases the text. Part of the cache key.
+    name      -- distinguishes caches of the same file that contain different
+                 data (e.g. different columns).
+    """
+    cache_path = token_cache_path(path, tokenizer, lang, downcase, name)
+    if os.path.exists(cache_path):
+        return cache_path
+
+    stale_caches = glob.glob(cache_path[:-len('.jsonl') - 16] + '?' * 16 +
+                             '.jsonl')
+    for stale_cache in stale_caches:
+        os.remove(stale_cache)
+
+    print('Building the token cache {}'.format(cache_path))
+    os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+    tmp_path = '{}.{}.tmp'.format(cache_path, os.getpid())
+    with open(path, 'r') as f, open(tmp_path, 'w') as cf:
+        for entry in processor(f):
+            cf.write(json.dumps(entry))
+            cf.write('\n')
+    os.replace(tmp_path, cache_path)
+    return cache_path
+
+
+def open_token_cache(path, processor, tokenizer='spacy', lang='en',
+                     downcase=False, name='tokens', skip=0):
+    """
+    Builds the token cache of `path` if needed (see `build_token_cache`) and
+    returns it opened for reading, already advanced by `skip` lines. The
+    cache is meant to be read with `readline` in lockstep with `path`.
+    """
+    cache_file = open(build_token_cache(path, processor, tokenizer, lang,
+                                        downcase, name), 'r')
+    for _ in range(skip):
+        cache_file.readline()
+    return cache_file
+
+
+def load_token_dict(path, line_processor, tokenizer='spacy', lang='en',
+                    name='tokens'):
+    """
+    Returns a dictionary mapping the string `line_processor(line)` of each
+    line of `path` to its list of tokens. The tokens come from the token cache
+    of `path`, which is built if needed.
+    """
+    def processor(lines):
+        return iter_tokenize((line_processor(line) for line in lines),
+                             tokenizer, lang)
+
+    cache_path = build_token_cache(path, processor, tokenizer, lang,
+                                   name=name)
+    with open(path, 'r') as f, open(cache_path, 'r') as cf:
+        return {line_processor(line): json.loads(tokens)
+                for line, tokens in zip(f, cf)}
+
+
+def tokenize_with_cache(lines, cache, tokenizer='spacy', lang='en'):
+    """
+    Same as `tokenize_batch`, but looks the lines up in the dictionary `cache`
+    first (see `load_token_dict`). Lines missing from `cache` are tokenized
+    and added to it.
+    """
+    missing = [line for line in collections.OrderedDict.fromkeys(lines)
+               if line not in cache]
+    if len(missing) > 0:
+        cache.update(zip(missing, tokenize_batch(missing, tokenizer, lang)))
+    return [cache[line] for line in lines]
+
+
+encoded_cache_directory = 'encoded_cache'
+
+
+def vocabulary_hash(i2w):
+    """
+    Returns the SHA1 hex digest of the words of the vocabulary `i2w`, in the
+    order of their IDs.
+    """
+    sha1 = hashlib.sha1()
+    for i in sorted(i2w):
+        sha1.update(i2w[i].encode('utf-8'))
+        sha1.update(b'\n')
+    return sha1.hexdigest()
+
+
+def encoded_cache_path(path, i2w, name='encoded', content_hash=None):
+    """
+    Returns the directory of the encoded copy of the file `path` (see
+    `build_encoded_cache`). Like the token cache, its name contains the hash
+    of the contents of `path`, and also the hash of the vocabulary used to
+    encode it.
+    """
+    if content_hash is None:
+        content_hash = file_hash(path)
+    return os.path.join(os.path.dirname(path), encoded_cache_directory,
+                        '{}_{}_{}_{}'.format(os.path.basename(path),
+                                             name.replace(' ', '_'),
+                                             vocabulary_hash(i2w)[:16],
+                                             content_hash[:16]))
+
+
+def build_encoded_cache(path, processor, w2i, i2w, name='encoded',
+                        chunk_size=10000):
+    """
+    Builds (if it does not exist yet) an encoded copy of the file `path` and
+    returns its directory. `processor` receives an iterable with the lines of
+    `path` and yields one dictionary for each line, mapping column names to
+    either a list of tokens, an array of integers or a number. For a column
+    of tokens, the directory gets two .npy files:
+
+    <column>.npy         -- the IDs (see `seq2id`) of the tokens of all the
+                            lines, one after the other, as int32.
+    <column>_offsets.npy -- int64 array with len(lines) + 1 elements. The IDs
+                            of line `i` are <column>[offsets[i]:offsets[i+1]].
+
+    A column of integer arrays is stored in the same way, with the integers
+    themselves instead of the IDs. A column of numbers is stored as a float32
+    array in <column>.npy. Encoded copies of older versions of `path` are
+    removed.
+
+    Keyword arguments:
+    name       -- distinguishes encoded copies of the same file that contain
+                  different data.
+    chunk_size -- number of lines encoded at a time.
+    """
+    cache_path = encoded_cache_path(path, i2w, name)
+    if os.path.exists(cache_path):
+        return cache_path
+
+    for stale_cache in glob.glob(cache_path[:-16] + '?' * 16):
+        shutil.rmtree(stale_cache)
+
+    print('Building the encoded cache {}'.format(cache_path))
+    unk = w2i['UNK']
+    columns = collections.OrderedDict()
+    with open(path, 'r') as f:
+        for chunk in chunks(processor(f), chunk_size):
+            for column in chunk[0]:
+                values = [entry[column] for entry in chunk]
+                if isinstance(values[0], (list, tuple, np.ndarray)):
+                    if isinstance(values[0], np.ndarray):
+                        ids = np.concatenate(values).astype(np.int32)
+                    else:
+                        ids = np.fromiter((w2i.get(term, unk) for seq in values
+                                           for term in seq), dtype=np.int32)
+                    lengths = np.array([len(seq) for seq in values],
+                                       dtype=np.int64)
+                    columns.setdefault(column, []).append(ids)
+                    columns.setdefault(column + '_offsets', []).append(lengths)
+                else:
+                    columns.setdefault(column, []).append(
+                        np.array(values, dtype=np.float32))
+
+    tmp_path = '{}.{}.tmp'.format(cache_path, os.getpid())
+    os.makedirs(tmp_path, exist_ok=True)
+    for column, arrays in columns.items():
+        data = np.concatenate(arrays)
+        if column.endswith('_offsets'):
+            data = np.concatenate([[0], np.cumsum(data)]).astype(np.int64)
+        np.save(os.path.join(tmp_path, column + '.npy'), data)
+    os.replace(tmp_path, cache_path)
+    return cache_path
+
+
+def load_encoded_cache(cache_path, mmap_mode='r'):
+    """
+    Returns a dictionary with the arrays of the encoded cache in the
+    directory `cache_path` (see `build_encoded_cache`), memory-mapped by
+    default.
+    """
+    return {os.path.basename(column)[:-len('.npy')]:
+            np.load(column, mmap_mode=mmap_mode)
+            for column in glob.glob(os.path.join(cache_path, '*.npy'))}
+
+
+corpus_cache_directory = 'corpus_cache'
+
+
+def corpus_cache_path(path, name='corpus', content_hash=None):
+    """
+    Returns the directory of the binary copy of the corpus file `path` (see
+    `build_corpus_cache`). Like the token cache, its name contains the hash
+    of the contents of `path`.
+    """
+    if content_hash is None:
+        content_hash = file_hash(path)
+    return os.path.join(os.path.dirname(path), corpus_cache_directory,
+                        '{}_{}_{}'.format(os.path.basename(path),
+                                          name.replace(' ', '_'),
+                                          content_hash[:16]))
+
+
+def build_corpus_cache(path, processor, name='corpus', encoding='utf-8',
+                       chunk_size=10000):
+    """
+    Builds (if it does not exist yet) a compact binary copy of the corpus
+    file `path` and returns its directory. `processor` receives the opened
+    file and yields one dictionary per sentence (or any other unit), mapping
+    column names to either a list of strings or an integer. It should stream
+    the file, so that only the encoded copy is held in memory.
+
+    Unlike `build_encoded_cache`, no vocabulary is needed: the strings of
+    each column are numbered in the order in which they first appear, and
+    the list of them is saved in <column>_strings.json. The IDs and offsets
+    of a column of strings are saved like the ones of `build_encoded_cache`
+    (<column>.npy and <column>_offsets.npy). A column of integers is saved as
+    an int64 array in <column>.npy. Copies of older versions of `path` are
+    removed.
+
+    Keyword arguments:
+    name       -- distinguishes copies of the same file that contain
+                  different data.
+    encoding   -- the encoding of `path`.
+    chunk_size -- number of sentences encoded at a time.
+    """
+    cache_path = corpus_cache_path(path, name)
+    if os.path.exists(cache_path):
+        return cache_path
+
+    for stale_cache in glob.glob(cache_path[:-16] + '?' * 16):
+        shutil.rmtree(stale_cache)
+
+    print('Building the corpus cache {}'.format(cache_path))
+    s2i = collections.defaultdict(dict)
+    columns = collections.OrderedDict()
+    with open(path, 'r', encoding=encoding) as f:
+        for chunk in chunks(processor(f), chunk_size):
+            for column in chunk[0]:
+                values = [entry[column] for entry in chunk]
+                if isinstance(values[0], (list, tuple)):
+                    # New strings get the next ID of the column
+                    ids = s2i[column]
+                    ids = np.fromiter((ids.setdefault(term, len(ids))
+                                       for seq in values for term in seq),
+                                      dtype=np.int32)
+                    lengths = np.array([len(seq) for seq in values],
+                                       dtype=np.int64)
+                    columns.setdefault(column, []).append(ids)
+                    columns.setdefault(column + '_offsets', []).append(lengths)
+                else:
+                    columns.setdefault(column, []).append(
+                        np.array(values, dtype=np.int64))
+
+    tmp_path = '{}.{}.tmp'.format(cache_path, os.getpid())
+    os.makedirs(tmp_path, exist_ok=True)
+    for column, arrays in columns.items():
+        data = np.concatenate(arrays)
+        if column.endswith('_offsets'):
+            data = np.concatenate([[0], np.cumsum(data)]).astype(np.int64)
+        np.save(os.path.join(tmp_path, column + '.npy'), data)
+    for column, ids in s2i.items():
+        with open(os.path.join(tmp_path, column + '_strings.json'), 'w') as f:
+            json.dump(sorted(ids, key=ids.get), f)
+    os.replace(tmp_path, cache_path)
+    return cache_path
+
+
+def load_corpus_cache(cache_path, mmap_mode='r'):
+    """
+    Returns a dictionary with the arrays of the corpus cache in the directory
+    `cache_path` (see `build_corpus_cache`), memory-mapped by default. The
+    strings of each column are under '<column>_strings', as an array of
+    Python strings that can be indexed with the IDs of the column.
+    """
+    cache = load_encoded_cache(cache_path, mmap_mode)
+    for strings_path in glob.glob(os.path.join(cache_path, '*_strings.json')):
+        with open(strings_path, 'r') as f:
+            strings = json.load(f)
+        cache[os.path.basename(strings_path)[:-len('.json')]] = \
+            np.array(strings, dtype=object)
+    return cache
+
+
+def corpus_ids(cache, column, w2i):
+    """
+    Returns the IDs in the vocabulary `w2i` of all the tokens of the column
+    of strings `column` of the corpus cache `cache` (see
+    `load_corpus_cache`), as a flat int32 array that lines up with the
+    offsets of the column. Like the arrays of `encode_ragged`, they can be
+    passed to `pad_ragged` with those offsets. Only the string table of the
+    column is looked up in `w2i`, once per distinct string; the tokens are
+    then mapped with a single array lookup. Unknown strings get the ID of
+    'UNK'.
+    """
+    strings = cache[column + '_strings']
+    unk = w2i['UNK']
+    lookup = np.fromiter((w2i.get(s, unk) for s in strings), dtype=np.int32,
+                         count=len(strings))
+    return lookup[cache[column]]
+
+
+def corpus_tokens(cache, column, rows=None):
+    """
+    Yields the sequences `rows` (all of them by default) of the column of
+    strings `column` of the corpus cache `cache` (see `load_corpus_cache`),
+    each one as a list of strings. Meant for the few places that need the
+    strings themselves, like raw batches; see `corpus_ids` otherwise.
+    """
+    ids, offsets = cache[column], cache[column + '_offsets']
+    strings = cache[column + '_strings']
+    if rows is None:
+        rows = range(len(offsets) - 1)
+    for i in rows:
+        yield strings[ids[offsets[i]:offsets[i + 1]]].tolist()
+
+
+def ragged_positions(lengths):
+    """
+    Returns the position of each element inside its sequence, for sequences
+    of the given `lengths` laid one after the other. For example, for the
+    lengths [2, 3] it returns [0, 1, 0, 1, 2].
+    """
+    lengths = np.asarray(lengths, dtype=np.int64)
+    return np.arange(int(lengths.sum())) - \
+        np.repeat(np.cumsum(lengths) - lengths, lengths)
+
+
+def pad_ragged(ids, offsets, rows, pad=0, seq_begin=False, seq_end=False,
+               drop_ids=None):
+    """
+    Same as `encode_batch`, but for the sequences `rows` of an encoded
+    column (see `build_encoded_cache`), whose IDs are sliced straight from
+    `ids` instead of being looked up in a vocabulary. The IDs in `drop_ids`
+    are removed from the sequences before they are padded.
+    """
+    rows = np.asarray(rows, dtype=np.int64)
+    offset = 1 if seq_begin else 0
+    starts = np.asarray(offsets[rows], dtype=np.int64)
+    seq_lengths = np.asarray(offsets[rows + 1], dtype=np.int64) - starts
+    if drop_ids is not None:
+        row_index = np.repeat(np.arange(len(rows)), seq_lengths)
+        values = ids[np.repeat(starts, seq_lengths) +
+                     ragged_positions(seq_lengths)]
+        keep = ~np.isin(values, drop_ids)
+        values, row_index = values[keep], row_index[keep]
+        seq_lengths = np.bincount(row_index, minlength=len(rows))
+    lengths = seq_lengths + offset + (1 if seq_end else 0)
+    if pad == 0:
+        pad = int(lengths.max()) if len(rows) > 0 else 0
+    lengths = np.minimum(lengths, pad).astype(np.int32)
+
+    batch = np.zeros((len(rows), pad), dtype=np.int32)
+    if pad == 0:
+        return batch, lengths
+
+    # Tokens that fit into the array after the 'SEQ_BEGIN' marker
+    n_tokens = np.minimum(seq_lengths, max(pad - offset, 0))
+    positions = ragged_positions(n_tokens)
+    if drop_ids is None:
+        row_index = np.repeat(np.arange(len(rows)), n_tokens)
+        values = ids[np.repeat(starts, n_tokens) + positions]
+    else:
+        fits = ragged_positions(seq_lengths) < n_tokens[row_index]
+        values, row_index = values[fits], row_index[fits]
+    batch[row_index, positions + offset] = values
+
+    # The vocabulary files always start with 'PAD', 'SEQ_BEGIN' and 'SEQ_END'
+    if seq_begin:
+        batch[:, 0] = 1
+    if seq_end:
+        end_positions = seq_lengths + offset
+        fits = end_positions < pad
+        batch[fits, end_positions[fits]] = 2
+    return batch, lengths
+
+
+def pad_ragged_sentences(ids, offsets, sentence_offsets, rows, pad=0,
+                         seq_begin=False, seq_end=False):
+    """
+    Same as `pad_ragged`, but for rows made of several sequences, such as the
+    sentences of a review. The IDs of sentence `j` are
+    `ids[offsets[j]:offsets[j+1]]`, and the sentences of row `i` are the
+    sentences `sentence_offsets[i]` to `sentence_offsets[i+1] - 1`.
+
+    Returns the padded IDs and the lengths of all the sentences of `rows`,
+    one row after the other (see `pad_ragged`), and the number of sentences
+    of each row.
+    """
+    rows = np.asarray(rows, dtype=np.int64)
+    first_sentences = np.asarray(sentence_offsets[rows], dtype=np.int64)
+    n_sentences = np.asarray(sentence_offsets[rows + 1],
+                             dtype=np.int64) - first_sentences
+    sentences = np.repeat(first_sentences, n_sentences) + \
+        ragged_positions(n_sentences)
+    batch, lengths = pad_ragged(ids, offsets, sentences, pad, seq_begin,
+                                seq_end)
+    return batch, lengths, n_sentences
+
+
+def split_sentences(batch, lengths, n_sentences, pad=0):
+    """
+    Splits the sentences returned by `pad_ragged_sentences` into one entry
+    per row, like the `sentences` of the batches that are built from text:
+    a list with the IDs of each sentence if `pad` is 0, or else an array of
+    shape [n_sentences, pad].
+    """
+    ends = np.cumsum(n_sentences)[:-1]
+    if pad == 0:
+        return [[s[:l].tolist() for s, l in zip(row, row_lengths)]
+                for row, row_lengths in zip(np.split(batch, ends),
+                                            np.split(lengths, ends))]
+    return np.split(batch, ends)
+
+
+# A batch of rows made of several sequences (e.g. reviews made of sentences)
+# as flat arrays. `values` has the IDs of all the sentences, one after the
+# other. The IDs of sentence `j` are values[sentence_splits[j]:
+# sentence_splits[j+1]], and row `i` has the sentences row_splits[i] to
+# row_splits[i+1] - 1.
+RaggedSentences = collections.namedtuple('RaggedSentences',
+        ['values', 'row_splits', 'sentence_splits'])
+
+
+def ragged_sentences(ids, offsets, sentence_offsets, rows=None,
+                     seq_begin=False, seq_end=False):
+    """
+    Returns the sentences of `rows` (all of them by default) of an encoded
+    column as `RaggedSentences`. The arguments are the ones of
+    `pad_ragged_sentences`. If `seq_begin` or `seq_end` are True, the IDs of
+    'SEQ_BEGIN' and 'SEQ_END' are inserted around each sentence.
+    """
+    if rows is None:
+        rows = np.arange(len(sentence_offsets) - 1)
+    rows = np.asarray(rows, dtype=np.int64)
+    first_sentences = np.asarray(sentence_offsets[rows], dtype=np.int64)
+    n_sentences = np.asarray(sentence_offsets[rows + 1],
+                             dtype=np.int64) - first_sentences
+    sentences = np.repeat(first_sentences, n_sentences) + \
+        ragged_positions(n_sentences)
+    starts = np.asarray(offsets[sentences], dtype=np.int64)
+    lengths = np.asarray(offsets[sentences + 1], dtype=np.int64) - starts
+
+    offset = 1 if seq_begin else 0
+    new_lengths = lengths + offset + (1 if seq_end else 0)
+    sentence_splits = np.concatenate([[0], np.cumsum(new_lengths)])
+    values = np.zeros(sentence_splits[-1], dtype=np.int32)
+    positions = ragged_positions(lengths)
+    values[np.repeat(sentence_splits[:-1] + offset, lengths) + positions] = \
+        ids[np.repeat(starts, lengths) + positions]
+    # The vocabulary files always start with 'PAD', 'SEQ_BEGIN' and 'SEQ_END'
+    if seq_begin:
+        values[sentence_splits[:-1]] = 1
+    if seq_end:
+        values[sentence_splits[1:] - 1] = 2
+    row_splits = np.concatenate([[0], np.cumsum(n_sentences)])
+    return RaggedSentences(values, row_splits, sentence_splits)
+
+
+def encode_sentences(data, w2i, seq_begin=False, seq_end=False):
+    """
+    Encodes `data`, a list of rows that are lists of sentences of tokens
+    (like the `sentences` of the review datasets), as `RaggedSentences`.
+    """
+    n_sentences = np.array([len(row) for row in data], dtype=np.int64)
+    lengths = np.array([len(sentence) for row in data for sentence in row],
+                       dtype=np.int64)
+    unk = w2i['UNK']
+    ids = np.fromiter((w2i.get(term, unk) for row in data for sentence in row
+                       for term in sentence), dtype=np.int32,
+                      count=int(lengths.sum()))
+    return ragged_sentences(ids, np.concatenate([[0], np.cumsum(lengths)]),
+                            np.concatenate([[0], np.cumsum(n_sentences)]),
+                            seq_begin=seq_begin, seq_end=seq_end)
+
+
+def dense_sentences(ragged, max_sentences=0, max_tokens=0):
+    """
+    Writes the `RaggedSentences` `ragged` into a preallocated int32 array of
+    shape [n_rows, max_sentences, max_tokens], padded with 0. Rows with more
+    sentences and sentences with more tokens are trimmed. If `max_sentences`
+    or `max_tokens` are 0, the longest row or sentence is used.
+
+    Returns the array, the number of sentences of each row and the length
+    of each sentence (an [n_rows, max_sentences] array), both after
+    trimming.
+    """
+    values, row_splits, sentence_splits = ragged
+    n_rows = len(row_splits) - 1
+    n_sentences = np.diff(row_splits)
+    lengths = np.diff(sentence_splits)
+    if max_sentences == 0:
+        max_sentences = int(n_sentences.max()) if n_rows > 0 else 0
+    if max_tokens == 0:
+        max_tokens = int(lengths.max()) if len(lengths) > 0 else 0
+
+    # Row and position of each sentence, and sentence and position of each
+    # token, so that all the kept tokens are written at once
+    sentence_rows = np.repeat(np.arange(n_rows), n_sentences)
+    sentence_positions = ragged_positions(n_sentences)
+    kept_sentences = sentence_positions < max_sentences
+    token_sentences = np.repeat(np.arange(len(lengths)), lengths)
+    token_positions = ragged_positions(lengths)
+    kept = kept_sentences[token_sentences] & (token_positions < max_tokens)
+
+    batch = np.zeros((n_rows, max_sentences, max_tokens), dtype=np.int32)
+    batch[sentence_rows[token_sentences[kept]],
+          sentence_positions[token_sentences[kept]],
+          token_positions[kept]] = values[kept]
+    sentence_lengths = np.zeros((n_rows, max_sentences), dtype=np.int32)
+    sentence_lengths[sentence_rows[kept_sentences],
+                     sentence_positions[kept_sentences]] = \
+        np.minimum(lengths, max_tokens)[kept_sentences]
+    return (batch, np.minimum(n_sentences, max_sentences).astype(np.int32),
+            sentence_lengths)
+
+
+class RowOrder(object):
+    """
+    Chooses the rows of the batches that are sliced from the encoded copy of
+    a dataset with `n_rows` rows (see `build_encoded_cache`). The `order`
+    and `shard` arguments are the ones of `LineReader`: the 'sequential'
+    order reads the rows in order, and any other order reads them in a new
+    random order (an index permutation) every epoch.
+    """
+    def __init__(self, n_rows, order='sequential', seed=None, shard=None):
+        self.first, last = shard_bounds(n_rows, shard)
+        self.n_rows = last - self.first
+        self.random = np.random.RandomState(seed)
+        self.permutation = None
+        if order != 'sequential':
+            self.permutation = self.random.permutation(self.n_rows)
+        self.position = 0
+
+    def next_rows(self, batch_size):
+        """
+        Returns an array with the next `batch_size` rows, and the number of
+        epochs that were completed while choosing them. Like `next_batch`,
+        the rows wrap around to the next epoch to fill the batch.
+        """
+        rows, n_chosen, epochs = [], 0, 0
+        while n_chosen < batch_size:
+            if self.position == self.n_rows:
+                epochs += 1
+                self.position = 0
+                if self.permutation is not None:
+                    self.permutation = self.random.permutation(self.n_rows)
+            n = min(batch_size - n_chosen, self.n_rows - self.position)
+            epoch_rows = np.arange(self.position, self.position + n)
+            if self.permutation is not None:
+                epoch_rows = self.permutation[epoch_rows]
+            rows.append(self.first + epoch_rows)
+            self.position += n
+            n_chosen += n
+        return np.concatenate(rows), epochs
+
+
+line_index_directory = 'line_index'
+
+
+def line_offsets(path, block_size=1 << 22):
+    """
+    Returns the byte offset of the beginning of each line of the file `path`,
+    followed by the size of the file, as an int64 array (so line `i` is in
+    the byte range [offsets[i], offsets[i+1])). The index is saved next to
+    `path`, keyed by the hash of its contents, and memory-mapped when it is
+    loaded again.
+    """
+    index_path = os.path.join(os.path.dirname(path), line_index_directory,
+                              '{}_{}.npy'.format(os.path.basename(path),
+                                                 file_hash(path)[:16]))
+    if os.path.exists(index_path):
+        return np.load(index_path, mmap_mode='r')
+
+    for stale_index in glob.glob(index_path[:-len('.npy') - 16] + '?' * 16 +
+                                 '.npy'):
+        os.remove(stale_index)
+
+    offsets, position = [np.zeros(1, dtype=np.int64)], 0
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            newlines = np.flatnonzero(np.frombuffer(block, dtype=np.uint8) ==
+                                      ord('\n'))
+            offsets.append(newlines.astype(np.int64) + position + 1)
+            position += len(block)
+    offsets = np.concatenate(offsets)
+    if offsets[-1] != position:
+        offsets = np.append(offsets, position)
+
+    os.makedirs(os.path.dirname(index_path), exist_ok=True)
+    tmp_path = '{}.{}.tmp.npy'.format(index_path[:-len('.npy')], os.getpid())
+    np.save(tmp_path, offsets)
+    os.replace(tmp_path, index_path)
+    return offsets
+
+
+def shard_bounds(n_rows, shard=None):
+    """
+    Returns the rows [first, last) of the shard `shard`, an (index, n_shards)
+    tuple, when `n_rows` rows are split into `n_shards` contiguous blocks of
+    (almost) the same size. Without a shard, all the rows are returned.
+    """
+    if shard is None:
+        return 0, n_rows
+    index, n_shards = shard
+    if not 0 <= index < n_shards:
+        raise ValueError('The shard index must be in [0, {})'.format(n_shards))
+    return n_rows * index // n_shards, n_rows * (index + 1) // n_shards
+
+
+def epoch_batches(dataset, n_rows, batch_size=64, **kwargs):
+    """
+    Yields the batches of `dataset.next_batch(size, **kwargs)` for batch
+    sizes of at most `batch_size` that add up to `n_rows`. Used by the
+    `iter_epoch` method of the datasets: when `dataset` has exactly `n_rows`
+    rows left in its epoch, every row is read once and `next_batch` never
+    wraps around to the next epoch to fill the last, shorter batch.
+    """
+    for first in range(0, n_rows, batch_size):
+        yield dataset.next_batch(min(batch_size, n_rows - first), **kwargs)
+
+
+class LineReader(object):
+    """
+    Reads the lines of one or more files that have the same number of lines
+    (e.g. a data file and its token cache) in lockstep. `readline` returns a
+    list with the same line of each file, or None once every line was read,
+    after which the next call starts a new epoch.
+
+    Keyword arguments:
+    order       -- 'sequential' reads the lines in the order of the files.
+                   'shuffle' reads them in a new random order every epoch,
+                   seeking to each line with the index of `line_offsets`, so
+                   only the index is kept in memory. 'buffer' reads the files
+                   sequentially, but returns the lines at random from a
+                   buffer of `buffer_size` lines; it needs no index, so it
+                   is meant for files too large to index.
+    buffer_size -- size of the buffer of the 'buffer' order.
+    seed        -- seed of the random orders.
+    skip        -- number of lines skipped at the beginning of the first
+                   epoch.
+    shard       -- an (index, n_shards) tuple. If given, only the index-th of
+                   `n_shards` contiguous blocks of lines is read (this needs
+                   the index of `line_offsets`, whatever the order).
+    """
+    orders = ['sequential', 'shuffle', 'buffer']
+
+    def __init__(self, paths, order='sequential', buffer_size=10000,
+                 seed=None, skip=0, shard=None):
+        if order not in self.orders:
+            raise ValueError('order must be one of {}'.format(self.orders))
+        self.order = order
+        self.buffer_size = buffer_size
+        self.random = np.random.RandomState(seed)
+        self.encoding = locale.getpreferredencoding(False)
+        self.files = [open(path, 'rb') for path in paths]
+        self.buffer = []
+
+        # Lines [first, last) are read. `last` is None when the whole files
+        # are read without an index.
+        self.offsets = None
+        self.first, self.last = 0, None
+        if order == 'shuffle' or shard is not None:
+            self.offsets = [line_offsets(path) for path in paths]
+            self.last = len(self.offsets[0]) - 1
+        if shard is not None:
+            self.first, self.last = shard_bounds(self.last, shard)
+
+        if order == 'shuffle':
+            self.permutation = self.first + self.random.permutation(
+                self.last - self.first)
+            self.position = skip
+        else:
+            self._rewind()
+            for _ in range(skip):
+                self._read()
+
+    def _read(self):
+        if self.last is not None and self.line >= self.last:
+            return None
+        lines = [f.readline() for f in self.files]
+        if lines[0] == b'':
+            return None
+        self.line += 1
+        return [line.decode(self.encoding) for line in lines]
+
+    def _rewind(self):
+        for i, f in enumerate(self.files):
+            f.seek(0 if self.offsets is None else self.offsets[i][self.first])
+        self.line = self.first
+
+    def readline(self):
+        if self.order == 'sequential':
+            lines = self._read()
+            if lines is None:
+                self._rewind()
+            return lines
+
+        if self.order == 'shuffle':
+            if self.position >= len(self.permutation):
+                self.permutation = self.first + self.random.permutation(
+                    len(self.permutation))
+                self.position = 0
+                return None
+            self.line = self.permutation[self.position]
+            self.position += 1
+            for f, offsets in zip(self.files, self.offsets):
+                f.seek(offsets[self.line])
+            return self._read()
+
+        while len(self.buffer) < self.buffer_size:
+            lines = self._read()
+            if lines is None:
+                break
+            self.buffer.append(lines)
+        if len(self.buffer) == 0:
+            self._rewind()
+            return None
+        # Swap a random line with the last one, so it can be popped in O(1)
+        i = self.random.randint(len(self.buffer))
+        self.buffer[i], self.buffer[-1] = self.buffer[-1], self.buffer[i]
+        return self.buffer.pop()
+
+    def n_lines(self):
+        """
+        Returns the number of lines read in an epoch. It is only known when
+        the lines are indexed, that is, with the 'shuffle' order or a shard.
+        """
+        if self.last is None:
+            raise ValueError('The number of lines is only known for indexed '
+                            'readers (with the shuffle order or a shard)')
+        return self.last - self.first
+
+    def close(self):
+        for f in self.files:
+            f.close()
+        self.buffer = []
+
+
+class PrefetchingLoader(object):
+    """
+    Calls `dataset.next_batch(**kwargs)` in the background and keeps up to
+    `queue_size` ready batches in a queue, so that building the next batch
+    overlaps with the training step. `next_batch` returns the batches in the
+    order in which they were built, as the same `Batch` namedtuples that
+    `dataset.next_batch` returns.
+
+    `epochs_completed` is the value that the dataset had right after
+    building the last batch returned, so training loops see the same epochs
+    as without the loader. Any other attribute is read from `dataset`. The
+    loader can be used as a context manager, which calls `close` on exit.
+
+    Keyword arguments:
+    queue_size -- maximum number of ready batches.
+    mode       -- 'thread' builds the batches in a thread of this process.
+                  'process' builds them in a forked process, which does not
+                  compete for the GIL. The forked process works on its own
+                  copy of `dataset`, so `dataset` should not be used directly
+                  while the loader runs.
+    kwargs     -- the arguments of `dataset.next_batch`.
+    """
+    modes = ['thread', 'process']
+
+    def __init__(self, dataset, queue_size=8, mode='thread', **kwargs):
+        if mode not in self.modes:
+            raise ValueError('mode must be one of {}'.format(self.modes))
+        self.dataset = dataset
+        self.kwargs = kwargs
+        self.mode = mode
+        self._epochs_completed = dataset.epochs_completed
+        # Number of batches returned, how many of them were not ready when
+        # they were requested, and the time spent waiting for them
+        self.n_batches = 0
+        self.n_starved = 0
+        self.wait_time = 0.0
+
+        if mode == 'thread':
+            self.queue = queue.Queue(queue_size)
+            self.stop_event = threading.Event()
+            self.worker = threading.Thread(target=self._produce)
+        else:
+            context = multiprocessing.get_context('fork')
+            self.queue = context.Queue(queue_size)
+            self.stop_event = context.Event()
+            self.worker = context.Process(target=self._produce)
+        self.worker.daemon = True
+        self.worker.start()
+
+    def _put(self, item):
+        while not self.stop_event.is_set():
+            try:
+                self.queue.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                continue
+
+    def _produce(self):
+        try:
+            while not self.stop_event.is_set():
+                batch = self.dataset.next_batch(**self.kwargs)
+                # Plain tuples, because the `Batch` classes are created by
+                # each dataset and cannot be pickled
+                self._put((tuple(batch), self.dataset.epochs_completed, None))
+        except Exception as e:
+            self._put((None, None, e))
+
+    def _get(self):
+        while True:
+            try:
+                return self.queue.get(timeout=0.1)
+            except queue.Empty:
+                if not self.worker.is_alive():
+                    raise RuntimeError('The batch producer is not running')
+
+    def next_batch(self):
+        try:
+            fields, epochs_completed, error = self.queue.get_nowait()
+        except queue.Empty:
+            self.n_starved += 1
+            start = time.time()
+            fields, epochs_completed, error = self._get()
+            self.wait_time += time.time() - start
+        if error is not None:
+            self.close()
+            raise error
+        self.n_batches += 1
+        self._epochs_completed = epochs_completed
+        return self.dataset.Batch(*fields)
+
+    def stats(self):
+        """
+        Returns a dictionary with the number of batches returned, how many
+        of them had to be waited for (the queue was empty), and the total
+        time spent waiting. A high starvation rate means the model is faster
+        than the batch producer.
+        """
+        return {'batches': self.n_batches, 'starved': self.n_starved,
+                'starved_fraction': self.n_starved / max(self.n_batches, 1),
+                'wait_time': self.wait_time}
+
+    def _drain(self):
+        try:
+            while True:
+                self.queue.get_nowait()
+        except queue.Empty:
+            pass
+
+    def close(self):
+        """
+        Stops the batch producer and discards the batches not returned yet.
+        """
+        self.stop_event.set()
+        while self.worker.is_alive():
+            self._drain()
+            self.worker.join(0.1)
+        self._drain()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    @property
+    def epochs_completed(self):
+        return self._epochs_completed
+
+    def __getattr__(self, name):
+        if name == 'dataset':
+            raise AttributeError(name)
+        return getattr(self.dataset, name)
+
+
+def _attach_shared_memory(name):
+    from multiprocessing import shared_memory, resource_tracker
+
+    try:
+        return shared_memory.SharedMemory(name=name, track=False)
+    except TypeError:
+        # Before Python 3.13 every attached block is tracked, and the
+        # tracker would unlink it when this process exits
+        block = shared_memory.SharedMemory(name=name)
+        resource_tracker.unregister(block._name, 'shared_memory')
+        return block
+
+
+class SharedMemoryLoader(object):
+    """
+    Builds the batches of `dataset` in `n_workers` forked processes. Worker
+    `i` opens shard `i` of the dataset, by calling
+    `dataset.open(shard=(i, n_workers), **open_kwargs)`, and calls
+    `dataset.next_batch(**kwargs)` on it. The numeric numpy arrays of each
+    batch (e.g. padded IDs) are written into shared memory
+    (`multiprocessing.shared_memory`), so they reach this process as
+    zero-copy views instead of being pickled. The other fields of the batch
+    are pickled. `next_batch` returns the batches of the workers in turn.
+
+    Each worker owns `n_slots` shared memory slots, so it can build up to
+    `n_slots` batches ahead. The slot of a batch is given back to its worker
+    on the next call to `next_batch`, so its arrays must be copied if they
+    are needed for longer than that.
+
+    `epochs_completed` is the number of epochs that every worker has
+    completed over its shard. Any other attribute is read from `dataset`.
+
+    Needs Python 3.8+, the first version with `multiprocessing.shared_memory`.
+    On older versions, `PrefetchingLoader` builds the batches in a thread.
+    """
+    def __init__(self, dataset, n_workers=None, n_slots=4, open_kwargs=None,
+                 **kwargs):
+        try:
+            from multiprocessing import shared_memory
+        except ImportError:
+            raise ImportError('SharedMemoryLoader needs '
+                              'multiprocessing.shared_memory (Python 3.8+). '
+                              'Please use PrefetchingLoader with older '
+                              'versions of Python.')
+        self.dataset = dataset
+        self.n_workers = n_workers or multiprocessing.cpu_count()
+        self.n_slots = n_slots
+        self.open_kwargs = open_kwargs or {}
+        self.kwargs = kwargs
+        self.n_batches = 0
+        self.n_starved = 0
+        self.wait_time = 0.0
+
+        context = multiprocessing.get_context('fork')
+        self.stop_event = context.Event()
+        self.ready_queues, self.free_queues, self.workers = [], [], []
+        for i in range(self.n_workers):
+            self.ready_queues.append(context.Queue())
+            self.free_queues.append(context.Queue())
+            for slot in range(n_slots):
+                self.free_queues[i].put(slot)
+            self.workers.append(context.Process(target=self._produce,
+                                                args=(i,)))
+            self.workers[-1].daemon = True
+            self.workers[-1].start()
+
+        self.worker_epochs = [0] * self.n_workers
+        self.blocks = {}
+        self.next_worker = 0
+        self.last_slot = None
+
+    def _produce(self, worker):
+        from multiprocessing import shared_memory
+
+        # slots[slot][field] is the shared memory block of that field
+        slots = [{} for _ in range(self.n_slots)]
+        try:
+            self.dataset.open(shard=(worker, self.n_workers),
+                              **self.open_kwargs)
+            while not self.stop_event.is_set():
+                batch = self.dataset.next_batch(**self.kwargs)
+                slot = None
+                while slot is None and not self.stop_event.is_set():
+                    try:
+                        slot = self.free_queues[worker].get(timeout=0.1)
+                    except queue.Empty:
+                        continue
+                if slot is None:
+                    break
+
+                fields = []
+                for field, value in enumerate(batch):
+                    if not isinstance(value, np.ndarray) or \
+                            value.dtype.hasobject:
+                        fields.append(('value', value))
+                        continue
+                    block = slots[slot].get(field)
+                    if block is None or block.size < value.nbytes:
+                        if block is not None:
+                            block.close()
+                            block.unlink()
+                        block = shared_memory.SharedMemory(
+                            create=True, size=max(value.nbytes, 1))
+                        slots[slot][field] = block
+                    np.ndarray(value.shape, value.dtype,
+                               buffer=block.buf)[...] = value
+                    fields.append(('shared', (block.name, value.shape,
+                                              value.dtype.str)))
+                self.ready_queues[worker].put(
+                    (slot, fields, self.dataset.epochs_completed, None))
+        except Exception as e:
+            self.ready_queues[worker].put((None, None, None, e))
+        finally:
+            for blocks in slots:
+                for block in blocks.values():
+                    block.close()
+                    block.unlink()
+
+    def _get(self, worker):
+        while True:
+            try:
+                return self.ready_queues[worker].get(timeout=0.1)
+            except queue.Empty:
+                if not self.workers[worker].is_alive():
+                    raise RuntimeError('Batch worker {} is not '
+                                       'running'.format(worker))
+
+    def next_batch(self):
+        if self.last_slot is not None:
+            self.free_queues[self.last_slot[0]].put(self.last_slot[1])
+            self.last_slot = None
+
+        worker = self.next_worker
+        self.next_worker = (worker + 1) % self.n_workers
+        try:
+            slot, fields, epochs_completed, error = \
+                self.ready_queues[worker].get_nowait()
+        except queue.Empty:
+            self.n_starved += 1
+            start = time.time()
+            slot, fields, epochs_completed, error = self._get(worker)
+            self.wait_time += time.time() - start
+        if error is not None:
+            self.close()
+            raise error
+
+        values = []
+        for kind, value in fields:
+            if kind == 'shared':
+                name, shape, dtype = value
+                if name not in self.blocks:
+                    self.blocks[name] = _attach_shared_memory(name)
+                value = np.ndarray(shape, np.dtype(dtype),
+                                   buffer=self.blocks[name].buf)
+            values.append(value)
+        self.last_slot = (worker, slot)
+        self.worker_epochs[worker] = epochs_completed
+        self.n_batches += 1
+        return self.dataset.Batch(*values)
+
+    def stats(self):
+        """
+        Same as `PrefetchingLoader.stats`.
+        """
+        return {'batches': self.n_batches, 'starved': self.n_starved,
+                'starved_fraction': self.n_starved / max(self.n_batches, 1),
+                'wait_time': self.wait_time}
+
+    def close(self):
+        """
+        Stops the workers and releases the shared memory. The arrays of the
+        batches returned so far must not be used afterwards.
+        """
+        self.stop_event.set()
+        for worker, process in enumerate(self.workers):
+            while process.is_alive():
+                try:
+                    while True:
+                        self.ready_queues[worker].get_nowait()
+                except queue.Empty:
+                    pass
+                process.join(0.1)
+        for block in self.blocks.values():
+            try:
+                block.close()
+            except BufferError:
+                # A returned batch still uses it; the mapping is released
+                # when the batch is garbage collected
+                pass
+        self.blocks = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    @property
+    def epochs_completed(self):
+        return min(self.worker_epochs)
+
+    def __getattr__(self, name):
+        if name == 'dataset':
+            raise AttributeError(name)
+        return getattr(self.dataset, name)
+
+
+def bucket_boundaries(lengths, n_buckets=4):
+    """
+    Chooses the upper lengths of `n_buckets` length buckets for sequences
+    with the given `lengths`, so that padding every sequence to the upper
+    length of its bucket needs as few 'PAD' tokens as possible. Returns the
+    sorted list of upper lengths; the last one is the maximum length.
+    """
+    values, counts = np.unique(np.asarray(lengths, dtype=np.int64),
+                               return_counts=True)
+    n_buckets = max(1, min(n_buckets, len(values)))
+    cum_counts = np.concatenate([[0], np.cumsum(counts)])
+    cum_lengths = np.concatenate([[0], np.cumsum(counts * values)])
+
+    def padding(first, last):
+        # PADs needed by the lengths values[first:last + 1] (`first` can be
+        # an array) padded to values[last]
+        return values[last] * (cum_counts[last + 1] - cum_counts[first]) - \
+            (cum_lengths[last + 1] - cum_lengths[first])
+
+    # best[k, j]: fewest PADs for values[:j + 1] with k + 1 buckets, the
+    # last of which ends at values[j]. start[k, j]: where that bucket starts
+    best = np.full((n_buckets, len(values)), np.inf)
+    start = np.zeros((n_buckets, len(values)), dtype=np.int64)
+    best[0] = [padding(0, j) for j in range(len(values))]
+    for k in range(1, n_buckets):
+        for j in range(k, len(values)):
+            firsts = np.arange(k, j + 1)
+            costs = best[k - 1, firsts - 1] + padding(firsts, j)
+            start[k, j] = firsts[np.argmin(costs)]
+            best[k, j] = costs.min()
+
+    boundaries, j = [], len(values) - 1
+    for k in range(n_buckets - 1, -1, -1):
+        boundaries.append(int(values[j]))
+        j = start[k, j] - 1
+    return sorted(boundaries)
+
+
+def length_profile(lengths, boundaries=None, pad=None):
+    """
+    Describes the distribution of the sequence `lengths`. Returns a
+    dictionary with the number of sequences, the mean and some percentiles of
+    the lengths, and the fraction of 'PAD' tokens in the padded batches when
+    all sequences are padded to `pad` (the maximum length by default) and
+    when each one is padded to the upper length of its bucket (see
+    `bucket_boundaries`).
+    """
+    lengths = np.asarray(lengths, dtype=np.int64)
+    if pad is None:
+        pad = int(lengths.max())
+    clipped = np.minimum(lengths, pad)
+    profile = {'count': len(lengths), 'mean': float(lengths.mean()),
+               'max': int(lengths.max()), 'pad': pad,
+               'pad_fraction': float(1.0 - clipped.sum() /
+                                     float(pad * len(lengths)))}
+    for percentile in [50, 90, 95, 99]:
+        profile['p{}'.format(percentile)] = \
+            float(np.percentile(lengths, percentile))
+    if boundaries is not None:
+        boundaries = np.asarray(boundaries)
+        bucket_pads = boundaries[np.minimum(
+            np.searchsorted(boundaries, lengths), len(boundaries) - 1)]
+        clipped = np.minimum(lengths, bucket_pads)
+        profile['boundaries'] = boundaries.tolist()
+        profile['bucket_pad_fraction'] = float(1.0 - clipped.sum() /
+                                               float(bucket_pads.sum()))
+    return profile
+
+
+def pad_to_length(data, length):
+    """
+    Pads (or trims) each sequence in `data` to `length` elements, like
+    `padseq`. Sequences of one-hot vectors (2-D arrays) are padded with
+    vectors of zeros.
+    """
+    first = np.asarray(data[0]) if len(data) > 0 else np.zeros(0)
+    padded = np.zeros((len(data), length) + first.shape[1:],
+                      dtype=first.dtype if first.ndim > 1 else np.int32)
+    for i, d in enumerate(data):
+        d = np.asarray(d)[:length]
+        padded[i, :len(d)] = d
+    return padded
+
+
+class BucketSampler(object):
+    """
+    Returns the examples of `dataset` in batches of sequences of similar
+    length, padded only to the longest sequence of the batch instead of to a
+    fixed length.
+
+    The sampler calls `dataset.next_batch(batch_size=pool_size, pad=0,
+    **kwargs)`, splits the batches into examples and puts each example in
+    the bucket of its length. A batch is returned as soon as a bucket has
+    `batch_size` examples; examples of a bucket that is not full yet wait
+    for the next calls. The returned batches are the `Batch` namedtuples of
+    the dataset, with the `pad_fields` padded and, if the batches have a
+    `length_field`, with the lengths of the padded sequences in it.
+
+    Keyword arguments:
+    pad_fields   -- names of the fields with sequences to pad (e.g.
+                    ['sentences', 'pos', 'ner'] for `Acner`). The length of
+                    an example is the length of its first pad field, or its
+                    `length_field` if the batches have it.
+    boundaries   -- upper lengths of the buckets. Longer sequences are
+                    trimmed to the last boundary. If None, `n_buckets`
+                    boundaries are chosen with `bucket_boundaries` from the
+                    lengths of the first `pool_size` examples.
+    pool_size    -- number of examples requested from the dataset at a time
+                    (8 batches by default).
+    kwargs       -- other arguments of `dataset.next_batch`.
+    """
+    def __init__(self, dataset, pad_fields, batch_size=64, boundaries=None,
+                 n_buckets=4, length_field='lengths', pool_size=None,
+                 **kwargs):
+        self.dataset = dataset
+        self.pad_fields = list(pad_fields)
+        self.batch_size = batch_size
+        self.boundaries = boundaries
+        self.n_buckets = n_buckets
+        self.length_field = length_field
+        self.pool_size = pool_size or 8 * batch_size
+        self.kwargs = kwargs
+        self._epochs_completed = dataset.epochs_completed
+        # One list of (example, epochs_completed) per bucket
+        self.buckets = None
+
+    def _fill(self):
+        batch = self.dataset.next_batch(batch_size=self.pool_size, pad=0,
+                                        **self.kwargs)
+        epochs_completed = self.dataset.epochs_completed
+        self.array_fields = [name for name, value in zip(batch._fields, batch)
+                             if isinstance(value, np.ndarray)]
+        examples = list(zip(*batch))
+        if self.length_field in batch._fields:
+            lengths = getattr(batch, self.length_field)
+        else:
+            lengths = [len(s) for s in getattr(batch, self.pad_fields[0])]
+
+        if self.boundaries is None:
+            self.boundaries = bucket_boundaries(lengths, self.n_buckets)
+        if self.buckets is None:
+            self.buckets = [[] for _ in self.boundaries]
+        buckets = np.minimum(np.searchsorted(self.boundaries, lengths),
+                             len(self.boundaries) - 1)
+        for example, length, bucket in zip(examples, lengths, buckets):
+            self.buckets[bucket].append((example, length, epochs_completed))
+
+    def next_batch(self):
+        while True:
+            full = [b for b in self.buckets or [] if len(b) >= self.batch_size]
+            if len(full) > 0:
+                break
+            self._fill()
+
+        # The fullest bucket goes first, so no bucket grows without bound
+        bucket = max(full, key=len)
+        entries = bucket[:self.batch_size]
+        del bucket[:self.batch_size]
+        examples, lengths, epochs = zip(*entries)
+        pad = min(max(lengths), self.boundaries[-1])
+
+        fields = dict(zip(self.dataset.Batch._fields, zip(*examples)))
+        for name in self.pad_fields:
+            fields[name] = pad_to_length(fields[name], pad)
+        if self.length_field in fields:
+            fields[self.length_field] = [min(l, pad) for l in lengths]
+        for name in fields:
+            if name in self.pad_fields or name == self.length_field:
+                continue
+            if name in self.array_fields:
+                fields[name] = np.asarray(fields[name])
+            else:
+                fields[name] = list(fields[name])
+        self._epochs_completed = max(epochs)
+        return self.dataset.Batch(**fields)
+
+    @property
+    def epochs_completed(self):
+        return self._epochs_completed
+
+    def __getattr__(self, name):
+        if name == 'dataset':
+            raise AttributeError(name)
+        return getattr(self.dataset, name)
+
+
+# Files are only split into shards for `vocabulary_builder` if each shard
+# gets at least this many bytes. Smaller files are counted in one process.
+vocabulary_shard_size = 1 << 22
+
+# The `line_processor` of the current `vocabulary_builder` call. The worker
+# processes are forked, so they inherit it without having to pickle it (it
+# is usually a lambda).
+_shard_line_processor = None
+
+
+def file_shards(path, n_shards):
+    """
+    Splits the file `path` into at most `n_shards` byte ranges. Every range
+    starts at the beginning of a line and ends at the beginning of the line
+    after its last one, so each line belongs to exactly one range. Returns a
+    list of (start, end) tuples.
+    """
+    size = os.path.getsize(path)
+    bounds = [0]
+    with open(path, 'rb') as f:
+        for i in range(1, n_shards):
+            f.seek(max(size * i // n_shards - 1, bounds[-1]))
+            f.readline()
+            bounds.append(min(f.tell(), size))
+    bounds.append(size)
+    return [(start, end) for start, end in zip(bounds[:-1], bounds[1:])
+            if end > start]
+
+
+def read_shard(path, start, end, block_lines=10000):
+    """
+    Yields the lines of `path` in the byte range [`start`, `end`) (see
+    `file_shards`), exactly as iterating over `open(path, 'r')` would.
+    """
+    encoding = locale.getpreferredencoding(False)
+    with open(path, 'rb') as f:
+        f.seek(start)
+        block = []
+        while f.tell() < end:
+            line = f.readline()
+            if line == b'':
+                break
+            block.append(line)
+            if len(block) == block_lines or f.tell() >= end:
+                text = b''.join(block).decode(encoding)
+                for decoded_line in io.StringIO(text, newline=None):
+                    yield decoded_line
+                block = []
+
+
+def _vocabulary_tokens(lines, line_processor, tokenizer, lang, downcase,
+                       n_process=1):
+    lines = (line_processor(line) for line in lines)
+    if downcase:
+        lines = (line.lower() for line in lines)
+    return iter_tokenize(lines, tokenizer, lang, n_process)
+
+
+def _count_tokens(cnt, all_tokens):
+    n_lines = 0
+    for tokens in all_tokens:
+        cnt.update([_ for _ in tokens if len(_) > 0])
+        n_lines += 1
+    return n_lines
+
+
+def _count_shard(args):
+    path, start, end, tokenizer, lang, downcase, from_cache = args
+    lines = read_shard(path, start, end)
+    if from_cache:
+        all_tokens = (json.loads(line) for line in lines)
+    else:
+        all_tokens = _vocabulary_tokens(lines, _shard_line_processor,
+                                        tokenizer, lang, downcase)
+    cnt = collections.Counter()
+    n_lines = _count_tokens(cnt, all_tokens)
+    return cnt, n_lines
+
+
+def count_tokens_sharded(path, n_process, tokenizer='spacy', lang='en',
+                         downcase=True, line_processor=None, from_cache=False):
+    """
+    Map-reduce version of the token counting in `vocabulary_builder`. The
+    file `path` is split into byte ranges (see `file_shards`), the tokens of
+    each range are counted by a pool of `n_process` worker processes and the
+    counters are merged. The result is the same as counting serially.
+
+    Returns the merged `collections.Counter` and the number of lines read.
+
+    Keyword arguments:
+    from_cache -- If True, `path` is a token cache (see `build_token_cache`),
+                  whose lines are already lists of tokens.
+    """
+    global _shard_line_processor
+
+    n_shards = min(n_process,
+                   max(1, os.path.getsize(path) // vocabulary_shard_size))
+    shards = file_shards(path, n_shards)
+    jobs = [(path, start, end, tokenizer, lang, downcase, from_cache)
+            for start, end in shards]
+
+    cnt = collections.Counter()
+    n_lines = 0
+    bar = progressbar.ProgressBar(max_value=len(jobs), redirect_stdout=True)
+    _shard_line_processor = line_processor
+    try:
+        with multiprocessing.get_context('fork').Pool(len(jobs)) as pool:
+            for i, (shard_cnt, shard_lines) in enumerate(
+                    pool.imap_unordered(_count_shard, jobs)):
+                cnt.update(shard_cnt)
+                n_lines += shard_lines
+                bar.update(i + 1)
+    finally:
+        _shard_line_processor = None
+    bar.finish()
+    return cnt, n_lines
+
+
 def vocabulary_builder(data_paths, min_frequency=5, tokenizer='spacy',
-                   downcase=True, max_vocab_size=None, line_processor=None, lang='en'):
+                   downcase=True, max_vocab_size=None, line_processor=None,
+                   lang='en', n_process=None, cache_name=None):
+    """
+    Counts the tokens in all files of `data_paths` and returns the list of
+    (token, count) pairs of the new vocabulary.
+
+    Keyword arguments:
+    n_process  -- Number of worker processes used to count the tokens of
+                  big files (see `count_tokens_sharded`). If None, one per
+                  CPU. If 1, everything is done in the current process.
+    cache_name -- If not None, the tokens of each file are stored in (and
+                  read from) a token cache with this name (see
+                  `build_token_cache`). It must identify `line_processor`.
+    """
+    if n_process is None:
+        n_process = multiprocessing.cpu_count()
+
     print('Building a new vocabulary')
     cnt = collections.Counter()
     for data_path in data_paths:
+        sharded = n_process > 1 and \
+                os.path.getsize(data_path) >= 2 * vocabulary_shard_size
+        from_cache = cache_name is not None
+        if from_cache:
+            processor = functools.partial(_vocabulary_tokens,
+                    line_processor=line_processor, tokenizer=tokenizer,
+                    lang=lang, downcase=downcase,
+                    n_process=n_process if sharded else 1)
+            data_path = build_token_cache(data_path, processor, tokenizer,
+                                          lang, downcase, cache_name)
+
+        if sharded:
+            file_cnt, n_lines = count_tokens_sharded(data_path, n_process,
+                    tokenizer, lang, downcase, line_processor, from_cache)
+            cnt.update(file_cnt)
+            print('Read {} lines from {}'.format(n_lines, data_path))
+            continue
+
         bar = progressbar.ProgressBar(max_value=progressbar.UnknownLength,
                                       redirect_stdout=True)
-        n_line = 0
-        for line in open(data_path, 'r'):
-            line = line_processor(line)
-            if downcase:
-                line = line.lower()
-            tokens = tokenize(line, tokenizer, lang)
-            tokens = [_ for _ in tokens if len(_) > 0]
-            cnt.update(tokens)
-            n_line += 1
-            bar.update(n_line)
+        n_lines = 0
+        with open(data_path, 'r') as f:
+            if from_cache:
+                all_tokens = (json.loads(line) for line in f)
+            else:
+                all_tokens = _vocabulary_tokens(f, line_processor, tokenizer,
+                                                lang, downcase)
+            for block in chunks(all_tokens, 1000):
+                n_lines += _count_tokens(cnt, block)
+                bar.update(n_lines)
         bar.finish()
 
     print("Found %d unique tokens in the vocabulary.", len(cnt))
@@ -375,7 +2243,8 @@ def vocabulary_builder(data_paths, min_frequency=5, tokenizer='spacy',
 
 def new_vocabulary(files, dataset_path, min_frequency, tokenizer,
                     downcase, max_vocab_size, name,
-                    line_processor=lambda line: " ".join(line.split('\t')[:2]), lang='en'):
+                    line_processor=lambda line: " ".join(line.split('\t')[:2]), lang='en',
+                    n_process=None, cache_name=None):
 
     vocab_path = os.path.join(dataset_path,
                               '{}_{}_{}_{}_{}_vocab.txt'.format(
@@ -399,13 +2268,9 @@ def new_vocabulary(files, dataset_path, min_frequency, tokenizer,
     word_with_counts = vocabulary_builder(files,
                 min_frequency=min_frequency, tokenizer=tokenizer,
                 downcase=downcase, max_vocab_size=max_vocab_size,
-                line_processor=line_processor, lang=lang)
+                line_processor=line_processor, lang=lang, n_process=n_process,
+                cache_name=cache_name)
 
-    entities = ['PERSON', 'NORP', 'FACILITY', 'ORG', 'GPE', 'LOC' +
-                'PRODUCT', 'EVENT', 'WORK_OF_ART', 'LANGUAGE',
-                'DATE', 'TIME', 'PERCENT', 'MONEY', 'QUANTITY',
-                'ORDINAL', 'CARDINAL', 'BOE', 'EOE']
-    
     with open(vocab_path, 'w') as vf, open(metadata_path, 'w') as mf:
         mf.write('word\tfreq\n')
         mf.write('PAD\t1\n')
@@ -418,7 +2283,7 @@ def new_vocabulary(files, dataset_path, min_frequency, tokenizer,
         vf.write('SEQ_END\t1\n')
         vf.write('UNK\t1\n')
         
-        for ent in entities :
+        for ent in entity_tokens:
             vf.write("{}\t{}\n".format(ent, 1))
             mf.write("{}\t{}\n".format(ent, 1))
         for word, count in word_with_counts:
@@ -461,36 +2326,129 @@ def load_vocabulary(vocab_path):
     return w2i, i2w
 
 
-def preload_w2v(w2i, initialize='random', lang='en'):
+def lookup_vectors(vocab, terms):
     '''
-    Loads the vocabulary based on spaCy's vectors.
+    Looks all strings in `terms` up in the word vectors of the spaCy
+    vocabulary `vocab`, without running the spaCy pipeline. Returns a boolean
+    array telling which terms have a vector, and a float32 array with the
+    vectors of those terms (in the same order as in `terms`).
+    '''
+    vectors = getattr(vocab, 'vectors', None)
+    if vectors is not None and hasattr(vectors, 'key2row'):
+        # spaCy 2+: one table with all vectors, indexed by the string hashes
+        from spacy.strings import hash_string
+        rows = np.array([vectors.key2row.get(hash_string(term), -1)
+                         for term in terms], dtype=np.int64)
+        found = rows >= 0
+        return found, np.asarray(vectors.data[rows[found]], dtype=np.float32)
+
+    # spaCy 1.x: each lexeme of the vocabulary has its own vector
+    lexemes = [vocab[term] for term in terms]
+    found = np.array([lex.has_vector for lex in lexemes], dtype=bool)
+    found_vectors = np.empty((int(found.sum()), vocab.vectors_length),
+                             dtype=np.float32)
+    for row, lex in enumerate(l for l, f in zip(lexemes, found) if f):
+        found_vectors[row] = lex.vector
+    return found, found_vectors
+
+
+def preload_w2v(w2i, initialize='random', lang='en', dims=300):
+    '''
+    Loads the vocabulary based on spaCy's vectors. Returns a float32 matrix
+    with one row for each word in `w2i`.
 
     Keyword arguments:
     initialize -- Either 'random' or 'zeros'. Indicate the value of the new
                     vectors to be created (if a word is not found in spaCy's
                     vocabulary
     lang       -- Either 'en' or 'de'.
+    dims       -- The size of the vectors.
     '''
-    print('Preloading a w2v matrix with dims VOCAB_SIZE X 300')
-    spacy_nlp = get_spacy(lang)
+    print('Preloading a w2v matrix with dims VOCAB_SIZE X {}'.format(dims))
+    spacy_nlp = get_spacy(lang, components='vectors')
     if initialize == 'random':
-        w2v = np.random.rand(len(w2i) , 300)
+        # Filled in blocks to avoid a temporary float64 copy of the matrix
+        w2v = np.empty((len(w2i), dims), dtype=np.float32)
+        for i in range(0, len(w2i), 10000):
+            w2v[i:i + 10000] = np.random.rand(min(10000, len(w2i) - i), dims)
     else:
-        w2v = np.zeros((len(w2i), 300))
+        w2v = np.zeros((len(w2i), dims), dtype=np.float32)
 
-    for term in w2i:
-        if spacy_nlp(term).has_vector:
-            w2v[w2i[term]] = spacy_nlp(term).vector
+    if len(w2i) == 0:
+        return w2v
 
+    terms = list(w2i.keys())
+    ids = np.array([w2i[term] for term in terms], dtype=np.int64)
+    found, vectors = lookup_vectors(spacy_nlp.vocab, terms)
+    if vectors.shape[1] == dims:
+        w2v[ids[found]] = vectors
+    else:
+        print('spaCy vectors have {} dimensions instead of {}. '
+              'Ignoring them.'.format(vectors.shape[1], dims))
+        found[:] = False
+
+    print('Found vectors for {} of {} words ({:.2%})'.format(
+            int(found.sum()), len(terms), found.mean()))
     return w2v
 
 
-def load_w2v(path):
-    return np.load(path)
+def load_w2v(path, mmap_mode=None):
+    """
+    Loads the word vectors in `path` as a float32 matrix.
+
+    Keyword arguments:
+    mmap_mode -- If not None, the file is memory-mapped with this mode (see
+                 `np.load`) instead of being read into memory. Processes
+                 that map the same file share one copy of it in the page
+                 cache. Files saved as float64 are converted once to a
+                 float32 copy (see `float32_w2v_path`), which is mapped.
+    """
+    w2v = np.load(path, mmap_mode=mmap_mode)
+    if w2v.dtype == np.float32:
+        return w2v
+    if mmap_mode is None:
+        return w2v.astype(np.float32)
+
+    float32_path = float32_w2v_path(path)
+    if not os.path.exists(float32_path) or \
+            os.path.getmtime(float32_path) < os.path.getmtime(path):
+        save_w2v(float32_path, w2v)
+    return np.load(float32_path, mmap_mode=mmap_mode)
+
+
+def float32_w2v_path(path):
+    """
+    Returns the path of the float32 copy of the word vectors in `path`.
+    """
+    return '{}_float32.npy'.format(os.path.splitext(path)[0])
 
 
 def save_w2v(path, w2v):
-    return np.save(path, w2v)
+    """
+    Saves the word vectors `w2v` in `path` as a float32 matrix.
+    """
+    return np.save(path, np.asarray(w2v, dtype=np.float32))
+
+
+class LazyW2V(object):
+    """
+    Descriptor for the `w2v` attribute of the dataset classes. The word
+    vectors in `w2v_path` are only loaded (memory-mapped, by default) the
+    first time the attribute is read. Assigning None to the attribute makes
+    it load `w2v_path` again on the next access.
+    """
+    def __init__(self, mmap_mode='r'):
+        self.mmap_mode = mmap_mode
+
+    def __get__(self, obj, objtype=None):
+        if obj is None:
+            return self
+        if getattr(obj, '_w2v', None) is None:
+            obj._w2v = load_w2v(obj.w2v_path, mmap_mode=self.mmap_mode)
+        return obj._w2v
+
+    def __set__(self, obj, w2v):
+        obj._w2v = w2v
 
 
 def validate_rescale(rescale):
@@ -534,6 +2492,172 @@ def paths_exist(paths_list):
     return True
 
 
+def file_stamp(path):
+    """
+    Returns the size and the modification time of the file `path`. They are
+    enough to tell that a file built by the datasets changed, without
+    hashing it (see `build_manifest`).
+    """
+    stat = os.stat(path)
+    return [stat.st_size, stat.st_mtime]
+
+
+def build_manifest(sources, outputs, **params):
+    """
+    Returns the manifest of the files in the dictionary `outputs` (name ->
+    path), which were built from the files `sources` with the parameters
+    `params`. It holds the hashes of the sources (see `file_hash`), the
+    stamps of the outputs (see `file_stamp`) and the parameters, so that
+    `matching_manifest` can tell when the outputs can be loaded as they are.
+    The parameters must be JSON-serializable.
+    """
+    return {'sources': {path: file_hash(path) for path in sources},
+            'outputs': {name: [path] + file_stamp(path)
+                        for name, path in outputs.items()},
+            'params': params}
+
+
+def save_manifest(manifest_path, manifest):
+    """
+    Saves `manifest` (see `build_manifest`) as JSON in `manifest_path`. The
+    file is replaced atomically, so a build that is interrupted leaves no
+    manifest behind.
+    """
+    tmp_path = '{}.{}.tmp'.format(manifest_path, os.getpid())
+    with open(tmp_path, 'w') as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    os.replace(tmp_path, manifest_path)
+
+
+def matching_manifest(manifest_path, sources, **params):
+    """
+    Returns the manifest in `manifest_path` (see `build_manifest`) if it was
+    built from the current contents of the files `sources` with the same
+    `params`, and none of its outputs changed since. Otherwise, or if there
+    is no manifest, returns None.
+    """
+    if not os.path.exists(manifest_path):
+        return None
+    with open(manifest_path, 'r') as f:
+        manifest = json.load(f)
+    # Compared after a round trip through JSON, which turns tuples into lists
+    if manifest['params'] != json.loads(json.dumps(params)):
+        return None
+    if sorted(manifest['sources']) != sorted(sources) or \
+            not paths_exist(sources) or \
+            any(manifest['sources'][path] != file_hash(path)
+                for path in sources):
+        return None
+    for path, size, mtime in manifest['outputs'].values():
+        if not os.path.exists(path) or file_stamp(path) != [size, mtime]:
+            return None
+    return manifest
+
+
+# The function run by the workers of `run_folds`. The workers are forked
+# after it is set, so it is never pickled
+_fold_function = None
+
+
+def _run_fold(fold):
+    return _fold_function(fold)
+
+
+def run_folds(fold_function, n_folds, n_processes=None):
+    """
+    Calls `fold_function(fold)` for each of the `n_folds` folds of a
+    cross-validation concurrently, in a pool of forked processes (one per
+    core, at most one per fold), and returns their results in the order of
+    the folds. Each fold runs in a new process, so models of different folds
+    never share a session or a graph. The data that `fold_function` uses can
+    be prepared once before the call (e.g., with
+    `TwitterEmotion.encode_folds`): the workers inherit it when they are
+    forked, and only the results (e.g., dictionaries of metrics, see
+    `aggregate_metrics`) are pickled back.
+
+    One process per core is only right for models trained on the CPU. On a
+    GPU, every process allocates its own memory there, so `n_processes`
+    should be as many as fit on the GPU, and each process should cap its
+    memory (e.g., with `per_process_gpu_memory_fraction` or `allow_growth`,
+    see templates/TwitterEmotionsKeras.py).
+    """
+    global _fold_function
+    if n_processes is None:
+        n_processes = multiprocessing.cpu_count()
+    n_processes = max(1, min(n_processes, n_folds))
+
+    _fold_function = fold_function
+    context = multiprocessing.get_context('fork')
+    try:
+        with context.Pool(n_processes, maxtasksperchild=1) as pool:
+            return pool.map(_run_fold, range(n_folds), chunksize=1)
+    finally:
+        _fold_function = None
+
+
+def aggregate_metrics(results):
+    """
+    Returns the mean and the standard deviation of each metric over the
+    dictionaries of metrics `results` (one per fold, see `run_folds`), as a
+    dictionary {metric: (mean, std)}.
+    """
+    return {metric: (float(np.mean([r[metric] for r in results])),
+                     float(np.std([r[metric] for r in results])))
+            for metric in results[0]}
+
+
+def read_first_lines(paths, n_threads=16, encoding='utf8'):
+    """
+    Returns the first line of each of the files `paths`, in the same order.
+    The files are read by a pool of `n_threads` threads, so that the latency
+    of opening many small files (e.g., on a network filesystem) overlaps.
+    """
+    def read(path):
+        with open(path, 'r', encoding=encoding) as f:
+            return f.readline()
+
+    with concurrent.futures.ThreadPoolExecutor(n_threads) as executor:
+        return list(executor.map(read, paths))
+
+
+def save_pack(pack_path, records, directories):
+    """
+    Packs `records`, a list of (path, ...) tuples with JSON-serializable
+    values describing the files in `directories` (e.g., the path, label and
+    text of each file of a corpus), into the single file `pack_path`. The
+    first line holds the modification times of `directories`, which change
+    when files are added to or removed from them. Each of the following
+    lines holds one record. The file is replaced atomically.
+    """
+    header = {'directories': {d: os.stat(d).st_mtime for d in directories}}
+    tmp_path = '{}.{}.tmp'.format(pack_path, os.getpid())
+    with open(tmp_path, 'w', encoding='utf8') as f:
+        f.write(json.dumps(header) + '\n')
+        for record in records:
+            f.write(json.dumps(record) + '\n')
+    os.replace(tmp_path, pack_path)
+
+
+def load_pack(pack_path, directories, paths):
+    """
+    Returns the records of the pack `pack_path` (see `save_pack`) with one
+    sequential read, or None if there is no pack or it is stale: if any of
+    `directories` changed since it was packed, or its records are not the
+    ones of the files `paths`.
+    """
+    if not os.path.exists(pack_path):
+        return None
+    with open(pack_path, 'r', encoding='utf8') as f:
+        header = json.loads(f.readline())
+        if header['directories'] != {d: os.stat(d).st_mtime
+                                     for d in directories}:
+            return None
+        records = [tuple(json.loads(line)) for line in f]
+    if sorted(record[0] for record in records) != sorted(paths):
+        return None
+    return records
+
+
 from .gersen import Gersen
 from .sts import STS
 from .sts_large import STSLarge
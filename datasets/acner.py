@@ -1,20 +1,23 @@
 import os
 import csv
-import random
+import copy
+import time
+import warnings
 import collections
 
 from builtins import len
 
-import datasets
+import numpy as np
 
-from tflearn.data_utils import to_categorical
+import datasets
 
 
 class Acner():
     def __init__(self, train_validate_split=None, test_split=None,
-                 use_defaults=False, shuffle=True):
+                 use_defaults=False, shuffle=True, seed=None):
         self.construct()
-        self.load(use_defaults, train_validate_split, test_split, shuffle)
+        self.load(use_defaults, train_validate_split, test_split, shuffle,
+                  seed)
         #super(Acner, self).__init__(train_validate_split, test_split,
         #                            use_defaults, shuffle)
 
@@ -27,6 +30,9 @@ class Acner():
         self.train_path = os.path.join(self.dataset_path, 'train.txt')
         self.validate_path = os.path.join(self.dataset_path, 'validate.txt')
         self.test_path = os.path.join(self.dataset_path, 'test.txt')
+        # The rows of the corpus cache in each split (see `load_anew`)
+        self.splits_path = os.path.join(self.dataset_path, 'splits.npz')
+        self.manifest_path = os.path.join(self.dataset_path, 'manifest.json')
 
         self.vocab_paths = [os.path.join(self.dataset_path, 'vocab.txt'),
                             os.path.join(self.dataset_path, 'pos_vocab.txt'),
@@ -44,78 +50,152 @@ class Acner():
         self.i2w = [None, None, None]
         self.w2v = [None, None, None]
 
-    def load(self, use_defaults, train_validate_split, test_split, shuffle):
-        if (use_defaults or
-                train_validate_split is None or
-                test_split is None) and \
-                (os.path.exists(self.train_path) and
-                os.path.exists(self.validate_path) and
-                os.path.exists(self.test_path) and
-                datasets.paths_exist(self.vocab_paths) and
-                datasets.paths_exist(self.metadata_paths) and
-                datasets.paths_exist(self.w2v_paths)):
-            self.initialize_defaults(shuffle)
+        # The columns of the corpus cache, in the order of `self.w2i`
+        self.corpus_columns = ['words', 'pos', 'ner']
+
+    def load(self, use_defaults, train_validate_split, test_split, shuffle,
+             seed=None):
+        """
+        Loads the splits, the vocabularies and the word vectors built by an
+        earlier construction (a warm start) if its manifest matches the
+        source file, the splits, `shuffle` and `seed`. Otherwise, or if the
+        splits are shuffled without a `seed`, builds them anew from the
+        source file (a cold build). The time of both is kept
+        in `load_times`.
+        """
+        if use_defaults or train_validate_split is None or test_split is None:
+            train_validate_split = datasets.train_validate_split
+            test_split = datasets.test_split_small
+        params = dict(train_validate_split=train_validate_split,
+                      test_split=test_split, shuffle=shuffle, seed=seed)
+
+        start = time.time()
+        manifest = None
+        # Without a seed, a shuffled split is a new random split every time
+        if seed is not None or not shuffle:
+            manifest = datasets.matching_manifest(self.manifest_path,
+                                                  self.source_paths(),
+                                                  **params)
+        # Manifests of older versions don't list all the current outputs
+        if manifest is not None and \
+                sorted(manifest['outputs']) == sorted(self.output_paths()):
+            self.initialize_defaults(manifest, shuffle)
+            self.report_load_times(manifest, time.time() - start)
         else:
-            if test_split is None:
-                test_split = datasets.test_split_small
-            if train_validate_split is None:
-                train_validate_split = datasets.train_validate_split
-            self.load_anew(train_validate_split, test_split,
-                           shuffle=shuffle)
-
-    def initialize_defaults(self, shuffle):
-        # For now, we are happy that this works =)
-        self.load_anew(train_validate_split=datasets.train_validate_split,
-                       test_split=datasets.test_split_small, shuffle=shuffle)
-        #train_data = self.load_data(self.train_path)
-        #validate_data = self.load_data(self.validate_path)
-        #test_data = self.load_data(self.test_path)
+            self.load_anew(train_validate_split, test_split, shuffle=shuffle,
+                           seed=seed)
+            self.save_manifest(time.time() - start, **params)
 
-        #self.w2i, self.i2w = datasets.load_vocabulary(self.vocab_path)
-        #self.w2v = datasets.load_w2v(self.w2v_path)
+    def source_paths(self):
+        return [os.path.join(self.dataset_path, 'acner.csv')]
 
-        #self.train = DataSet(train_data, (self.w2i, self.i2w), shuffle)
-        #self.validate = DataSet(validate_data, (self.w2i, self.i2w), shuffle)
-        #self.test = DataSet(test_data, (self.w2i, self.i2w), shuffle)
-
-
-    def load_anew(self, train_validate_split, test_split, shuffle=True):
-        all_data = self.load_all_data(self.dataset_path)
+    def output_paths(self):
+        outputs = {'train': self.train_path, 'validate': self.validate_path,
+                   'test': self.test_path, 'splits': self.splits_path}
+        for i in range(len(self.vocab_paths)):
+            outputs['vocab_{}'.format(i)] = self.vocab_paths[i]
+            outputs['metadata_{}'.format(i)] = self.metadata_paths[i]
+            outputs['w2v_{}'.format(i)] = self.w2v_paths[i]
+        return outputs
+
+    def save_manifest(self, build_time, **params):
+        manifest = datasets.build_manifest(self.source_paths(),
+                                           self.output_paths(), **params)
+        manifest['build_time'] = build_time
+        datasets.save_manifest(self.manifest_path, manifest)
+        self.load_times = {'cold_build': build_time, 'warm_load': None}
+        print('Built {} from the source files in {:.2f}s'.format(
+                self.dataset_name, build_time))
+
+    def report_load_times(self, manifest, load_time):
+        self.load_times = {'cold_build': manifest['build_time'],
+                           'warm_load': load_time}
+        print('Loaded {} in {:.2f}s (built from the source files in '
+              '{:.2f}s)'.format(self.dataset_name, load_time,
+                                manifest['build_time']))
+
+    def initialize_defaults(self, manifest, shuffle=True):
+        """
+        Loads the splits, the vocabularies and the word vectors listed in
+        `manifest` (see `load`), without parsing the source file again.
+        """
+        outputs = {name: output[0]
+                   for name, output in manifest['outputs'].items()}
+        self.train_path = outputs['train']
+        self.validate_path = outputs['validate']
+        self.test_path = outputs['test']
+        for i in range(len(self.vocab_paths)):
+            self.vocab_paths[i] = outputs['vocab_{}'.format(i)]
+            self.metadata_paths[i] = outputs['metadata_{}'.format(i)]
+            self.w2v_paths[i] = outputs['w2v_{}'.format(i)]
+            self.w2i[i], self.i2w[i] = datasets.load_vocabulary(
+                    self.vocab_paths[i])
+            # Memory-mapped instead of preloaded again (see `datasets.load_w2v`)
+            self.w2v[i] = datasets.load_w2v(self.w2v_paths[i], mmap_mode='r')
+
+        self.initialize_datasets(*self.load_splits(outputs), shuffle=shuffle)
+
+    def load_splits(self, outputs):
+        """
+        Returns the (corpus cache, rows) pairs of the train, validation and
+        test splits saved by `load_anew`, given the `outputs` of its manifest.
+        """
+        self.splits_path = outputs['splits']
+        corpus = self.load_all_data(self.dataset_path)
+        with np.load(self.splits_path) as splits:
+            return [(corpus, splits[name])
+                    for name in ['train', 'validate', 'test']]
+
+    def load_anew(self, train_validate_split, test_split, shuffle=True,
+                  seed=None):
+        """
+        Splits the sentences of the corpus cache (see `load_all_data`) by
+        their row numbers, so that the data of every split is a pair (corpus
+        cache, rows) and no sentence is copied or decoded. The rows of each
+        split are saved in `splits_path`.
+        """
+        corpus = self.load_all_data(self.dataset_path)
+        all_rows = np.arange(len(corpus['index']))
 
         if shuffle:
-            random.shuffle(all_data)
+            all_rows = np.random.RandomState(seed).permutation(all_rows)
 
         # First we take the test data away
-        total_length = len(all_data)
+        total_length = len(all_rows)
         test_length = int(total_length * test_split)
-        train_validate_data, test_data = all_data[:-test_length],\
-                                         all_data[-test_length:]
+        train_validate_rows, test_rows = all_rows[:-test_length],\
+                                         all_rows[-test_length:]
 
         # Then we split the training/validation data
-        train_validate_length = len(train_validate_data)
+        train_validate_length = len(train_validate_rows)
         train_length = int(train_validate_length * train_validate_split)
-        train_data, validate_data = train_validate_data[:train_length], \
-                                    train_validate_data[train_length:]
-
+        train_rows, validate_rows = train_validate_rows[:train_length], \
+                                    train_validate_rows[train_length:]
+        np.savez(self.splits_path, train=train_rows, validate=validate_rows,
+                 test=test_rows)
+
+        train_data, validate_data, test_data = [
+                (corpus, rows)
+                for rows in [train_rows, validate_rows, test_rows]]
         self.dump_all_data(train_data, validate_data, test_data)
         self.initialize_vocabulary()
         self.initialize_datasets(train_data, validate_data, test_data, shuffle)
 
     def load_all_data(self, path):
-        file_name = 'acner.csv'
-        path_plus_file_name = os.path.join(path, file_name)
-        with open(path_plus_file_name, 'r', encoding='cp1252') as f:
-            csv_reader = csv.reader(f, delimiter=',')
-
-            # Skip one line
-            next(csv_reader)
-
-            all_lines = [i for i in csv_reader]
-        return self.group_words_into_sentences(all_lines)
+        """
+        Returns the corpus cache of acner.csv (see
+        `datasets.load_corpus_cache`), with one row per sentence in the
+        columns 'words', 'pos', 'ner' and 'index'. The file is parsed only
+        once: afterwards, the sentences are read from the cache.
+        """
+        path_plus_file_name = os.path.join(path, 'acner.csv')
+        return datasets.load_corpus_cache(datasets.build_corpus_cache(
+                path_plus_file_name, self.iter_sentences, name='sentences',
+                encoding='cp1252'))
 
     def initialize_vocabulary(self):
         self.initialize_vocabulary_ll(['texts', 'pos', 'ner'], [5,1,1],
-                                      [False, False, False], ['spacy', 'split', 'split'])
+                                      [False, False, False], ['split', 'split', 'split'])
 
     def initialize_vocabulary_ll(self, names, min_frequencies,
                                  downcases, tokenizer):
@@ -126,7 +206,8 @@ class Acner():
                     min_frequency=min_frequencies[i], tokenizer=tokenizer[i],
                     downcase=downcases[i], max_vocab_size=None,
                     name=names[i],
-                    line_processor=lambda line: line.split('\t')[i], lang='de')
+                    line_processor=lambda line: line.split('\t')[i], lang='de',
+                    cache_name=names[i])
 
             self.w2i[i], self.i2w[i] = datasets.load_vocabulary(self.vocab_paths[i])
             self.w2v[i] = datasets.preload_w2v(self.w2i[i], lang='de')
@@ -141,40 +222,31 @@ class Acner():
         # `str` should look like "Sentence: 1". I want to take the "1" there.
         return int(s.split(' ')[1])
 
-    def group_words_into_sentences(self, lines):
-        words = []
-        parts_of_speech = []
-        ner_tags = []
-        ret = []
-        curr_sentence = 0
-        for i, l in enumerate(lines):
-            if l[0] != '':
-                if i != 0:
-                    #ret.append("\t".join([" ".join(words),
-                    #           " ".join(parts_of_speech),
-                    #           " ".join(ner_tags),
-                    #           str(curr_sentence)])
-                    #       )
-                    ret.append([" ".join(words),
-                               " ".join(parts_of_speech),
-                               " ".join(ner_tags),
-                               str(curr_sentence)])
-
-                curr_sentence = self.get_sentence_index(l[0])
-                words = []
-                parts_of_speech = []
-                ner_tags = []
-
-            words.append(l[1])
-            parts_of_speech.append(l[2])
-            ner_tags.append(l[3])
-
-        # Add the last one
-        ret.append([" ".join(words),
-                    " ".join(parts_of_speech),
-                    " ".join(ner_tags),
-                    curr_sentence])
-        return ret
+    def iter_sentences(self, f):
+        """
+        Streams the lines of the opened acner.csv and yields one dictionary
+        per sentence, with its 'words', 'pos' and 'ner' tags and its 'index'.
+        """
+        csv_reader = csv.reader(f, delimiter=',')
+
+        # Skip one line
+        next(csv_reader)
+
+        sentence = None
+        for l in csv_reader:
+            if l[0] != '' or sentence is None:
+                if sentence is not None:
+                    yield sentence
+                index = self.get_sentence_index(l[0]) if l[0] != '' else 0
+                sentence = {'words': [], 'pos': [], 'ner': [], 'index': index}
+
+            sentence['words'].append(l[1])
+            sentence['pos'].append(l[2])
+            sentence['ner'].append(l[3])
+
+        # Yield the last one
+        if sentence is not None:
+            yield sentence
 
     def dump_all_data(self, train_data, validate_data, test_data):
         self.dump_data(train_data, self.train_path)
@@ -182,9 +254,14 @@ class Acner():
         self.dump_data(test_data, self.test_path)
 
     def dump_data(self, data, path):
+        # The text copy of a split, from which its vocabularies are built
+        corpus, rows = data
+        columns = [datasets.corpus_tokens(corpus, column, rows)
+                   for column in self.corpus_columns]
         with open(path, 'w') as f:
-            for i in data:
-                f.write("{}\t{}\t{}\t{}\n".format(i[0], i[1], i[2], i[3]))
+            for tokens, index in zip(zip(*columns), corpus['index'][rows]):
+                f.write("{}\t{}\t{}\t{}\n".format(
+                        *[' '.join(t) for t in tokens], index))
 
     def __refresh(self, load_w2v):
         # (Again)
@@ -213,23 +290,45 @@ class Acner():
                 min_frequency=min_frequency,
                 tokenizer=tokenizer, downcase=downcase,
                 max_vocab_size=max_vocab_size, name=name,
-                line_processor=lambda line: line.split('\t')[0])
+                line_processor=lambda line: line.split('\t')[0],
+                cache_name='texts')
         self.__refresh(load_w2v)
 
 
 
+def _warn_ignored_tokenizer(tokenizer):
+    if tokenizer is not None:
+        warnings.warn('The tokens are read from the corpus cache, so the '
+                      'tokenizer {!r} is ignored'.format(tokenizer),
+                      stacklevel=3)
+
+
 class DataSet():
     def __init__(self, data, w2i, i2w, shuffle=True):
+        """
+        `data` is a pair (corpus cache, rows): the corpus cache of the
+        sentences (see `datasets.load_corpus_cache`) and the rows of it that
+        belong to this dataset.
+        """
         self._epochs_completed = 0
-        self._index_in_epoch = 0
         self.datafile = None
         self.set_vocab(w2i, i2w)
-        self.data = data
+        self.corpus, self.data = data[0], np.asarray(data[1], dtype=np.int64)
         self.Batch = self.initialize_batch()
 
+        # The rows of each batch. They are shuffled with a new index
+        # permutation every epoch, so `self.data` is never reordered
+        self.row_order = datasets.RowOrder(
+                len(self.data), 'shuffle' if shuffle else 'sequential')
+        self.encode()
+
     def initialize_batch(self):
         return collections.namedtuple('Batch', ['sentences', 'pos', 'ner', 'lengths'])
 
+    def columns(self):
+        # The columns of the corpus cache, in the order of the vocabularies
+        return ['words', 'pos', 'ner']
+
     # I got the number of parts of speech with:
     # f = open('acner.csv', 'r', encoding='cp1252')
     # csv_reader = csv.reader(f, delimiter=',')
@@ -238,61 +337,77 @@ class DataSet():
     # i, w, p, ner = zip(*all_lines)
     # p = list(set(p))
     # len(p)
-    def next_batch(self, batch_size=64, pad=0, raw=False,
-                   tokenizer=['spacy', 'split', 'split'],
+    def next_batch(self, batch_size=64, pad=0, raw=False, tokenizer=None,
                    one_hot=False):
-        # format: either 'one_hot' or 'numerical'
-        # rescale: if format is 'numerical', then this should be a tuple
-        #           (min, max)
-        
-        samples = None
-        if self._index_in_epoch + batch_size > len(self.data):
-            samples = self.data[self._index_in_epoch: len(self.data)]
-            random.shuffle(self.data)
-            missing_samples = batch_size - (len(self.data) - self._index_in_epoch)
-            self._epochs_completed += 1
-            samples.extend(self.data[0 :missing_samples])
-            self._index_in_epoch = missing_samples
-        else:
-            samples = self.data[self._index_in_epoch :self._index_in_epoch + batch_size]
-            self._index_in_epoch += batch_size
-            
-
-        data = list(zip(*samples))
-        sentences = data[0]
-        pos = data[1]
-        ner = data[2]
-
-        
-        # Generate sequences
-        sentences = self.generate_sequences(sentences, tokenizer[0])
-        pos = self.generate_sequences(pos, tokenizer[1])
-        ner = self.generate_sequences(ner, tokenizer[2])
+        """
+        Returns the next batch of sentences. Unless the batch is `raw`, the
+        `sentences`, `pos` and `ner` of the batch are int32 arrays of IDs,
+        padded to `pad` or, with a `pad` of 0, to the longest sentence of
+        the batch (they used to be lists of unpadded sequences when `pad`
+        was 0; `lengths` has the length of each one). With `one_hot`, `ner`
+        is one-hot encoded.
+
+        The tokens are the ones of the corpus cache, so `tokenizer` is
+        ignored. It is only accepted so that older calls keep working.
+        """
+        _warn_ignored_tokenizer(tokenizer)
+        rows, epochs = self.row_order.next_rows(batch_size)
+        self._epochs_completed += epochs
+        rows = self.data[rows]
+        if not raw:
+            return self.encoded_batch(rows, pad, one_hot)
+
+        # Only the tokens of the batch are decoded
+        sentences, pos, ner = [list(datasets.corpus_tokens(self.corpus,
+                                                           column, rows))
+                               for column in self.columns()]
 
         lengths = [len(s) if pad == 0 else min(pad, len(s)) for s in sentences]
 
-        if (raw) :
-            return self.Batch(sentences=sentences, pos=pos, ner=ner, lengths=lengths)
-
-        sentences = datasets.padseq(datasets.seq2id(sentences,
-                                                    self.vocab_w2i[0]), pad)
-        pos = datasets.padseq(datasets.seq2id(pos, self.vocab_w2i[1]), pad)
-        ner = datasets.padseq(datasets.seq2id(ner, self.vocab_w2i[2]), pad)
+        return self.Batch(sentences=sentences, pos=pos, ner=ner, lengths=lengths)
+
+    def iter_epoch(self, batch_size=64, rank=0, world_size=1, **kwargs):
+        """
+        Yields the batches of a single pass over the dataset, in which every
+        sentence is read exactly once, in order. The last batch is shorter when
+        the number of sentences is not a multiple of `batch_size`. With
+        `world_size` workers, only the sentences of the `rank`-th shard are
+        read. `kwargs` are passed to `next_batch`.
+
+        The pass reads its own copy of the dataset, so it doesn't change the
+        position or `epochs_completed` of the dataset.
+        """
+        dataset = copy.copy(self)
+        dataset.row_order = datasets.RowOrder(len(self.data),
+                                              shard=(rank, world_size))
+        return datasets.epoch_batches(dataset, dataset.row_order.n_rows,
+                                      batch_size, **kwargs)
+
+    def encode(self):
+        """
+        Maps the tokens of the three columns of the corpus cache to the IDs
+        of the vocabularies (see `datasets.corpus_ids`), as flat int32 arrays
+        that `next_batch` slices the rows of each batch from, with the
+        offsets of the cache. Done when the dataset is created, and again
+        only when the vocabularies change.
+        """
+        self.encoded = [(datasets.corpus_ids(self.corpus, column,
+                                             self.vocab_w2i[i]),
+                         self.corpus[column + '_offsets'])
+                        for i, column in enumerate(self.columns())]
+
+    def encoded_batch(self, rows, pad, one_hot):
+        if self.encoded is None:
+            self.encode()
+        (sentences, lengths), (pos, _), (ner, _) = [
+                datasets.pad_ragged(ids, offsets, rows, pad)
+                for ids, offsets in self.encoded]
 
         if one_hot:
-            ner = [to_categorical(n, nb_classes=len(self.vocab_w2i[2]))
-                   for n in ner]
-
-        batch = self.Batch(sentences=sentences, pos=pos, ner=ner, lengths=lengths)
-        
-        return batch
+            ner = datasets.id2onehot(ner, len(self.vocab_w2i[2]))
 
-    def generate_sequences(self, x, tokenizer):
-        new_x = []
-        for instance in x:
-            tokens = datasets.tokenize(instance, tokenizer)
-            new_x.append(tokens)
-        return new_x
+        return self.Batch(sentences=sentences, pos=pos, ner=ner,
+                          lengths=lengths)
 
     @property
     def epochs_completed(self):
@@ -306,12 +421,19 @@ class DataSet():
         else:
             self.vocab_w2i = w2i
             self.vocab_i2w = i2w
+        # Encoded again with the new vocabularies by the next batch
+        self.encoded = None
 
 if __name__ == '__main__':
     import timeit
-    t = timeit.timeit(Acner, number=100)
-    print(t)
-    a = Acner()
+    a = Acner(seed=1)
+    print(a.load_times)
+    # The split is random, so only the constructions with the same seed load
+    # the one built (or loaded) above
+    t = timeit.timeit(lambda: Acner(seed=1), number=100)
+    print('Average warm load time: {:.2f}s'.format(t / 100))
+    t = timeit.timeit(Acner, number=1)
+    print('Cold build time (no seed): {:.2f}s'.format(t))
     b = a.train.next_batch()
     print(b)
 
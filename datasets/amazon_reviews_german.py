@@ -3,10 +3,12 @@ import json
 import datasets
 import collections
 
-from tflearn.data_utils import to_categorical
+from datasets.reviews import ReviewDataSet
 
 
 class AmazonReviewsGerman(object):
+    w2v = datasets.LazyW2V()
+
     def __init__(self, train_validation_split=None, test_split=None,
                  use_defaults=True):
         if train_validation_split is not None or test_split is not None or \
@@ -33,7 +35,8 @@ class AmazonReviewsGerman(object):
         self.w2v_path = os.path.join(self.dataset_path, 'w2v.npy')
 
         self.w2i, self.i2w = datasets.load_vocabulary(self.vocab_path)
-        self.w2v = datasets.load_w2v(self.w2v_path)
+        # Memory-mapped the first time it is used (see `datasets.LazyW2V`)
+        self.w2v = None
 
         self.vocab_size = len(self.w2i)
         self.train = DataSet(self.train_path, (self.w2i, self.i2w))
@@ -54,7 +57,8 @@ class AmazonReviewsGerman(object):
                                     min_frequency, tokenizer=tokenizer,
                                     downcase=downcase,
                                     max_vocab_size=max_vocab_size, name=name,
-                                    line_processor=line_processor, lang='de')
+                                    line_processor=line_processor, lang='de',
+                                    cache_name='title_text')
         self.__refresh(load_w2v)
 
     def __refresh(self, load_w2v):
@@ -68,92 +72,15 @@ class AmazonReviewsGerman(object):
         self.test.set_vocab((self.w2i, self.i2w))
 
 
-class DataSet(object):
+class DataSet(ReviewDataSet):
     def __init__(self, path, vocab):
+        super(DataSet, self).__init__(path, vocab, lang='de',
+                                      text_key='review_text',
+                                      title_key='review_header')
 
-        self.path = path
-        self._epochs_completed = 0
-        self.vocab_w2i = vocab[0]
-        self.vocab_i2w = vocab[1]
-        self.datafile = None
-
-        self.Batch = collections.namedtuple('Batch', ['text', 'sentences',
-                                                     'ratings', 'titles'])
-
-    def open(self):
-        self.datafile = open(self.path, 'r')
-
-    def close(self):
-        self.datafile.close()
-
-    def next_batch(self, batch_size=64, seq_begin=False, seq_end=False,
-                   rescale=None, pad=0, raw=False, mark_entities=False,
-                   tokenizer='spacy', sentence_pad=0, one_hot=False):
-        if not self.datafile:
-            raise Exception('The dataset needs to be open before being used. '
-                            'Please call dataset.open() before calling '
-                            'dataset.next_batch()')
-        text, sentences, ratings, titles = [], [], [], []
-
-        while len(text) < batch_size:
-            row = self.datafile.readline()
-            if row == '':
-                self._epochs_completed += 1
-                self.datafile.seek(0)
-                continue
-            json_obj = json.loads(row.strip())
-            text.append(datasets.tokenize(json_obj["review_text"], tokenizer))
-            sentences.append(datasets.sentence_tokenizer(json_obj["review_text"]))
-            ratings.append(int(json_obj["review_rating"]))
-            titles.append(datasets.tokenize(json_obj["review_header"]))
-        
-        if rescale is not None and one_hot == False:
-            ratings = datasets.rescale(ratings, rescale, [1.0, 5.0])
-        elif rescale is None and one_hot == True:
-            ratings = [x - 1 for x in ratings]
-            ratings = to_categorical(ratings, nb_classes=5)
-        elif rescale is None and one_hot == False:
-            pass
-        else:
-            raise ValueError('rescale and one_hot cannot be set together')
-        if mark_entities:
-            text = datasets.mark_entities(text, lang='de')
-            titles = datasets.mark_entities(titles, lang='de')
-            sentences = [datasets.mark_entities(sentence, lang='de')
-                         for sentence in sentences]
-
-        if not raw:
-            text = datasets.seq2id(text[:batch_size], self.vocab_w2i, seq_begin,
-                                  seq_end)
-            titles = datasets.seq2id(titles[:batch_size], self.vocab_w2i,
-                                     seq_begin, seq_end)
-            sentences = [datasets.seq2id(sentence, self.vocab_w2i,
-                     seq_begin, seq_end) for sentence in sentences[:batch_size]]
-        else:
-            text = datasets.append_seq_markers(text[:batch_size],
-                                               seq_begin, seq_end)
-            titles = datasets.append_seq_markers(titles[:batch_size],
-                                                 seq_begin, seq_end)
-            sentences = [datasets.append_seq_markers(sentence, seq_begin,
-                         seq_end) for sentence in sentences[:batch_size]]
-
-        if pad != 0:
-            text = datasets.padseq(text[:batch_size], pad, raw)
-            titles = datasets.padseq(titles[:batch_size], pad, raw)
-            sentences = [datasets.padseq(sentence, pad, raw) for sentence in
-                         sentences[:batch_size]]
-        if sentence_pad != 0:
-            sentences = [datasets.pad_sentences(sentence, sentence_pad, raw) for
-                         sentence in sentences[:batch_size]]
-
-        batch = self.Batch(text=text, sentences=sentences,
-                           ratings=ratings, titles=titles)
-        return batch
-
-    def set_vocab(self, vocab):
-        self.vocab_w2i = vocab[0]
-        self.vocab_i2w = vocab[1]
+    def initialize_batch(self):
+        return collections.namedtuple('Batch', ['text', 'sentences',
+                                                'ratings', 'titles'])
 
-    @property
-    def epochs_completed(self):
-        return self._epochs_completed
+    def row_columns(self, json_obj):
+        return {'ratings': int(json_obj['review_rating'])}
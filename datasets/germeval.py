@@ -1,40 +1,75 @@
 import os
 import csv
-import random
+import copy
+import time
 import collections
+
+import numpy as np
+
 import datasets
 
-from datasets.acner import Acner
-from tflearn.data_utils import to_categorical
+from datasets.acner import Acner, _warn_ignored_tokenizer
 
 class Germeval(Acner):
     def __init__(self, train_validate_split=None, test_split=None,
              use_defaults=False, shuffle=True):
         # It makes less sense to try to change the sizes of the stuff in this
         # dataset: it already comes with a Train/Dev/Test cutting
-        super(Germeval, self).__init__(None, None, None, None)
-
-    def load(self, train_validate_split=None, test_split=None,
-             use_defaults=None, shuffle=None):
-        # Ignore all the parameters passed to `load`. This method signature is
-        # here only to agree with the Base Class' signature.
-        # It makes less sense to try to change the sizes of the stuff in this
-        # dataset: it already comes with a Train/Dev/Test cutting
+        super(Germeval, self).__init__(train_validate_split, test_split,
+                                       use_defaults, shuffle)
+
+    def load(self, use_defaults, train_validate_split, test_split, shuffle,
+             seed=None):
+        """
+        Same as `Acner.load`, but the splits are the files of the dataset, so
+        they are always loaded by a warm start when they didn't change.
+        `train_validate_split` and `test_split` don't change them; like
+        `shuffle`, they are kept in the manifest, so that a manifest built
+        with other parameters is never loaded.
+        """
+        if use_defaults or train_validate_split is None or test_split is None:
+            train_validate_split = datasets.train_validate_split
+            test_split = datasets.test_split_small
+        params = dict(train_validate_split=train_validate_split,
+                      test_split=test_split, shuffle=shuffle)
+        start = time.time()
+        manifest = datasets.matching_manifest(self.manifest_path,
+                                              self.source_paths(), **params)
+        # Manifests of older versions don't list all the current outputs
+        if manifest is not None and \
+                sorted(manifest['outputs']) == sorted(self.output_paths()):
+            self.initialize_defaults(manifest, shuffle)
+            self.report_load_times(manifest, time.time() - start)
+            return
 
         all_data = self.load_all_data(self.dataset_path)
 
         self.dump_all_data(*all_data)
         self.initialize_vocabulary()
-        self.initialize_datasets(*all_data)
+        self.initialize_datasets(*all_data, shuffle=shuffle)
+        self.save_manifest(time.time() - start, **params)
+
+    def source_paths(self):
+        return [os.path.join(self.dataset_path, fn) for fn in
+                ['NER-de-train.tsv', 'NER-de-dev.tsv', 'NER-de-test.tsv']]
+
+    def output_paths(self):
+        # The splits are the files themselves, so there are no rows to save
+        outputs = super(Germeval, self).output_paths()
+        del outputs['splits']
+        return outputs
+
+    def load_splits(self, outputs):
+        return self.load_all_data(self.dataset_path)
 
     def initialize_datasets(self, train_data, validate_data, test_data, shuffle=True):
-        self.train = DataSet(train_data, self.w2i, self.i2w)
-        self.validation = DataSet(validate_data, self.w2i, self.i2w)
-        self.test = DataSet(test_data, self.w2i, self.i2w)
+        self.train = DataSet(train_data, self.w2i, self.i2w, shuffle)
+        self.validation = DataSet(validate_data, self.w2i, self.i2w, shuffle)
+        self.test = DataSet(test_data, self.w2i, self.i2w, shuffle)
 
     def initialize_vocabulary(self):
         self.initialize_vocabulary_ll(['texts', 'ner1', 'ner2'], [5,1,1],
-                                      [False, False, False], ['spacy', 'split', 'split'])
+                                      [False, False, False], ['split', 'split', 'split'])
 
     def construct(self):
         self.dataset_name = 'GermEval 2014: Named Entity Recognition Shared Task'
@@ -47,6 +82,7 @@ class Germeval(Acner):
         self.train_path = os.path.join(self.dataset_path, 'train.txt')
         self.validate_path = os.path.join(self.dataset_path, 'validate.txt')
         self.test_path = os.path.join(self.dataset_path, 'test.txt')
+        self.manifest_path = os.path.join(self.dataset_path, 'manifest.json')
 
         self.vocab_paths = [os.path.join(self.dataset_path, 'vocab.txt'),
                             os.path.join(self.dataset_path, 'ner1_vocab.txt'),
@@ -64,117 +100,148 @@ class Germeval(Acner):
         self.i2w = [None, None, None]
         self.w2v = [None, None, None]
 
+        # The columns of the corpus cache, in the order of `self.w2i`
+        self.corpus_columns = ['words', 'ner1', 'ner2']
+
     def load_all_data(self, path):
+        """
+        Returns the train, validation and test splits as pairs (corpus cache,
+        rows), one corpus cache per file (see `datasets.load_corpus_cache`)
+        with all its rows.
+        """
         file_names = ['NER-de-train.tsv', 'NER-de-dev.tsv', 'NER-de-test.tsv']
         ret = []
         for fn in file_names:
             path_plus_file_name = os.path.join(path, fn)
-            with open(path_plus_file_name, 'r', encoding='utf-8') as f:
-                csv_reader = csv.reader(f, delimiter='\t', quotechar=None)
+            cache = datasets.load_corpus_cache(datasets.build_corpus_cache(
+                    path_plus_file_name, self.iter_sentences,
+                    name='sentences', encoding='utf-8'))
+            ret.append((cache, np.arange(len(cache['index']))))
+        return ret
 
-                # Skip one line
-                next(csv_reader)
+    def iter_sentences(self, f):
+        """
+        Streams the lines of an opened GermEval file and yields one
+        dictionary per sentence, with its 'words', 'ner1' and 'ner2' tags and
+        its 'index'.
+        """
+        csv_reader = csv.reader(f, delimiter='\t', quotechar=None)
 
-                all_lines = [i for i in csv_reader]
-            ret.append(self.group_words_into_sentences(all_lines))
-        return ret
+        # Skip one line
+        next(csv_reader)
 
-    def group_words_into_sentences(self, lines):
-        words = []
-        ner_tags1 = []
-        ner_tags2 = []
-        ret = []
-        curr_sentence = 0
-        for i, l in enumerate(lines):
+        sentence = {'words': [], 'ner1': [], 'ner2': [], 'index': 0}
+        for l in csv_reader:
             if len(l) == 0:
-                ret.append([" ".join(words),
-                           " ".join(ner_tags1),
-                           " ".join(ner_tags2),
-                           str(curr_sentence)])
-                words = []
-                ner_tags1 = []
-                ner_tags2 = []
-                curr_sentence += 1
+                yield sentence
+                sentence = {'words': [], 'ner1': [], 'ner2': [],
+                            'index': sentence['index'] + 1}
                 continue
 
             if l[0] == '#':
                 continue
 
-            words.append(l[1])
-            ner_tags1.append(l[2])
-            ner_tags2.append(l[3])
+            sentence['words'].append(l[1])
+            sentence['ner1'].append(l[2])
+            sentence['ner2'].append(l[3])
 
-        # Add the last one
-        ret.append([" ".join(words),
-                    " ".join(ner_tags1),
-                    " ".join(ner_tags2),
-                    curr_sentence])
-        return ret
+        # Yield the last one
+        yield sentence
 
 
 class DataSet():
-    def __init__(self, data, w2i, i2w):
+    def __init__(self, data, w2i, i2w, shuffle=True):
+        """
+        `data` is a pair (corpus cache, rows): the corpus cache of the
+        sentences (see `datasets.load_corpus_cache`) and the rows of it that
+        belong to this dataset.
+        """
         self._epochs_completed = 0
-        self._index_in_epoch = 0
         self.datafile = None
         self.set_vocab(w2i, i2w)
-        self.data = data
+        self.corpus, self.data = data[0], np.asarray(data[1], dtype=np.int64)
         self.Batch = self.initialize_batch()
 
+        # The rows of each batch. They are shuffled with a new index
+        # permutation every epoch, so `self.data` is never reordered
+        self.row_order = datasets.RowOrder(
+                len(self.data), 'shuffle' if shuffle else 'sequential')
+        self.encode()
+
     def initialize_batch(self):
         return collections.namedtuple('Batch', ['sentences', 'ner1', 'ner2', 'lengths'])
 
-    def next_batch(self, batch_size=64, pad=0, raw=False,
-                   tokenizer=['spacy', 'split', 'split'], one_hot=False):
-        samples = None
-        if self._index_in_epoch + batch_size > len(self.data) :
-            samples = self.data[self._index_in_epoch : len(self.data)]
-            random.shuffle(self.data)
-            missing_samples = batch_size - (len(self.data) - self._index_in_epoch)
-            self._epochs_completed += 1
-            samples.extend(self.data[0 :missing_samples])
-            self._index_in_epoch = missing_samples
-        else :
-            samples = self.data[self._index_in_epoch :self._index_in_epoch + batch_size]
-            self._index_in_epoch += batch_size
-
-        data = list(zip(*samples))
-        sentences = data[0]
-        ner1 = data[1]
-        ner2 = data[2]
-
-        # Generate sequences
-        sentences = self.generate_sequences(sentences, tokenizer=tokenizer[0])
-        ner1 = self.generate_sequences(ner1, tokenizer=tokenizer[1])
-        ner2 = self.generate_sequences(ner2, tokenizer=tokenizer[2])
+    def columns(self):
+        # The columns of the corpus cache, in the order of the vocabularies
+        return ['words', 'ner1', 'ner2']
+
+    def next_batch(self, batch_size=64, pad=0, raw=False, tokenizer=None,
+                   one_hot=False):
+        """
+        Same as `datasets.acner.DataSet.next_batch`, with `ner1` and `ner2`
+        instead of `pos` and `ner`. With `one_hot`, both are one-hot
+        encoded.
+        """
+        _warn_ignored_tokenizer(tokenizer)
+        rows, epochs = self.row_order.next_rows(batch_size)
+        self._epochs_completed += epochs
+        rows = self.data[rows]
+        if not raw:
+            return self.encoded_batch(rows, pad, one_hot)
+
+        # Only the tokens of the batch are decoded
+        sentences, ner1, ner2 = [list(datasets.corpus_tokens(self.corpus,
+                                                             column, rows))
+                                 for column in self.columns()]
 
         lengths = [len(s) if pad == 0 else min(pad, len(s)) for s in sentences]
 
-        if (raw):
-            return self.Batch(sentences=sentences, ner1=ner1, ner2=ner2,
-                              lengths=lengths)
-        sentences = datasets.padseq(datasets.seq2id(sentences,
-                                                    self.vocab_w2i[0]), pad)
-        ner1 = datasets.padseq(datasets.seq2id(ner1, self.vocab_w2i[1]), pad)
-        ner2 = datasets.padseq(datasets.seq2id(ner2, self.vocab_w2i[2]), pad)
-        
-        if one_hot:
-            ner1 = [to_categorical(n, nb_classes=len(self.vocab_w2i[1]))
-                   for n in ner1]
-            ner2 = [to_categorical(n, nb_classes=len(self.vocab_w2i[2]))
-                   for n in ner2]
-
-        batch = self.Batch(sentences=sentences, ner1=ner1, ner2=ner2,
-                           lengths=lengths)
+        return self.Batch(sentences=sentences, ner1=ner1, ner2=ner2,
+                          lengths=lengths)
+
+    def iter_epoch(self, batch_size=64, rank=0, world_size=1, **kwargs):
+        """
+        Yields the batches of a single pass over the dataset, in which every
+        sentence is read exactly once, in order. The last batch is shorter when
+        the number of sentences is not a multiple of `batch_size`. With
+        `world_size` workers, only the sentences of the `rank`-th shard are
+        read. `kwargs` are passed to `next_batch`.
+
+        The pass reads its own copy of the dataset, so it doesn't change the
+        position or `epochs_completed` of the dataset.
+        """
+        dataset = copy.copy(self)
+        dataset.row_order = datasets.RowOrder(len(self.data),
+                                              shard=(rank, world_size))
+        return datasets.epoch_batches(dataset, dataset.row_order.n_rows,
+                                      batch_size, **kwargs)
+
+    def encode(self):
+        """
+        Maps the tokens of the three columns of the corpus cache to the IDs
+        of the vocabularies (see `datasets.corpus_ids`), as flat int32 arrays
+        that `next_batch` slices the rows of each batch from, with the
+        offsets of the cache. Done when the dataset is created, and again
+        only when the vocabularies change.
+        """
+        self.encoded = [(datasets.corpus_ids(self.corpus, column,
+                                             self.vocab_w2i[i]),
+                         self.corpus[column + '_offsets'])
+                        for i, column in enumerate(self.columns())]
+
+    def encoded_batch(self, rows, pad, one_hot):
+        if self.encoded is None:
+            self.encode()
+        (sentences, lengths), (ner1, _), (ner2, _) = [
+                datasets.pad_ragged(ids, offsets, rows, pad)
+                for ids, offsets in self.encoded]
 
-        return batch
+        if one_hot:
+            ner1 = datasets.id2onehot(ner1, len(self.vocab_w2i[1]))
+            ner2 = datasets.id2onehot(ner2, len(self.vocab_w2i[2]))
 
-    def generate_sequences(self, x, tokenizer):
-        new_x = []
-        for instance in x:
-            tokens = datasets.tokenize(instance, tokenizer)
-            new_x.append(tokens)
-        return new_x
+        return self.Batch(sentences=sentences, ner1=ner1, ner2=ner2,
+                          lengths=lengths)
 
     @property
     def epochs_completed(self):
@@ -187,6 +254,8 @@ class DataSet():
         else:
             self.vocab_w2i = w2i
             self.vocab_i2w = i2w
+        # Encoded again with the new vocabularies by the next batch
+        self.encoded = None
 
 
 if __name__ == '__main__':
@@ -1,13 +1,14 @@
 import os
 import csv
+import copy
 import random
 import glob
 import collections
 import datasets
 
-from tflearn.data_utils import to_categorical
-
 class Gersen(object):
+    w2v = datasets.LazyW2V()
+
     def __init__(self, train_validate_split=None, test_split=None, use_defaults=False,
                     shuffle=True):
         self.construct()
@@ -55,11 +56,15 @@ class Gersen(object):
         test_data = self.load_data(self.test_path)
 
         self.w2i, self.i2w = datasets.load_vocabulary(self.vocab_path)
-        self.w2v = datasets.load_w2v(self.w2v_path)
+        # Memory-mapped the first time it is used (see `datasets.LazyW2V`)
+        self.w2v = None
 
-        self.train = DataSet(train_data, (self.w2i, self.i2w), shuffle)
-        self.validation = DataSet(validate_data, (self.w2i, self.i2w), shuffle)
-        self.test = DataSet(test_data, (self.w2i, self.i2w), shuffle)
+        self.train = DataSet(train_data, (self.w2i, self.i2w), shuffle,
+                             self.train_path)
+        self.validation = DataSet(validate_data, (self.w2i, self.i2w), shuffle,
+                                  self.validate_path)
+        self.test = DataSet(test_data, (self.w2i, self.i2w), shuffle,
+                            self.test_path)
 
     def load_anew(self, train_validate_split, test_split, shuffle=True):
         all_data = self.load_all_data(self.dataset_path)
@@ -91,16 +96,20 @@ class Gersen(object):
                 files=[self.train_path], dataset_path=self.dataset_path,
                 min_frequency=5, tokenizer='spacy',
                 downcase=True, max_vocab_size=None,
-                name='new', line_processor=line_processor)
+                name='new', line_processor=line_processor,
+                cache_name='text')
 
         self.w2i, self.i2w = datasets.load_vocabulary(self.vocab_path)
         self.w2v = datasets.preload_w2v(self.w2i)
         datasets.save_w2v(self.w2v_path, self.w2v)
 
     def initialize_datasets(self, train_data, validate_data, test_data, shuffle):
-        self.train = DataSet(train_data, (self.w2i, self.i2w), shuffle)
-        self.validation = DataSet(validate_data, (self.w2i, self.i2w), shuffle)
-        self.test = DataSet(test_data, (self.w2i, self.i2w), shuffle)
+        self.train = DataSet(train_data, (self.w2i, self.i2w), shuffle,
+                             self.train_path)
+        self.validation = DataSet(validate_data, (self.w2i, self.i2w), shuffle,
+                                  self.validate_path)
+        self.test = DataSet(test_data, (self.w2i, self.i2w), shuffle,
+                            self.test_path)
 
     def load_data(self, path):
         with open(path, 'r') as f:
@@ -118,26 +127,33 @@ class Gersen(object):
         self.dump_data(test_data, self.test_path)
 
     def load_all_data(self, path):
-        all_positive = glob.glob(os.path.join(path, 'positive/*.txt'))
-        all_negative = glob.glob(os.path.join(path, 'negative/*.txt'))
-        all_neutral  = glob.glob(os.path.join(path, 'neutral/*.txt'))
-
+        """
+        Returns the (sentence, label) pairs of the files in `positive/`,
+        `negative/` and `neutral/`. They are read with one sequential pass
+        over `gersen.pack` (see `datasets.load_pack`). If the pack is missing
+        or stale, the files are read by a pool of threads (see
+        `datasets.read_first_lines`) and packed again.
+        """
+        directories = [os.path.join(path, d)
+                       for d in ['positive', 'negative', 'neutral']]
         # I.e., the class labels are:
         # Positive: 0
         # Negative: 1
         # Neutral : 2
-        all_files = [all_positive, all_negative, all_neutral]
-
-        all_data = []
-        for i in range(len(all_files)):
-            for j in all_files[i]:
-                with open(j, 'r', encoding='utf8') as f:
-                    all_data.append((f.readline(), i))
-
-        self.all_files = [i for j in all_files for i in j]
+        all_files = [glob.glob(os.path.join(d, '*.txt')) for d in directories]
 
         # This list comprehension "flattens" all_files
-        return all_data #, [i for j in all_files for i in j]
+        paths = [i for j in all_files for i in j]
+        pack_path = os.path.join(path, 'gersen.pack')
+        records = datasets.load_pack(pack_path, directories, paths)
+        if records is None:
+            labels = [i for i in range(len(all_files)) for _ in all_files[i]]
+            records = list(zip(paths, labels,
+                               datasets.read_first_lines(paths)))
+            datasets.save_pack(pack_path, records, directories)
+
+        self.all_files = [record[0] for record in records]
+        return [(text, label) for _, label, text in records]
 
     def __refresh(self, load_w2v):
         self.w2i, self.i2w = datasets.load_vocabulary(self.vocab_path)
@@ -161,14 +177,18 @@ class Gersen(object):
 
 
 class DataSet(object):
-    def __init__(self, data, vocab, shuffle=True):
+    def __init__(self, data, vocab, shuffle=True, path=None):
         self._epochs_completed = 0
         self._index_in_epoch = 0
         self.datafile = None
+        self.path = path
         self.set_vocab(vocab)
         self.data = data
         self.Batch = self.initialize_batch()
 
+        # One dictionary {text: tokens} per tokenizer (see `generate_sequences`)
+        self.token_cache = {}
+
     def initialize_batch(self):
         return collections.namedtuple('Batch', ['x', 'y', 'lengths'])
 
@@ -198,7 +218,7 @@ class DataSet(object):
             return self.Batch(x=x, y=y, lengths=lens)
 
         if (format == 'one_hot'):
-            y = to_categorical(y, nb_classes=3)
+            y = datasets.id2onehot(y, 3)
 
         if (rescale is not None):
             datasets.validate_rescale(rescale)
@@ -210,12 +230,34 @@ class DataSet(object):
 
         return batch
 
+    def iter_epoch(self, batch_size=64, rank=0, world_size=1, **kwargs):
+        """
+        Yields the batches of a single pass over the dataset, in which every
+        sentence is read exactly once, in order. The last batch is shorter when
+        the number of sentences is not a multiple of `batch_size`. With
+        `world_size` workers, only the sentences of the `rank`-th shard are
+        read. `kwargs` are passed to `next_batch`.
+
+        The pass reads its own copy of the dataset, so it doesn't change the
+        position or `epochs_completed` of the dataset.
+        """
+        dataset = copy.copy(self)
+        first, last = datasets.shard_bounds(len(self.data), (rank, world_size))
+        dataset.data = self.data[first:last]
+        dataset._index_in_epoch = 0
+        return datasets.epoch_batches(dataset, len(dataset.data), batch_size,
+                                      **kwargs)
+
     def generate_sequences(self, x, tokenizer):
-        new_x = []
-        for instance in x:
-            tokens = datasets.tokenize(instance, tokenizer)
-            new_x.append(tokens)
-        return new_x
+        if tokenizer not in self.token_cache:
+            if self.path is not None and os.path.exists(self.path):
+                self.token_cache[tokenizer] = datasets.load_token_dict(
+                        self.path, lambda line: line.split('\t')[0],
+                        tokenizer, name='text')
+            else:
+                self.token_cache[tokenizer] = {}
+        return datasets.tokenize_with_cache(x, self.token_cache[tokenizer],
+                                            tokenizer)
 
     @property
     def epochs_completed(self):
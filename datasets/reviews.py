@@ -0,0 +1,360 @@
+import copy
+import json
+import datasets
+import collections
+
+import numpy as np
+
+
+class ReviewDataSet(object):
+    """
+    A split of a dataset of reviews, stored as one JSON object per line with
+    the text of the review under `text_key` and its title under
+    `title_key`. The batches have the tokens of the `text`, of its
+    `sentences` and of the `titles`, plus the fields of `row_columns` (the
+    ratings of the review, for instance). The subclasses only say which
+    fields these are (see `initialize_batch` and `row_columns`).
+
+    Keyword arguments:
+    lang      -- the language of the reviews, passed to spaCy.
+    text_key  -- the key of the text in the JSON objects.
+    title_key -- the key of the title in the JSON objects.
+    """
+    def __init__(self, path, vocab, lang='en', text_key='text',
+                 title_key='title'):
+        self.path = path
+        self.lang = lang
+        self.text_key = text_key
+        self.title_key = title_key
+        self._epochs_completed = 0
+        self.vocab_w2i = vocab[0]
+        self.vocab_i2w = vocab[1]
+        self.datafile = None
+        self.encoded = False
+        self.encoded_caches = {}
+        self.row_order = None
+        self.reader_options = ('sequential', 10000, None, None)
+        self.tokensfile_tokenizer = None
+        self._line_index = 0
+
+        self.Batch = self.initialize_batch()
+
+    def initialize_batch(self):
+        raise NotImplementedError
+
+    def row_columns(self, json_obj):
+        """
+        Returns a dictionary with the values of the batch fields other than
+        the text, the sentences and the titles for the review `json_obj`.
+        The fields whose name starts with 'ratings' are scaled with
+        `scale_ratings`.
+        """
+        raise NotImplementedError
+
+    def open(self, encoded=False, order='sequential', buffer_size=10000,
+             seed=None, shard=None):
+        """
+        Opens the dataset. If `encoded` is True, the batches that are not
+        `raw` and don't mark the entities are sliced from the columnar copy
+        of the dataset (see `encoded_cache`) instead of being parsed from
+        the JSON rows. The first batch of an encoded dataset tokenizes the
+        whole data file and builds its token cache and its columnar copy
+        next to it, unless they were already built.
+
+        `order`, `buffer_size` and `seed` choose the order in which the
+        reviews are read, and `shard` restricts them to one shard of the
+        data file (see `datasets.LineReader`).
+        """
+        self.datafile = datasets.LineReader([self.path], order, buffer_size,
+                                            seed, shard=shard)
+        self.encoded = encoded
+        self.row_order = None
+        self.reader_options = (order, buffer_size, seed, shard)
+        self.tokensfile_tokenizer = None
+        self._line_index = 0
+
+    def close(self):
+        self.datafile.close()
+
+    def iter_epoch(self, batch_size=64, rank=0, world_size=1, **kwargs):
+        """
+        Yields the batches of a single pass over the dataset, in which every
+        review is read exactly once, in order. The last batch is shorter when
+        the number of reviews is not a multiple of `batch_size`. With
+        `world_size` workers, only the reviews of the `rank`-th shard are
+        read. `kwargs` are passed to `next_batch`.
+
+        The pass reads its own copy of the dataset, so it doesn't change the
+        position or `epochs_completed` of the dataset.
+        """
+        dataset = copy.copy(self)
+        dataset.open(encoded=self.encoded, shard=(rank, world_size))
+        try:
+            n_rows = dataset.datafile.n_lines()
+            for batch in datasets.epoch_batches(dataset, n_rows, batch_size,
+                                                **kwargs):
+                yield batch
+        finally:
+            dataset.close()
+
+    def tokenize_rows(self, rows, tokenizer='spacy'):
+        """
+        Yields the tokens of the text, the tokens of each sentence of the
+        text and the tokens of the title of each row in `rows`. Used to build
+        the token cache of the dataset. The tokens and the sentences of the
+        text come from a single spaCy pass (see `datasets.process_documents`).
+        """
+        for chunk in datasets.chunks(rows, 1000):
+            json_objs = [json.loads(row) for row in chunk]
+            texts = [j[self.text_key] for j in json_objs]
+            documents = list(datasets.process_documents(texts,
+                                                        lang=self.lang))
+            if tokenizer == 'spacy':
+                text = [tokens for tokens, _, _ in documents]
+            else:
+                text = datasets.tokenize_batch(texts, tokenizer,
+                                               lang=self.lang)
+            titles = datasets.tokenize_batch([j[self.title_key]
+                                              for j in json_objs],
+                                             lang=self.lang)
+            for tokens, document, title in zip(text, documents, titles):
+                yield tokens, document[1], title
+
+    def token_cache(self, tokenizer):
+        """
+        Builds (if needed) the token cache of the dataset for `tokenizer` and
+        returns its path (see `datasets.build_token_cache`).
+        """
+        return datasets.build_token_cache(self.path,
+                lambda rows: self.tokenize_rows(rows, tokenizer),
+                tokenizer, lang=self.lang, name='documents')
+
+    def line_reader(self, tokenizer):
+        """
+        Returns a `datasets.LineReader` that reads the data file together
+        with its token cache for `tokenizer`. When the tokenizer changes, a
+        sequential reader goes on from the current line.
+        """
+        if self.tokensfile_tokenizer != tokenizer:
+            cache_path = self.token_cache(tokenizer)
+            order, buffer_size, seed, shard = self.reader_options
+            self.datafile.close()
+            self.datafile = datasets.LineReader([self.path, cache_path],
+                                                order, buffer_size, seed,
+                                                skip=self._line_index,
+                                                shard=shard)
+            self.tokensfile_tokenizer = tokenizer
+        return self.datafile
+
+    def encode_rows(self, rows, tokens_path):
+        """
+        Yields the columns of each row in `rows` for the columnar copy of the
+        dataset: the tokens of the text, of its sentences (one after the
+        other, with the length of each sentence in `sentence_lengths`) and
+        of the title, and the fields of `row_columns`. The tokens are read
+        from the token cache in `tokens_path`.
+        """
+        with open(tokens_path, 'r') as tokens_file:
+            for row, tokens in zip(rows, tokens_file):
+                text_tokens, sentence_tokens, title_tokens = json.loads(tokens)
+                columns = {
+                    'text': text_tokens,
+                    'sentences': [token for sentence in sentence_tokens
+                                  for token in sentence],
+                    'sentence_lengths': np.array(
+                            [len(sentence) for sentence in sentence_tokens],
+                            dtype=np.int32),
+                    'titles': title_tokens}
+                columns.update(self.row_columns(json.loads(row)))
+                yield columns
+
+    def encoded_cache(self, tokenizer='spacy'):
+        """
+        Returns the columnar copy of the dataset for the current vocabulary
+        and `tokenizer`: the IDs of the text, the sentences and the titles as
+        int32 arrays with their offsets, and the fields of `row_columns` as
+        float32 arrays (see `datasets.build_encoded_cache`). It is built the
+        first time it is needed and memory-mapped afterwards, so a batch only
+        reads the columns it uses.
+        """
+        if tokenizer not in self.encoded_caches:
+            tokens_path = self.token_cache(tokenizer)
+            cache_path = datasets.build_encoded_cache(self.path,
+                    lambda rows: self.encode_rows(rows, tokens_path),
+                    self.vocab_w2i, self.vocab_i2w,
+                    name='columns_{}'.format(tokenizer))
+            encoded = datasets.load_encoded_cache(cache_path)
+            # Offsets of the IDs of each sentence in `sentences`
+            encoded['sentence_offsets'] = np.concatenate(
+                    [[0], np.cumsum(encoded['sentence_lengths'],
+                                    dtype=np.int64)])
+            self.encoded_caches[tokenizer] = encoded
+        return self.encoded_caches[tokenizer]
+
+    def next_encoded_batch(self, batch_size=64, seq_begin=False,
+                           seq_end=False, rescale=None, pad=0,
+                           tokenizer='spacy', sentence_pad=0, one_hot=False,
+                           fields=None, ragged=False):
+        """
+        Same as `next_batch` with `raw=False`, but slices the batch from the
+        columnar copy of the dataset. Only the batch fields in `fields` (all
+        of them by default) are read; the others are None.
+        """
+        encoded = self.encoded_cache(tokenizer)
+        if self.row_order is None:
+            order, _, seed, shard = self.reader_options
+            self.row_order = datasets.RowOrder(
+                    len(encoded['text_offsets']) - 1, order, seed, shard)
+        rows, epochs = self.row_order.next_rows(batch_size)
+        self._epochs_completed += epochs
+
+        batch = dict.fromkeys(self.Batch._fields)
+        for field in self.Batch._fields if fields is None else fields:
+            if field in ['text', 'titles']:
+                ids, lengths = datasets.pad_ragged(encoded[field],
+                        encoded[field + '_offsets'], rows, pad, seq_begin,
+                        seq_end)
+                if pad == 0:
+                    ids = [s[:l].tolist() for s, l in zip(ids, lengths)]
+                batch[field] = ids
+            elif field == 'sentences' and (ragged or sentence_pad != 0):
+                sentences = datasets.ragged_sentences(encoded['sentences'],
+                        encoded['sentence_offsets'],
+                        encoded['sentence_lengths_offsets'], rows, seq_begin,
+                        seq_end)
+                if not ragged:
+                    sentences = datasets.dense_sentences(
+                            sentences, sentence_pad, pad)[0]
+                batch[field] = sentences
+            elif field == 'sentences':
+                batch[field] = datasets.split_sentences(
+                        *datasets.pad_ragged_sentences(encoded['sentences'],
+                                encoded['sentence_offsets'],
+                                encoded['sentence_lengths_offsets'], rows,
+                                pad, seq_begin, seq_end), pad=pad)
+            else:
+                values = encoded[field][rows].astype(np.int64).tolist()
+                if field.startswith('ratings'):
+                    values = self.scale_ratings(values, rescale, one_hot)
+                batch[field] = values
+        return self.Batch(**batch)
+
+    def scale_ratings(self, ratings, rescale=None, one_hot=False):
+        if rescale is not None and one_hot == False:
+            return datasets.rescale(ratings, rescale, [1.0, 5.0])
+        elif rescale is None and one_hot == True:
+            return datasets.id2onehot(
+                    np.asarray(ratings, dtype=np.int64) - 1, 5)
+        elif rescale is None and one_hot == False:
+            return ratings
+        else:
+            raise ValueError('rescale and one_hot cannot be set together')
+
+    def next_batch(self, batch_size=64, seq_begin=False, seq_end=False,
+                   rescale=None, pad=0, raw=False, mark_entities=False,
+                   tokenizer='spacy', sentence_pad=0, one_hot=False,
+                   fields=None, ragged=False):
+        """
+        Returns the next batch of reviews. If the dataset was opened with
+        `encoded=True`, the batches that are not `raw` and don't mark the
+        entities are sliced from the columnar copy of the dataset, and
+        `fields` can restrict them to some of the batch fields (see
+        `next_encoded_batch`).
+
+        Unless the batch is `raw`, the `sentences` of the reviews are:
+        a `datasets.RaggedSentences` with flat arrays, if `ragged` is True;
+        a [batch_size, sentence_pad, pad] array built in one pass (see
+        `datasets.dense_sentences`), if `sentence_pad` is not 0, where a
+        `pad` of 0 pads the sentences to the longest one; or else one list
+        (or array, if `pad` is not 0) of sentences per review.
+        """
+        if not self.datafile:
+            raise Exception('The dataset needs to be open before being used. '
+                            'Please call dataset.open() before calling '
+                            'dataset.next_batch()')
+        if self.encoded and not raw and not mark_entities:
+            return self.next_encoded_batch(batch_size, seq_begin, seq_end,
+                                           rescale, pad, tokenizer,
+                                           sentence_pad, one_hot, fields,
+                                           ragged)
+        text, sentences, titles = [], [], []
+        columns = collections.OrderedDict()
+
+        reader = self.line_reader(tokenizer)
+        while len(text) < batch_size:
+            lines = reader.readline()
+            if lines is None:
+                self._epochs_completed += 1
+                self._line_index = 0
+                continue
+            self._line_index += 1
+            row, tokens = lines
+            text_tokens, sentence_tokens, title_tokens = json.loads(tokens)
+            json_obj = json.loads(row.strip())
+            text.append(text_tokens)
+            sentences.append(sentence_tokens)
+            for field, value in self.row_columns(json_obj).items():
+                columns.setdefault(field, []).append(value)
+            titles.append(title_tokens)
+
+        for field in columns:
+            if field.startswith('ratings'):
+                columns[field] = self.scale_ratings(columns[field], rescale,
+                                                    one_hot)
+
+        if mark_entities:
+            text = datasets.mark_entities(text, lang=self.lang)
+            titles = datasets.mark_entities(titles, lang=self.lang)
+            # All the sentences of the batch are marked in a single call
+            marked = iter(datasets.mark_entities([sentence for review in
+                          sentences for sentence in review], lang=self.lang))
+            sentences = [[next(marked) for _ in review]
+                         for review in sentences]
+
+        if not raw:
+            text = datasets.seq2id(text[:batch_size], self.vocab_w2i, seq_begin,
+                                  seq_end)
+            titles = datasets.seq2id(titles[:batch_size], self.vocab_w2i,
+                                     seq_begin, seq_end)
+            if ragged or sentence_pad != 0:
+                # All the sentences of the batch are encoded at once
+                sentences = datasets.encode_sentences(sentences[:batch_size],
+                                                      self.vocab_w2i,
+                                                      seq_begin, seq_end)
+                if not ragged:
+                    sentences = datasets.dense_sentences(
+                            sentences, sentence_pad, pad)[0]
+            else:
+                sentences = [datasets.seq2id(sentence, self.vocab_w2i,
+                             seq_begin, seq_end)
+                             for sentence in sentences[:batch_size]]
+        else:
+            text = datasets.append_seq_markers(text[:batch_size],
+                                               seq_begin, seq_end)
+            titles = datasets.append_seq_markers(titles[:batch_size],
+                                                 seq_begin, seq_end)
+            sentences = [datasets.append_seq_markers(sentence, seq_begin,
+                         seq_end) for sentence in sentences[:batch_size]]
+
+        if pad != 0:
+            text = datasets.padseq(text[:batch_size], pad, raw)
+            titles = datasets.padseq(titles[:batch_size], pad, raw)
+            if raw or not (ragged or sentence_pad != 0):
+                sentences = [datasets.padseq(sentence, pad, raw)
+                             for sentence in sentences[:batch_size]]
+        if raw and sentence_pad != 0:
+            sentences = [datasets.pad_sentences(sentence, sentence_pad, raw)
+                         for sentence in sentences[:batch_size]]
+
+        batch = self.Batch(text=text, sentences=sentences, titles=titles,
+                           **columns)
+        return batch
+
+    def set_vocab(self, vocab):
+        self.vocab_w2i = vocab[0]
+        self.vocab_i2w = vocab[1]
+        self.encoded_caches = {}
+
+    @property
+    def epochs_completed(self):
+        return self._epochs_completed
@@ -1,9 +1,17 @@
 import os
+import copy
 import datasets
 import collections
 
+import numpy as np
+
+# Membership tests for the tokens that mark the named entities
+entity_token_set = frozenset(datasets.entity_tokens)
+
 
 class STS(object):
+    w2v = datasets.LazyW2V()
+
     def __init__(self, train_validation_split=None, test_split=None,
                  use_defaults=True, subset='sts_small'):
         if train_validation_split is not None or test_split is not None or \
@@ -31,7 +39,8 @@ class STS(object):
         self.w2v_path = os.path.join(self.dataset_path, 'w2v.npy')
 
         self.w2i, self.i2w = datasets.load_vocabulary(self.vocab_path)
-        self.w2v = datasets.load_w2v(self.w2v_path)
+        # Memory-mapped the first time it is used (see `datasets.LazyW2V`)
+        self.w2v = None
 
         self.vocab_size = len(self.w2i)
         self.train = DataSet(self.train_path, (self.w2i, self.i2w))
@@ -45,7 +54,8 @@ class STS(object):
         self.vocab_path, self.w2v_path, self.metadata_path = \
             datasets.new_vocabulary([self.train_path], self.dataset_path,
                                     min_frequency, tokenizer=tokenizer, downcase=downcase,
-                                    max_vocab_size=max_vocab_size, name=name)
+                                    max_vocab_size=max_vocab_size, name=name,
+                                    cache_name='s1_s2')
         self.__refresh(load_w2v)
 
     def __refresh(self, load_w2v):
@@ -64,31 +74,127 @@ class DataSet(object):
 
         self.path = path
         self._epochs_completed = 0
-        self.vocab_w2i = vocab[0]
-        self.vocab_i2w = vocab[1]
         self.datafile = None
+        self.encoded = False
+        self.encoded_cache_ = None
+        self.set_vocab(vocab)
+        self.reader_options = ('sequential', None, None)
+        self.row_order = None
 
         self.Batch = collections.namedtuple('Batch', ['s1', 's2', 'sim'])
 
-    def open(self):
-        self.datafile = open(self.path, 'r')
+    def open(self, encoded=False, order='sequential', buffer_size=10000,
+             seed=None, shard=None):
+        """
+        Opens the dataset. If `encoded` is True, the batches that are not
+        `raw` are sliced from the encoded copy of the dataset (see
+        `encoded_cache`) instead of being parsed from the text file.
+
+        `order`, `buffer_size` and `seed` choose the order in which the rows
+        are read, and `shard` restricts them to one shard of the dataset (see
+        `datasets.LineReader`). The encoded copy is read in a new random
+        order every epoch for any `order` but 'sequential'.
+        """
+        self.datafile = datasets.LineReader([self.path], order, buffer_size,
+                                            seed, shard=shard)
+        self.encoded = encoded
+        self.reader_options = (order, seed, shard)
+        self.row_order = None
 
     def close(self):
         self.datafile.close()
 
+    def encode_rows(self, rows):
+        """
+        Yields the tokens of both sentences and the similarity of each row
+        in `rows`. Used to build the encoded copy of the dataset.
+        """
+        for row in rows:
+            cols = row.strip().split('\t')
+            yield {'s1': cols[0].split(' '), 's2': cols[1].split(' '),
+                   'sim': float(cols[2])}
+
+    def encoded_cache(self):
+        """
+        Returns the encoded copy of the dataset for the current vocabulary:
+        the IDs of `s1` and `s2` as int32 arrays with their offsets, and the
+        similarities as a float32 array (see `datasets.build_encoded_cache`).
+        It is built the first time it is needed and memory-mapped afterwards.
+
+        The entities are kept in the encoded copy and dropped by ID when the
+        batches are sliced, so a single copy serves both `keep_entities`
+        settings. The entity tokens missing from the vocabulary are encoded
+        as -1 (see `set_vocab`).
+        """
+        if self.encoded_cache_ is None:
+            cache_path = datasets.build_encoded_cache(self.path,
+                    self.encode_rows, self.entity_w2i, self.vocab_i2w,
+                    name='entity_ids')
+            self.encoded_cache_ = datasets.load_encoded_cache(cache_path)
+        return self.encoded_cache_
+
+    def next_encoded_batch(self, batch_size=64, seq_begin=False,
+                           seq_end=False, rescale=(0.0, 1.0), pad=0,
+                           keep_entities=False):
+        """
+        Same as `next_batch` with `raw=False`, but slices the batch from the
+        encoded copy of the dataset.
+        """
+        encoded = self.encoded_cache()
+        if self.row_order is None:
+            self.row_order = datasets.RowOrder(len(encoded['sim']),
+                                               *self.reader_options)
+        rows, epochs = self.row_order.next_rows(batch_size)
+        self._epochs_completed += epochs
+
+        drop_ids = None if keep_entities else self.entity_ids
+        s1s, s1_lengths = datasets.pad_ragged(encoded['s1'],
+                encoded['s1_offsets'], rows, pad, seq_begin, seq_end,
+                drop_ids)
+        s2s, s2_lengths = datasets.pad_ragged(encoded['s2'],
+                encoded['s2_offsets'], rows, pad, seq_begin, seq_end,
+                drop_ids)
+        if keep_entities:
+            # Entity tokens missing from the vocabulary are unknown words
+            s1s[s1s < 0] = self.vocab_w2i['UNK']
+            s2s[s2s < 0] = self.vocab_w2i['UNK']
+        if pad == 0:
+            s1s = [s[:l].tolist() for s, l in zip(s1s, s1_lengths)]
+            s2s = [s[:l].tolist() for s, l in zip(s2s, s2_lengths)]
+        return self.Batch(
+            s1=s1s,
+            s2=s2s,
+            sim=datasets.rescale(encoded['sim'][rows].tolist(), rescale,
+                                 (0.0, 1.0)))
+
+    def iter_epoch(self, batch_size=64, rank=0, world_size=1, **kwargs):
+        """
+        Yields the batches of a single pass over the dataset, in which every
+        row is read exactly once, in order. The last batch is shorter when
+        the number of rows is not a multiple of `batch_size`. With
+        `world_size` workers, only the rows of the `rank`-th shard are read.
+        `kwargs` are passed to `next_batch`.
+
+        The pass reads its own copy of the dataset, so it doesn't change the
+        position or `epochs_completed` of the dataset.
+        """
+        dataset = copy.copy(self)
+        dataset.open(encoded=self.encoded, shard=(rank, world_size))
+        try:
+            if self.encoded and not kwargs.get('raw', False):
+                n_rows = datasets.RowOrder(len(dataset.encoded_cache()['sim']),
+                                           shard=(rank, world_size)).n_rows
+            else:
+                n_rows = dataset.datafile.n_lines()
+            for batch in datasets.epoch_batches(dataset, n_rows, batch_size,
+                                                **kwargs):
+                yield batch
+        finally:
+            dataset.close()
+
     def remove_entities(self, data):
-        entities = ['PERSON' , 'NORP' , 'FACILITY' , 'ORG' , 'GPE' , 'LOC' +
-                    'PRODUCT' , 'EVENT' , 'WORK_OF_ART' , 'LANGUAGE' ,
-                    'DATE' , 'TIME' , 'PERCENT' , 'MONEY' , 'QUANTITY' ,
-                    'ORDINAL' , 'CARDINAL' , 'BOE', 'EOE']
-        data_ = []
-        for d in data:
-            d_ = []
-            for token in d:
-                if token not in entities:
-                    d_.append(token)
-            data_.append(d_)
-        return data_
+        return [[token for token in d if token not in entity_token_set]
+                for d in data]
 
     def next_batch(self, batch_size=64, seq_begin=False, seq_end=False,
                    rescale=(0.0, 1.0), pad=0, raw=False, keep_entities=False):
@@ -97,22 +203,37 @@ class DataSet(object):
                             'Please call dataset.open() before calling '
                             'dataset.next_batch()')
         datasets.validate_rescale(rescale)
+        if self.encoded and not raw:
+            return self.next_encoded_batch(batch_size, seq_begin, seq_end,
+                                           rescale, pad, keep_entities)
 
         s1s, s2s, sims = [], [], []
 
         while len(s1s) < batch_size:
             row = self.datafile.readline()
-            if row == '':
+            if row is None:
                 self._epochs_completed += 1
-                self.datafile.seek(0)
                 continue
-            cols = row.strip().split('\t')
+            cols = row[0].strip().split('\t')
             s1, s2, sim = cols[0], cols[1], float(cols[2])
             s1, s2 = s1.split(' '), s2.split(' ')
             s1s.append(s1)
             s2s.append(s2)
             sims.append(sim)
 
+        if not raw and pad != 0:
+            # The entities are dropped by ID while the batch is encoded
+            w2i = self.vocab_w2i if keep_entities else self.entity_w2i
+            drop_ids = None if keep_entities else self.entity_ids
+            s1s, _ = datasets.encode_batch(s1s[:batch_size], w2i, pad,
+                                           seq_begin, seq_end, drop_ids)
+            s2s, _ = datasets.encode_batch(s2s[:batch_size], w2i, pad,
+                                           seq_begin, seq_end, drop_ids)
+            return self.Batch(
+                s1=s1s,
+                s2=s2s,
+                sim=datasets.rescale(sims[:batch_size], rescale, (0.0, 1.0)))
+
         if not keep_entities:
             s1s = self.remove_entities(s1s)
             s2s = self.remove_entities(s2s)
@@ -125,9 +246,9 @@ class DataSet(object):
         else:
             s1s = datasets.append_seq_markers(s1s[:batch_size], seq_begin, seq_end)
             s2s = datasets.append_seq_markers(s2s[:batch_size], seq_begin, seq_end)
-        if pad != 0:
-            s1s = datasets.padseq(s1s, pad, raw)
-            s2s = datasets.padseq(s2s, pad, raw)
+            if pad != 0:
+                s1s = datasets.padseq(s1s, pad, raw)
+                s2s = datasets.padseq(s2s, pad, raw)
         batch = self.Batch(
             s1=s1s,
             s2=s2s,
@@ -137,6 +258,16 @@ class DataSet(object):
     def set_vocab(self, vocab):
         self.vocab_w2i = vocab[0]
         self.vocab_i2w = vocab[1]
+        self.encoded_cache_ = None
+        # The entity tokens missing from the vocabulary are encoded as -1
+        # instead of 'UNK', so that they can be dropped by ID without
+        # dropping the other unknown words. The merged dictionary is built
+        # once, so that encoding looks up a plain dict.
+        missing = {token: -1 for token in datasets.entity_tokens
+                   if token not in self.vocab_w2i}
+        self.entity_w2i = dict(self.vocab_w2i, **missing)
+        self.entity_ids = np.array([self.entity_w2i[token] for token in
+                                    datasets.entity_tokens], dtype=np.int32)
 
     @property
     def epochs_completed(self):
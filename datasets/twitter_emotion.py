@@ -1,12 +1,14 @@
 import os
+import copy
 import json
 import datasets
 import collections
-
-from tflearn.data_utils import to_categorical
+import numpy as np
 
 
 class TwitterEmotion(object):
+    w2v = datasets.LazyW2V()
+
     def __init__(self, train_validation_split=None, test_split=None,
                  use_defaults=True):
         if train_validation_split is not None or test_split is not None or \
@@ -40,7 +42,8 @@ class TwitterEmotion(object):
         self.w2v_path = os.path.join(self.dataset_path, 'w2v.npy')
 
         self.w2i, self.i2w = datasets.load_vocabulary(self.vocab_path)
-        self.w2v = datasets.load_w2v(self.w2v_path)
+        # Memory-mapped the first time it is used (see `datasets.LazyW2V`)
+        self.w2v = None
         self.c2i, self.i2c = datasets.load_classes(self.classes_path)
         self.n_classes = len(self.c2i)
 
@@ -65,9 +68,55 @@ class TwitterEmotion(object):
                                     min_frequency, tokenizer=tokenizer,
                                     downcase=downcase,
                                     max_vocab_size=max_vocab_size, name=name,
-                                    line_processor=line_processor, lang='de')
+                                    line_processor=line_processor, lang='de',
+                                    cache_name='text')
         self.__refresh(load_w2v)
 
+    def encode_folds(self, tokenizer='spacy', mark_entities=False):
+        """
+        Reads the tweets of the train, validation and test splits of all the
+        folds, and tokenizes and encodes each distinct tweet only once (see
+        `datasets.encode_ragged`). The splits become sets of indices into the
+        encoded tweets, so the folds can be trained concurrently (see
+        `datasets.run_folds`) without reading the data again.
+
+        Returns a list with one dictionary per fold, mapping 'train',
+        'validation' and 'test' to a `FoldDataSet`.
+        """
+        split_paths = [('train', self.train_paths),
+                       ('validation', self.validation_paths),
+                       ('test', self.test_paths)]
+        index, tweets, emotions = {}, [], []
+        folds = []
+        for fold in range(5):
+            splits = {}
+            for split, paths in split_paths:
+                rows = []
+                with open(paths[fold], 'r') as f:
+                    for row in f:
+                        cols = row.strip().split('\t')
+                        try:
+                            tweet, emo = cols[0], int(cols[1])
+                        except Exception as e:
+                            print('Invalid data instance. Skipping line.')
+                            continue
+                        if (tweet, emo) not in index:
+                            index[(tweet, emo)] = len(tweets)
+                            tweets.append(tweet)
+                            emotions.append(emo)
+                        rows.append(index[(tweet, emo)])
+                splits[split] = rows
+            folds.append(splits)
+
+        text = datasets.tokenize_batch(tweets, tokenizer)
+        if mark_entities:
+            text = datasets.mark_entities(text, lang='en')
+        ids, offsets = datasets.encode_ragged(text, self.w2i)
+        encoded = (ids, offsets, np.array(emotions, dtype=np.int32))
+        return [{split: FoldDataSet(encoded, rows, self.n_classes,
+                                    shuffle=(split == 'train'))
+                 for split, rows in splits.items()} for splits in folds]
+
     def __refresh(self, load_w2v):
         self.w2i, self.i2w = datasets.load_vocabulary(self.vocab_path)
         self.vocab_size = len(self.w2i)
@@ -89,21 +138,119 @@ class DataSet(object):
         self.vocab_i2w = vocab[1]
         self.c2i = classes[0]
         self.i2c = classes[1]
-        self.datafiles = None
+        self.datafile = None
+        self.fold = 0
+        self.reader_options = ('sequential', 10000, None, None)
+        self.tokensfile_tokenizer = None
+        self._line_index = 0
+        # Number of valid rows of each shard of each fold. See `n_valid_rows`
+        self.valid_row_counts = {}
 
         self.Batch = collections.namedtuple('Batch', ['text', 'emotion'])
 
-    def open(self, fold=0):
+    def open(self, fold=0, order='sequential', buffer_size=10000, seed=None,
+             shard=None):
+        """
+        Opens the fold `fold` of the dataset. `order`, `buffer_size` and
+        `seed` choose the order in which the tweets are read, and `shard`
+        restricts them to one shard of the fold (see `datasets.LineReader`).
+        """
         if self.valid_fold(fold=fold):
-            self.datafile = open(self.paths[fold], 'r')
+            self.fold = fold
+            self.path = self.paths[fold]
+            self.datafile = datasets.LineReader([self.path], order,
+                                                buffer_size, seed, shard=shard)
+            self.reader_options = (order, buffer_size, seed, shard)
+            self.tokensfile_tokenizer = None
             self._epochs_completed = 0
+            self._line_index = 0
         else:
             raise ValueError('Only 5 folds are available. fold can take '
                              'values from 0 - 4 Please use folds in this range')
 
     def close(self):
         self.datafile.close()
-        
+
+    def iter_epoch(self, batch_size=64, rank=0, world_size=1, **kwargs):
+        """
+        Yields the batches of a single pass over the dataset, in which every
+        tweet is read exactly once, in order. The last batch is shorter when
+        the number of tweets is not a multiple of `batch_size`. With
+        `world_size` workers, only the tweets of the `rank`-th shard are
+        read. `kwargs` are passed to `next_batch`.
+
+        The pass reads its own copy of the dataset, so it doesn't change the
+        position or `epochs_completed` of the dataset.
+        """
+        dataset = copy.copy(self)
+        dataset.open(self.fold, shard=(rank, world_size))
+        try:
+            # The invalid rows are skipped by `next_batch`, so they are not
+            # part of the pass
+            n_rows = dataset.n_valid_rows(shard=(rank, world_size))
+            for batch in datasets.epoch_batches(dataset, n_rows, batch_size,
+                                                **kwargs):
+                yield batch
+        finally:
+            dataset.close()
+
+    def parse_row(self, row):
+        """
+        Returns the emotion of the tweet in the data row `row`, or None if
+        the row is invalid.
+        """
+        cols = row.strip().split('\t')
+        try:
+            return int(cols[1])
+        except (IndexError, ValueError):
+            return None
+
+    def n_valid_rows(self, shard=None):
+        """
+        Returns the number of valid rows (see `parse_row`) of the shard
+        `shard` of the open fold, which is the number of tweets that
+        `next_batch` reads in an epoch. The rows are counted once for each
+        shard and version of the fold.
+        """
+        key = (self.path, shard) + tuple(datasets.file_stamp(self.path))
+        if key not in self.valid_row_counts:
+            reader = datasets.LineReader([self.path], shard=shard)
+            n_rows = 0
+            lines = reader.readline()
+            while lines is not None:
+                n_rows += self.parse_row(lines[0]) is not None
+                lines = reader.readline()
+            reader.close()
+            self.valid_row_counts[key] = n_rows
+        return self.valid_row_counts[key]
+
+    def tokenize_rows(self, rows, tokenizer='spacy'):
+        """
+        Yields the tokens of the tweet in each row of `rows`. Used to build
+        the token cache of the dataset.
+        """
+        tweets = (row.strip().split('\t')[0] for row in rows)
+        for tokens in datasets.iter_tokenize(tweets, tokenizer):
+            yield tokens
+
+    def line_reader(self, tokenizer):
+        """
+        Returns a `datasets.LineReader` that reads the open fold together
+        with its token cache for `tokenizer`. When the tokenizer changes, a
+        sequential reader goes on from the current line.
+        """
+        if self.tokensfile_tokenizer != tokenizer:
+            cache_path = datasets.build_token_cache(self.path,
+                    lambda rows: self.tokenize_rows(rows, tokenizer),
+                    tokenizer, name='text')
+            order, buffer_size, seed, shard = self.reader_options
+            self.datafile.close()
+            self.datafile = datasets.LineReader([self.path, cache_path],
+                                                order, buffer_size, seed,
+                                                skip=self._line_index,
+                                                shard=shard)
+            self.tokensfile_tokenizer = tokenizer
+        return self.datafile
 
     def valid_fold(self, fold):
         if fold >=0 and fold <= 4:
@@ -121,23 +268,25 @@ class DataSet(object):
                             'dataset.next_batch()')
         text, emotion = [], []
 
+        reader = self.line_reader(tokenizer)
         while len(text) < batch_size:
-            row = self.datafile.readline()
-            if row == '':
+            lines = reader.readline()
+            if lines is None:
                 self._epochs_completed += 1
-                self.datafile.seek(0)
+                self._line_index = 0
                 continue
-            cols = row.strip().split('\t')
-            try:
-                tweet, emo = cols[0], int(cols[1])
-            except Exception as e:
+            self._line_index += 1
+            row, tokens = lines
+            tokens = json.loads(tokens)
+            emo = self.parse_row(row)
+            if emo is None:
                 print('Invalid data instance. Skipping line.')
                 continue
-            text.append(datasets.tokenize(tweet, tokenizer))
+            text.append(tokens)
             emotion.append(emo)
 
         if one_hot:
-            emotion = to_categorical(emotion, nb_classes=self.n_classes)
+            emotion = datasets.id2onehot(emotion, self.n_classes)
 
         if mark_entities:
             text = datasets.mark_entities(text, lang='en')
@@ -161,4 +310,52 @@ class DataSet(object):
 
     @property
     def epochs_completed(self):
-        return self._epochs_completed
\ No newline at end of file
+        return self._epochs_completed
+
+
+class FoldDataSet(object):
+    """
+    One split of a fold returned by `TwitterEmotion.encode_folds`. It holds
+    the indices `rows` of its tweets in the corpus `encoded`, a tuple (ids,
+    offsets, emotions) that is shared by all the splits of all the folds.
+    Its batches have the same fields as the ones of `DataSet`, but the text
+    is always an int32 array, padded to the longest tweet when `pad` is 0.
+    """
+    def __init__(self, encoded, rows, n_classes, shuffle=True, seed=None):
+        self.ids, self.offsets, self.emotions = encoded
+        self.rows = np.asarray(rows, dtype=np.int64)
+        self.n_classes = n_classes
+        self._epochs_completed = 0
+        # A new index permutation of the rows every epoch (when shuffling)
+        self.row_order = datasets.RowOrder(
+                len(self.rows), 'shuffle' if shuffle else 'sequential', seed)
+
+        self.Batch = collections.namedtuple('Batch', ['text', 'emotion'])
+
+    def next_batch(self, batch_size=64, seq_begin=False, seq_end=False,
+                   pad=0, one_hot=False):
+        rows, epochs = self.row_order.next_rows(batch_size)
+        self._epochs_completed += epochs
+        rows = self.rows[rows]
+
+        text, _ = datasets.pad_ragged(self.ids, self.offsets, rows, pad,
+                                      seq_begin, seq_end)
+        emotion = self.emotions[rows]
+        if one_hot:
+            emotion = datasets.id2onehot(emotion, self.n_classes)
+        return self.Batch(text=text, emotion=emotion)
+
+    def iter_epoch(self, batch_size=64, rank=0, world_size=1, **kwargs):
+        """
+        Yields the batches of a single pass over the split, in which every
+        tweet is read exactly once, in order (see `DataSet.iter_epoch`).
+        """
+        dataset = copy.copy(self)
+        dataset.row_order = datasets.RowOrder(len(self.rows),
+                                              shard=(rank, world_size))
+        return datasets.epoch_batches(dataset, dataset.row_order.n_rows,
+                                      batch_size, **kwargs)
+
+    @property
+    def epochs_completed(self):
+        return self._epochs_completed
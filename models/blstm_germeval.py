@@ -22,9 +22,14 @@ class BLSTMGermEval(Model):
         self.pos = tf.placeholder(tf.int32,
                                     [None, self.args.get("sequence_length")])
         self.input_lengths = tf.placeholder(tf.int32, [None])
-        self.output = tf.placeholder(tf.float32,
-                                      [None, self.args.get("sequence_length"),
-                                       self.args['n_classes']])
+        if self.args.get('sparse_labels'):
+            # The IDs of the tags, which are one-hot encoded in the graph
+            self.output = tf.placeholder(tf.int32,
+                                         [None, self.args.get("sequence_length")])
+        else:
+            self.output = tf.placeholder(tf.float32,
+                                          [None, self.args.get("sequence_length"),
+                                           self.args['n_classes']])
 
     # Inspired by:
     # https://github.com/monikkinom/ner-lstm/blob/master/model.py
@@ -68,6 +73,21 @@ class BLSTMGermEval(Model):
         prediction = tf.nn.softmax(logits)
         self.prediction = tf.reshape(prediction, [-1, self.args.get("sequence_length"),
                                                   self.args['n_classes']])
+        if self.args.get('sparse_labels'):
+            # The padding after the end of each sentence is left out
+            mask = tf.sequence_mask(self.input_lengths,
+                                    self.args.get("sequence_length"))
+            with tf.name_scope("loss"):
+                self.loss = ops.sparse_sequence_loss(logits, self.output, mask)
+
+                if self.args["l2_reg_beta"] > 0.0:
+                    self.regularizer = ops.get_regularizer(self.args["l2_reg_beta"])
+                    self.loss = tf.reduce_mean(self.loss + self.regularizer)
+            with tf.name_scope('accuracy'):
+                self.accuracy = ops.sparse_sequence_accuracy(logits,
+                                                             self.output, mask)
+            return
+
         open_targets = tf.reshape(self.output, [-1, self.args['n_classes']])
         with tf.name_scope("loss"):
             #self.loss = self.cost()
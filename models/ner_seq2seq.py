@@ -20,9 +20,14 @@ class AcnerSeq2Seq(Model):
         self.input_target = tf.placeholder(tf.int32,
                                  [None, self.args.get("sequence_length")])
 
-        self.output = tf.placeholder(tf.float32,
-                                      [None, self.args.get("sequence_length"),
-                                       self.args['n_classes']])
+        if self.args.get('sparse_labels'):
+            # The IDs of the tags, which are one-hot encoded in the graph
+            self.output = tf.placeholder(tf.int32,
+                                         [None, self.args.get("sequence_length")])
+        else:
+            self.output = tf.placeholder(tf.float32,
+                                          [None, self.args.get("sequence_length"),
+                                           self.args['n_classes']])
 
     # Inspired by:
     # https://github.com/monikkinom/ner-lstm/blob/master/model.py
@@ -73,6 +78,24 @@ class AcnerSeq2Seq(Model):
         self.prediction_open = tf.nn.softmax(softmax_logits)
         self.prediction = tf.reshape(self.prediction_open,
                          shape=[-1, self.args['sequence_length'], self.args['n_classes']])
+
+        if self.args.get('sparse_labels'):
+            # The padding tags (ID 0) after the end of each sentence are left
+            # out
+            mask = tf.not_equal(self.output, 0)
+            with tf.name_scope("loss"):
+                self.loss = ops.sparse_sequence_loss(softmax_logits,
+                                                     self.output, mask)
+
+                if self.args["l2_reg_beta"] > 0.0:
+                    self.regularizer = ops.get_regularizer(self.args["l2_reg_beta"])
+                    self.loss = tf.reduce_mean(self.loss + self.regularizer)
+
+            with tf.name_scope("Graph_Accuracy"):
+                self.accuracy = ops.sparse_sequence_accuracy(
+                        softmax_logits, self.output, mask)
+            return
+
         reshaped_output = tf.reshape(self.output, [-1, self.args['n_classes']])
 
         with tf.name_scope("loss"):
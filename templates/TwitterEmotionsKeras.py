@@ -1,11 +1,4 @@
-from keras.models import Sequential
-from keras.layers import Dense
-from keras.layers import Dropout
-from keras.layers import Activation
-from keras.layers import Embedding
-from keras.layers import LSTM
-from keras.layers import Conv1D
-from keras.layers import MaxPooling1D
+import datasets
 from datasets import TwitterEmotion
 
 # setup the dataset
@@ -13,9 +6,9 @@ te = TwitterEmotion()
 te.create_vocabulary(min_frequency=2)
 w2v = te.w2v
 
-te.train.open(fold=0)
-te.validation.open(fold=0)
-te.test.open(fold=0)
+# The tweets of all the folds are tokenized and encoded only once. Each fold
+# is trained in its own process, which inherits them
+folds = te.encode_folds(mark_entities=True)
 
 # Hyper Params
 
@@ -35,80 +28,100 @@ lstm_output_size = 70
 batch_size = 500
 epochs = 2
 
-print('Building the Model...')
-model = Sequential()
-model.add(Embedding(vocab_size, embedding_size, input_length = maxlen,
-					weights = [w2v]))
-model.add(Dropout(0.25))
-model.add(Conv1D(filters,
-				 kernel_size,
-				 padding = 'valid',
-				 activation = 'relu',
-				 strides = 1))
-model.add(MaxPooling1D(pool_size = pool_size))
-model.add(LSTM(lstm_output_size))
-model.add(Dense(te.n_classes))
-model.add(Activation('sigmoid'))
-
-model.compile(loss = 'categorical_crossentropy',
-			  optimizer = 'adam', metrics = ['accuracy'])
-
-min_val_loss = float("inf")
-prev_epoch = 0
-while te.train.epochs_completed < epochs:
-
-	train_batch = te.train.next_batch(batch_size = batch_size, pad = maxlen,
-									  one_hot = True, mark_entities = True)
-	[loss, accuracy] = model.train_on_batch(train_batch.text,
-											train_batch.emotion)
-	print('Epoch {}\tLoss: {}\tAcc: {}'.format(te.train.epochs_completed,
-											   loss, accuracy))
-	if prev_epoch != te.train.epochs_completed:
-		prev_epoch = te.train.epochs_completed
-
-		print('validating')
-		total_val_loss, total_val_acc, n_val_iterations = 0.0, 0.0, 0
-		while te.validation.epochs_completed < 1:
-			val_batch = te.validation.next_batch(batch_size = batch_size,
-												 pad = maxlen, one_hot = True,
-												 mark_entities = True)
-			[val_loss, val_accuracy] = model.test_on_batch(val_batch.text,
-														   val_batch.emotion)
-
-			total_val_loss += val_loss
-			total_val_acc += val_accuracy
-			n_val_iterations += 1
-		te.validation._epochs_completed = 0
-		avg_val_loss = total_val_loss / n_val_iterations
-		avg_val_acc = total_val_acc / n_val_iterations
-		print("Average Validation Loss: {}\t"
-			  "Average Validation Accuracy: {}".format(avg_val_loss,
-													   avg_val_acc))
-		if avg_val_loss < min_val_loss:
-			print('saving model as the validation loss improved. '
-				  'Previous val loss: {}\t current val loss: {}'.format(
-				min_val_loss, avg_val_loss))
-			model.save('model_{}.h5'.format(te.train.epochs_completed))
-			min_val_loss = avg_val_loss
-
-print('Testing')
-total_test_loss, total_test_acc, n_test_iterations = 0.0, 0.0, 0
-while te.test.epochs_completed < 1:
-	te.test._epochs_completed = 0
-	test_batch = te.test.next_batch(batch_size = batch_size,
-									pad = maxlen, one_hot = True,
-									mark_entities = True)
-	[test_loss, test_accuracy] = model.test_on_batch(test_batch.text,
-													 test_batch.emotion)
-	total_test_loss += test_loss
-	total_test_acc += test_accuracy
-	n_test_iterations += 1
-
-avg_test_loss = total_test_loss / n_test_iterations
-avg_test_acc = total_test_acc / n_test_iterations
-print("Avg Test Accuracy: {}\nAverage Test Loss: {}".format(avg_test_acc,
-															avg_test_loss))
-
-te.train.close()
-te.validation.close()
-te.test.close()
\ No newline at end of file
+# Folds trained at the same time. TensorFlow takes all the GPU memory by
+# default, so on a GPU every process is given its own share of it, and there
+# are fewer processes than cores
+n_processes = 2
+gpu_fraction = 0.9 / n_processes
+
+
+def evaluate(model, dataset):
+	total_loss, total_acc, n_iterations = 0.0, 0.0, 0
+	for batch in dataset.iter_epoch(batch_size = batch_size, pad = maxlen,
+									one_hot = True):
+		[loss, accuracy] = model.test_on_batch(batch.text, batch.emotion)
+		total_loss += loss
+		total_acc += accuracy
+		n_iterations += 1
+	return total_loss / n_iterations, total_acc / n_iterations
+
+
+def train_fold(fold):
+	# Keras is imported by each fold's process, so that every fold gets its
+	# own TensorFlow session
+	import tensorflow as tf
+	from keras import backend as K
+	from keras.models import Sequential
+	from keras.layers import Dense
+	from keras.layers import Dropout
+	from keras.layers import Activation
+	from keras.layers import Embedding
+	from keras.layers import LSTM
+	from keras.layers import Conv1D
+	from keras.layers import MaxPooling1D
+
+	config = tf.ConfigProto()
+	config.gpu_options.per_process_gpu_memory_fraction = gpu_fraction
+	config.gpu_options.allow_growth = True
+	K.set_session(tf.Session(config=config))
+
+	train, validation, test = [folds[fold][split] for split in
+							   ['train', 'validation', 'test']]
+
+	print('Building the Model for fold {}...'.format(fold))
+	model = Sequential()
+	model.add(Embedding(vocab_size, embedding_size, input_length = maxlen,
+						weights = [w2v]))
+	model.add(Dropout(0.25))
+	model.add(Conv1D(filters,
+					 kernel_size,
+					 padding = 'valid',
+					 activation = 'relu',
+					 strides = 1))
+	model.add(MaxPooling1D(pool_size = pool_size))
+	model.add(LSTM(lstm_output_size))
+	model.add(Dense(te.n_classes))
+	model.add(Activation('sigmoid'))
+
+	model.compile(loss = 'categorical_crossentropy',
+				  optimizer = 'adam', metrics = ['accuracy'])
+
+	min_val_loss = float("inf")
+	prev_epoch = 0
+	while train.epochs_completed < epochs:
+
+		train_batch = train.next_batch(batch_size = batch_size, pad = maxlen,
+									   one_hot = True)
+		[loss, accuracy] = model.train_on_batch(train_batch.text,
+												train_batch.emotion)
+		print('Fold {}\tEpoch {}\tLoss: {}\tAcc: {}'.format(
+			fold, train.epochs_completed, loss, accuracy))
+		if prev_epoch != train.epochs_completed:
+			prev_epoch = train.epochs_completed
+
+			print('validating')
+			avg_val_loss, avg_val_acc = evaluate(model, validation)
+			print("Fold {}\tAverage Validation Loss: {}\t"
+				  "Average Validation Accuracy: {}".format(fold, avg_val_loss,
+														   avg_val_acc))
+			if avg_val_loss < min_val_loss:
+				print('saving model as the validation loss improved. '
+					  'Previous val loss: {}\t current val loss: {}'.format(
+					min_val_loss, avg_val_loss))
+				model.save('model_fold_{}_{}.h5'.format(
+					fold, train.epochs_completed))
+				min_val_loss = avg_val_loss
+
+	print('Testing fold {}'.format(fold))
+	avg_test_loss, avg_test_acc = evaluate(model, test)
+	return {'val_loss': min_val_loss, 'test_loss': avg_test_loss,
+			'test_acc': avg_test_acc}
+
+
+# The folds are trained concurrently, `n_processes` at a time
+results = datasets.run_folds(train_fold, len(folds), n_processes)
+for fold, metrics in enumerate(results):
+	print("Fold {}\tTest Accuracy: {}\tTest Loss: {}".format(
+		fold, metrics['test_acc'], metrics['test_loss']))
+for metric, (mean, std) in sorted(datasets.aggregate_metrics(results).items()):
+	print("Average {}: {} (std {})".format(metric, mean, std))
@@ -2,12 +2,13 @@ import os
 import datetime
 import tflearn
 
+import numpy as np
 import tensorflow as tf
 
 from datasets import Acner
 from datasets import id2seq
 from models import BLSTMAcner
-from datasets import onehot2seq
+from datasets import onehot2id
 
 
 # Model Parameters
@@ -28,6 +29,9 @@ tf.flags.DEFINE_string("optimizer", 'adam', "Which Optimizer to use. "
                     "adadelta, rmsprop")
 tf.flags.DEFINE_integer("learning_rate", 0.0001, "Learning Rate")
 tf.flags.DEFINE_integer("sequence_length", 50, "maximum length of a sequence")
+tf.flags.DEFINE_boolean("sparse_labels", True, "Feed the IDs of the NER tags "
+                                               "instead of their one-hot "
+                                               "vectors")
 
 # Training parameters
 tf.flags.DEFINE_integer("max_checkpoints", 100, "Maximum number of "
@@ -51,6 +55,9 @@ tf.flags.DEFINE_boolean("verbose", True, "Log Verbosity Flag")
 tf.flags.DEFINE_float("gpu_fraction", 0.5, "Fraction of GPU to use")
 tf.flags.DEFINE_string("data_dir", "/scratch", "path to the root of the data "
                                            "directory")
+tf.flags.DEFINE_integer("seed", 42, "Seed of the random train/validation/test "
+                        "split. The split built by an earlier run with the "
+                        "same seed is loaded instead of built again")
 tf.flags.DEFINE_string("experiment_name",
                        "NER_ACNER_BLSTM",
                        "Name of your model")
@@ -97,7 +104,8 @@ def train(dataset, metadata_path, w2v, n_classes):
         tflearn.is_training(True, session=sess)
         while dataset.train.epochs_completed < FLAGS.num_epochs:
             train_batch = dataset.train.next_batch(batch_size=FLAGS.batch_size,
-                        pad=ner_model.args["sequence_length"], one_hot=True)
+                        pad=ner_model.args["sequence_length"],
+                        one_hot=not FLAGS.sparse_labels)
             pred, loss, step, acc = ner_model.train_step(sess,
                                     train_batch.sentences, train_batch.ner,
                                         train_batch.lengths, train_batch.pos,
@@ -150,24 +158,30 @@ def evaluate(sess, dataset, model, step, max_dev_itr=100, verbose=True,
     # TF for calculating streaming Pearson Correlation and MSE
     all_dev_text, all_dev_pred, all_dev_gt = [], [], []
     dev_itr = 0
-    while (dev_itr < max_dev_itr and max_dev_itr != 0) \
-            or mode in ['test', 'train']:
-        val_batch = dataset.next_batch(FLAGS.batch_size,
-                                       pad=model.args["sequence_length"],
-                                       one_hot=True, raw=False)
+    # The test and train passes read every example exactly once
+    batch_kwargs = dict(pad=model.args["sequence_length"],
+                        one_hot=not FLAGS.sparse_labels, raw=False)
+    if mode in ['test', 'train']:
+        batches = dataset.iter_epoch(FLAGS.batch_size, **batch_kwargs)
+    else:
+        batches = (dataset.next_batch(FLAGS.batch_size, **batch_kwargs)
+                   for _ in range(max_dev_itr))
+    for val_batch in batches:
         loss, pred, acc = model.evaluate_step(sess, val_batch.sentences,
                                               val_batch.ner, val_batch.lengths,
                                               val_batch.pos)
         avg_val_loss += loss
         avg_acc += acc
-        all_dev_text += id2seq(val_batch.sentences, dataset.vocab_i2w[0])
-        all_dev_pred += onehot2seq(pred, dataset.vocab_i2w[2])
-        all_dev_gt += onehot2seq(val_batch.ner, dataset.vocab_i2w[2])
+        all_dev_text.append(val_batch.sentences)
+        all_dev_pred.append(onehot2id(pred))
+        all_dev_gt.append(val_batch.ner if FLAGS.sparse_labels
+                          else onehot2id(val_batch.ner))
         dev_itr += 1
 
-        if mode == 'test' and dataset.epochs_completed == 1: break
-        if mode == 'train' and dataset.epochs_completed == 1: break
-
+    # The batches are decoded into words once, after the evaluation loop
+    all_dev_text = id2seq(np.concatenate(all_dev_text), dataset.vocab_i2w[0])
+    all_dev_pred = id2seq(np.concatenate(all_dev_pred), dataset.vocab_i2w[2])
+    all_dev_gt = id2seq(np.concatenate(all_dev_gt), dataset.vocab_i2w[2])
     result_set = (all_dev_text, all_dev_pred, all_dev_gt)
     avg_loss = avg_val_loss / dev_itr
     avg_acc = avg_acc / dev_itr
@@ -196,7 +210,7 @@ def test(dataset, metadata_path, w2v, n_classes):
 
 
 if __name__ == '__main__':
-    acner = Acner()
+    acner = Acner(seed=FLAGS.seed)
     if FLAGS.mode == 'train':
         train(acner, acner.metadata_paths, acner.w2v, len(acner.w2i[2]))
     elif FLAGS.mode == 'test':
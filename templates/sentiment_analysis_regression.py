@@ -168,10 +168,14 @@ def evaluate(sess, dataset, model, step, max_dev_itr=100, verbose=True,
     sess.run(tf.local_variables_initializer())
     all_dev_review, all_dev_score, all_dev_gt = [], [], []
     dev_itr = 0
-    while (dev_itr < max_dev_itr and max_dev_itr != 0) \
-            or mode in ['test', 'train']:
-        val_batch = dataset.next_batch(FLAGS.batch_size, rescale=[0.0, 1.0],
-                                       pad=model.args["sequence_length"])
+    # The test and train passes read every example exactly once
+    batch_kwargs = dict(rescale=[0.0, 1.0], pad=model.args["sequence_length"])
+    if mode in ['test', 'train']:
+        batches = dataset.iter_epoch(FLAGS.batch_size, **batch_kwargs)
+    else:
+        batches = (dataset.next_batch(FLAGS.batch_size, **batch_kwargs)
+                   for _ in range(max_dev_itr))
+    for val_batch in batches:
         val_loss, val_pco, val_mse, val_ratings = \
             model.evaluate_step(sess, val_batch.text, val_batch.ratings)
         avg_val_loss += val_mse
@@ -181,9 +185,6 @@ def evaluate(sess, dataset, model, step, max_dev_itr=100, verbose=True,
         all_dev_gt += val_batch.ratings
         dev_itr += 1
 
-        if mode == 'test' and dataset.epochs_completed == 1: break
-        if mode == 'train' and dataset.epochs_completed == 1: break
-
     result_set = (all_dev_review, all_dev_score, all_dev_gt)
     avg_loss = avg_val_loss / dev_itr
     avg_pco = avg_val_pco / dev_itr
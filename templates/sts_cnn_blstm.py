@@ -115,14 +115,17 @@ def train(dataset, metadata_path, w2v):
         avg_val_loss = 0.0
         prev_epoch = 0
         tflearn.is_training(True, session=sess)
-        while dataset.train.epochs_completed < FLAGS.num_epochs:
-            train_batch = dataset.train.next_batch(batch_size=FLAGS.batch_size,
+        # The next training batches are built while the model is training
+        train_loader = datasets.PrefetchingLoader(dataset.train,
+                                   batch_size=FLAGS.batch_size,
                                    pad=siamese_model.args["sequence_length"])
+        while train_loader.epochs_completed < FLAGS.num_epochs:
+            train_batch = train_loader.next_batch()
             pco, mse, loss, step =  siamese_model.train_step(sess,
                                                  train_batch.s1,
                                                  train_batch.s2,
                                                  train_batch.sim,
-                                                 dataset.train.epochs_completed)
+                                                 train_loader.epochs_completed)
 
 
             if step % FLAGS.evaluate_every == 0:
@@ -136,14 +139,17 @@ def train(dataset, metadata_path, w2v):
                 if validation_loss is not None:
                     min_validation_loss = validation_loss
 
-            if dataset.train.epochs_completed != prev_epoch:
-                prev_epoch = dataset.train.epochs_completed
+            if train_loader.epochs_completed != prev_epoch:
+                prev_epoch = train_loader.epochs_completed
                 avg_test_loss, avg_test_pco, _ = evaluate(sess=sess,
                                      dataset=dataset.test, model=siamese_model,
                                      max_dev_itr=0, mode='test', step=step)
                 min_test_loss = maybe_save_checkpoint(sess,
                         min_validation_loss, avg_val_loss, step, siamese_model)
 
+        train_loader.close()
+        print('Training batches not ready in time: {}'.format(
+                train_loader.stats()))
         dataset.train.close()
         dataset.validation.close()
         dataset.test.close()
@@ -181,23 +187,27 @@ def evaluate(sess, dataset, model, step, max_dev_itr=100, verbose=True,
     sess.run(tf.local_variables_initializer())
     all_dev_x1, all_dev_x2, all_dev_sims, all_dev_gt = [], [], [], []
     dev_itr = 0
-    while (dev_itr < max_dev_itr and max_dev_itr != 0) \
-                                    or mode in ['test', 'train']:
-        val_batch = dataset.next_batch(FLAGS.batch_size,
-                                       pad=model.args["sequence_length"])
+    # The test and train passes read every example exactly once
+    batch_kwargs = dict(pad=model.args["sequence_length"])
+    if mode in ['test', 'train']:
+        batches = dataset.iter_epoch(FLAGS.batch_size, **batch_kwargs)
+    else:
+        batches = (dataset.next_batch(FLAGS.batch_size, **batch_kwargs)
+                   for _ in range(max_dev_itr))
+    for val_batch in batches:
         val_loss, val_pco, val_mse, val_sim = \
             model.evaluate_step(sess, val_batch.s1, val_batch.s2, val_batch.sim)
         avg_val_loss += val_mse
         avg_val_pco += val_pco[0]
-        all_dev_x1 += id2seq(val_batch.s1, dataset.vocab_i2w)
-        all_dev_x2 += id2seq(val_batch.s2, dataset.vocab_i2w)
+        all_dev_x1.append(val_batch.s1)
+        all_dev_x2.append(val_batch.s2)
         all_dev_sims += val_sim.tolist()
         all_dev_gt += val_batch.sim
         dev_itr += 1
 
-        if mode == 'test' and dataset.epochs_completed == 1: break
-        if mode == 'train' and dataset.epochs_completed == 1: break
-
+    # The batches are decoded into words once, after the evaluation loop
+    all_dev_x1 = id2seq(np.concatenate(all_dev_x1), dataset.vocab_i2w)
+    all_dev_x2 = id2seq(np.concatenate(all_dev_x2), dataset.vocab_i2w)
     result_set = (all_dev_x1, all_dev_x2, all_dev_sims, all_dev_gt)
     avg_loss = avg_val_loss / dev_itr
     avg_pco = avg_val_pco / dev_itr
@@ -1,4 +1,7 @@
 import os
+import shutil
+import tempfile
+import warnings
 from nose.tools import *
 
 import datasets
@@ -54,6 +57,14 @@ class TestAcnerBatches(object):
         # This is exactly how it is constructed. Makes no sense. Find other way
         #assert_true(lens == [len(x) for x in batch.x])
 
+    def test_next_batch_ignores_tokenizer(self):
+        with warnings.catch_warnings(record=True) as caught:
+            warnings.simplefilter('always')
+            batch = self.ds.train.next_batch(
+                    tokenizer=['spacy', 'split', 'split'])
+        assert_equal(len(batch.sentences), 64)
+        assert_equal(len(caught), 1)
+
     def test_next_batch_get_raw(self):
         batch = self.ds.train.next_batch(raw=True)
         assert_is_instance(batch.sentences[0][0], str)
@@ -110,3 +121,26 @@ def test_specific_sizes():
     assert_equal(validate_len, 10072)
     assert_equal(test_len, 33571)
 
+
+def test_warm_start_same_as_cold_build():
+    # Built in a copy of the dataset, so that its own manifest is kept
+    root_directory = datasets.data_root_directory
+    tmp_directory = tempfile.mkdtemp()
+    os.makedirs(os.path.join(tmp_directory, 'acner'))
+    shutil.copy(os.path.join(root_directory, 'acner', 'acner.csv'),
+                os.path.join(tmp_directory, 'acner'))
+    datasets.data_root_directory = tmp_directory
+    try:
+        cold = Acner(use_defaults=True, seed=1)
+        warm = Acner(use_defaults=True, seed=1)
+        unseeded = Acner(use_defaults=True)
+    finally:
+        datasets.data_root_directory = root_directory
+        shutil.rmtree(tmp_directory)
+    assert_is_none(cold.load_times['warm_load'])
+    assert_is_not_none(warm.load_times['warm_load'])
+    assert_equal(cold.w2i, warm.w2i)
+    assert_equal(cold.train.data.tolist(), warm.train.data.tolist())
+    assert_equal(cold.test.data.tolist(), warm.test.data.tolist())
+    # A random split is never loaded again
+    assert_is_none(unseeded.load_times['warm_load'])
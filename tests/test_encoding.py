@@ -0,0 +1,175 @@
+import numpy as np
+from nose.tools import *
+
+import datasets
+
+
+w2i = {'PAD': 0, 'SEQ_BEGIN': 1, 'SEQ_END': 2, 'UNK': 3,
+       'the': 4, 'dog': 5, 'chased': 6, 'cat': 7}
+
+data = [['the', 'dog', 'chased', 'the', 'cat'],
+        ['the', 'boy'],
+        []]
+
+
+def test_encode_batch_same_as_seq2id_and_padseq():
+    for seq_begin in [False, True]:
+        for seq_end in [False, True]:
+            for pad in [1, 3, 6, 10]:
+                ids, lengths = datasets.encode_batch(data, w2i, pad,
+                                                     seq_begin, seq_end)
+                expected = datasets.seq2id(data, w2i, seq_begin, seq_end)
+                assert_equal(ids.dtype, np.int32)
+                assert_equal(ids.tolist(),
+                             datasets.padseq(expected, pad).tolist())
+                assert_equal(lengths.tolist(),
+                             [min(len(e), pad) for e in expected])
+
+
+def test_encode_batch_pads_to_longest():
+    ids, lengths = datasets.encode_batch(data, w2i, seq_end=True)
+    assert_equal(ids.shape, (3, 6))
+    assert_equal(ids[1].tolist(), [4, 3, 2, 0, 0, 0])
+    assert_equal(lengths.tolist(), [6, 3, 1])
+
+
+i2w = dict((i, w) for w, i in w2i.items())
+
+
+def test_id2seq_skips_special_and_unknown_ids():
+    ids = np.array([[1, 4, 5, 6, 4, 7, 2, 0],
+                    [1, 4, 3, 2, 0, 0, 0, 0],
+                    [4, 42, -1, 7, 0, 0, 0, 0]], dtype=np.int32)
+    expected = ['the dog chased the cat', 'the UNK', 'the cat']
+    assert_equal(datasets.id2seq(ids, i2w), expected)
+    assert_equal(datasets.id2seq([row[row > 0].tolist() for row in ids],
+                                 i2w), expected)
+
+
+def test_id2onehot_same_as_onehot2id():
+    ids, _ = datasets.encode_batch(data, w2i, pad=6)
+    onehot = datasets.id2onehot(ids, len(w2i))
+    assert_equal(onehot.shape, (3, 6, len(w2i)))
+    assert_equal(onehot.dtype, np.float32)
+    assert_equal(datasets.onehot2id(onehot).tolist(), ids.tolist())
+
+
+def test_id2onehot_casts_labels():
+    # Labels read from the split files with `csv.reader` are strings
+    labels = ['0', '2', '1']
+    onehot = datasets.id2onehot(labels, 3)
+    assert_equal(onehot.tolist(),
+                 datasets.id2onehot([0, 2, 1], 3).tolist())
+    assert_equal(datasets.onehot2id(onehot).tolist(), [0, 2, 1])
+
+
+def test_onehot2seq_same_as_id2seq():
+    ids, _ = datasets.encode_batch(data, w2i, seq_begin=True, seq_end=True)
+    onehot = np.eye(len(w2i), dtype=np.float32)[ids]
+    assert_equal(datasets.onehot2id(onehot).tolist(), ids.tolist())
+    assert_equal(datasets.onehot2seq(onehot, i2w),
+                 datasets.id2seq(ids, i2w))
+
+
+def test_pad_ragged_same_as_encode_batch():
+    ids = np.array(datasets.seq2id(data, w2i)[0] +
+                   datasets.seq2id(data, w2i)[1], dtype=np.int32)
+    offsets = np.array([0, 5, 7, 7])
+    rows = [2, 0, 1, 0]
+    for seq_begin in [False, True]:
+        for seq_end in [False, True]:
+            for pad in [0, 1, 3, 10]:
+                expected = datasets.encode_batch([data[r] for r in rows], w2i,
+                                                 pad, seq_begin, seq_end)
+                batch = datasets.pad_ragged(ids, offsets, rows, pad,
+                                            seq_begin, seq_end)
+                assert_equal(batch[0].tolist(), expected[0].tolist())
+                assert_equal(batch[1].tolist(), expected[1].tolist())
+
+
+def test_encode_ragged_same_as_seq2id():
+    ids, offsets = datasets.encode_ragged(data, w2i)
+    assert_equal(ids.dtype, np.int32)
+    assert_equal(offsets.tolist(), [0, 5, 7, 7])
+    assert_equal([ids[offsets[i]:offsets[i + 1]].tolist()
+                  for i in range(len(data))],
+                 datasets.seq2id(data, w2i))
+
+
+def test_drop_ids_same_as_removing_tokens():
+    dropped = [w2i['the'], w2i['UNK']]
+    kept = [[token for token in seq if token not in ('the', 'boy')]
+            for seq in data]
+    for seq_begin in [False, True]:
+        for seq_end in [False, True]:
+            for pad in [0, 1, 3, 10]:
+                expected = datasets.encode_batch(kept, w2i, pad, seq_begin,
+                                                 seq_end)
+                batch = datasets.encode_batch(data, w2i, pad, seq_begin,
+                                              seq_end, drop_ids=dropped)
+                assert_equal(batch[0].tolist(), expected[0].tolist())
+                assert_equal(batch[1].tolist(), expected[1].tolist())
+
+
+def test_pad_ragged_sentences_same_as_encode_batch():
+    # Two reviews: the first one with the sentences 0 and 1, the second one
+    # with the sentence 2
+    reviews = [data[:2], data[2:]]
+    ids = np.array(datasets.seq2id(data, w2i)[0] +
+                   datasets.seq2id(data, w2i)[1], dtype=np.int32)
+    offsets = np.array([0, 5, 7, 7])
+    sentence_offsets = np.array([0, 2, 3])
+    rows = [1, 0]
+    for pad in [0, 3, 10]:
+        sentences = datasets.split_sentences(*datasets.pad_ragged_sentences(
+                ids, offsets, sentence_offsets, rows, pad, seq_end=True),
+                pad=pad)
+        for review, expected in zip(sentences, [reviews[r] for r in rows]):
+            expected, lengths = datasets.encode_batch(expected, w2i, pad,
+                                                      seq_end=True)
+            if pad == 0:
+                expected = [e[:l].tolist() for e, l in zip(expected, lengths)]
+            assert_equal([np.asarray(s).tolist() for s in review],
+                         [np.asarray(s).tolist() for s in expected])
+
+
+def test_dense_sentences_same_as_padseq():
+    reviews = [data[:2], data[2:], data]
+    ragged = datasets.encode_sentences(reviews, w2i, seq_end=True)
+    assert_equal(ragged.row_splits.tolist(), [0, 2, 3, 6])
+    assert_equal(ragged.sentence_splits.tolist(), [0, 6, 9, 10, 16, 19, 20])
+    batch, n_sentences, lengths = datasets.dense_sentences(ragged, 2, 4)
+    assert_equal(batch.shape, (3, 2, 4))
+    assert_equal(n_sentences.tolist(), [2, 1, 2])
+    for review, sentences, review_lengths in zip(reviews, batch, lengths):
+        expected = datasets.seq2id(review, w2i, seq_end=True)[:2]
+        assert_equal(sentences[:len(expected)].tolist(),
+                     datasets.padseq(expected, 4).tolist())
+        assert_equal(review_lengths[:len(expected)].tolist(),
+                     [min(len(e), 4) for e in expected])
+    assert_equal(batch[1, 1].tolist(), [0] * 4)
+
+
+def test_pad_sentences_does_not_change_data():
+    sentences = [[4, 5]]
+    assert_equal(datasets.pad_sentences(sentences, 3),
+                 [[4, 5], [0, 0], [0, 0]])
+    assert_equal(sentences, [[4, 5]])
+
+
+def test_bucket_boundaries_minimize_padding():
+    lengths = [2] * 10 + [3] * 10 + [10] * 5 + [11] * 5 + [30]
+    assert_equal(datasets.bucket_boundaries(lengths, 3), [3, 11, 30])
+    assert_equal(datasets.bucket_boundaries(lengths, 1), [30])
+    assert_equal(datasets.bucket_boundaries([5, 5, 5], 4), [5])
+    profile = datasets.length_profile(lengths, [3, 11, 30], pad=30)
+    assert_equal(profile['max'], 30)
+    assert_less(profile['bucket_pad_fraction'], profile['pad_fraction'])
+
+
+def test_pad_to_length():
+    padded = datasets.pad_to_length([[4, 5, 6], [7]], 2)
+    assert_equal(padded.tolist(), [[4, 5], [7, 0]])
+    onehot = datasets.pad_to_length([np.eye(3)[[0, 1]], np.eye(3)[[2]]], 3)
+    assert_equal(onehot.shape, (2, 3, 3))
+    assert_equal(onehot[1].tolist(), [[0, 0, 1], [0, 0, 0], [0, 0, 0]])
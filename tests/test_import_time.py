@@ -0,0 +1,50 @@
+import os
+import sys
+import subprocess
+from nose.tools import *
+
+
+# Maximum time (in seconds) that `import datasets` may take. The spaCy
+# pipelines are loaded on demand, so importing the package should only pay
+# for the Python modules themselves.
+IMPORT_TIME_BUDGET = 5.0
+
+root_directory = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def run_in_subprocess(code):
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join([root_directory,
+                                         env.get('PYTHONPATH', '')])
+    out = subprocess.check_output([sys.executable, '-c', code], env=env,
+                                  cwd=root_directory)
+    return out.decode('utf-8').strip()
+
+
+def test_import_time_budget():
+    elapsed = float(run_in_subprocess(
+        'import time\n'
+        't = time.time()\n'
+        'import datasets\n'
+        'print(time.time() - t)\n'))
+    assert_less(elapsed, IMPORT_TIME_BUDGET)
+
+
+def test_import_does_not_load_spacy():
+    loaded = run_in_subprocess(
+        'import sys\n'
+        'import datasets\n'
+        'print(len(datasets._spacy_pipelines), "spacy" in sys.modules)\n')
+    assert_equal(loaded, '0 False')
+
+
+def test_import_does_not_load_tensorflow():
+    # The datasets one-hot encode their labels with numpy (see
+    # `datasets.id2onehot`), so only the models need TensorFlow
+    loaded = run_in_subprocess(
+        'import sys\n'
+        'import datasets\n'
+        'print(sorted(m for m in sys.modules\n'
+        '             if m.split(".")[0] in ("tensorflow", "tflearn")))\n')
+    assert_not_in('tensorflow', loaded)
+    assert_not_in('tflearn', loaded)
@@ -0,0 +1,127 @@
+import os
+import sys
+import shutil
+import tempfile
+from nose.tools import *
+from nose.plugins.skip import SkipTest
+
+import datasets
+from datasets.sts import DataSet
+
+
+w2i = {'PAD': 0, 'SEQ_BEGIN': 1, 'SEQ_END': 2, 'UNK': 3,
+       'the': 4, 'dog': 5, 'chased': 6, 'cat': 7}
+i2w = dict((i, w) for w, i in w2i.items())
+
+
+class DataFile(object):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'train.txt')
+        with open(self.path, 'w') as f:
+            for i in range(25):
+                f.write('the dog chased the cat {}\tthe cat\t{}\n'.format(
+                        i, i / 25.0))
+
+    def teardown(self):
+        shutil.rmtree(self.directory)
+
+
+class TestPrefetchingLoader(DataFile):
+    def test_same_batches_as_dataset(self):
+        for mode in datasets.PrefetchingLoader.modes:
+            expected = DataSet(self.path, (w2i, i2w))
+            expected.open()
+            dataset = DataSet(self.path, (w2i, i2w))
+            dataset.open()
+            with datasets.PrefetchingLoader(dataset, queue_size=2, mode=mode,
+                                            batch_size=10, pad=8) as loader:
+                for _ in range(10):
+                    batch = loader.next_batch()
+                    expected_batch = expected.next_batch(10, pad=8)
+                    assert_equal(batch._fields, expected_batch._fields)
+                    assert_equal(batch.s1.tolist(),
+                                 expected_batch.s1.tolist())
+                    assert_equal(batch.sim, expected_batch.sim)
+                    assert_equal(loader.epochs_completed,
+                                 expected.epochs_completed)
+                assert_equal(loader.stats()['batches'], 10)
+            assert_false(loader.worker.is_alive())
+            expected.close()
+            dataset.close()
+
+    def test_errors_are_raised(self):
+        dataset = DataSet(self.path, (w2i, i2w))
+        loader = datasets.PrefetchingLoader(dataset, batch_size=10)
+        assert_raises(Exception, loader.next_batch)
+        assert_false(loader.worker.is_alive())
+
+
+class TestSharedMemoryLoader(DataFile):
+    def test_workers_read_their_shards(self):
+        if sys.version_info < (3, 8):
+            raise SkipTest('multiprocessing.shared_memory needs Python 3.8+')
+        with datasets.SharedMemoryLoader(DataSet(self.path, (w2i, i2w)),
+                                         n_workers=2, n_slots=2,
+                                         batch_size=5, pad=8) as loader:
+            sims = []
+            for _ in range(6):
+                batch = loader.next_batch()
+                assert_equal(batch.s1.shape, (5, 8))
+                assert_equal(batch.s1[:, 0].tolist(), [w2i['the']] * 5)
+                sims += batch.sim
+            assert_equal(loader.epochs_completed, 1)
+        # Each worker read its 12 or 13 rows (and started again) once
+        assert_equal(sorted(set(sims)), [i / 25.0 for i in range(25)])
+
+
+class TestBucketSampler(DataFile):
+    def test_batches_padded_to_bucket(self):
+        dataset = DataSet(self.path, (w2i, i2w))
+        dataset.open()
+        sampler = datasets.BucketSampler(dataset, ['s1', 's2'], batch_size=5,
+                                         boundaries=[4, 6, 8])
+        for _ in range(10):
+            batch = sampler.next_batch()
+            lengths = (batch.s1 != 0).sum(axis=1)
+            assert_equal(batch.s1.shape[1], lengths.max())
+            assert_equal(len(batch.sim), 5)
+        assert_greater(sampler.epochs_completed, 0)
+        dataset.close()
+
+
+class TestIterEpoch(DataFile):
+    def test_every_row_read_once(self):
+        dataset = DataSet(self.path, (w2i, i2w))
+        for encoded in [False, True]:
+            dataset.open(encoded=encoded)
+            dataset.next_batch(7)
+            batches = list(dataset.iter_epoch(10, pad=8))
+            assert_equal([len(batch.sim) for batch in batches], [10, 10, 5])
+            # The row number of each similarity, read from float32 when encoded
+            assert_equal([round(sim * 25) for batch in batches
+                          for sim in batch.sim], list(range(25)))
+            # The position and the epochs of the dataset are left as they were
+            assert_equal(dataset.epochs_completed, 0)
+            assert_equal(round(dataset.next_batch(1).sim[0] * 25), 7)
+            dataset.close()
+
+    def test_ranks_read_their_shards(self):
+        dataset = DataSet(self.path, (w2i, i2w))
+        sims = []
+        for rank in range(3):
+            for batch in dataset.iter_epoch(4, rank=rank, world_size=3,
+                                            raw=True):
+                sims += batch.sim
+        assert_equal(sims, [i / 25.0 for i in range(25)])
+
+
+def test_run_folds():
+    parent = os.getpid()
+    results = datasets.run_folds(
+            lambda fold: {'fold': fold, 'forked': os.getpid() != parent},
+            n_folds=5, n_processes=2)
+    assert_equal([r['fold'] for r in results], list(range(5)))
+    assert_true(all(r['forked'] for r in results))
+    metrics = datasets.aggregate_metrics(results)
+    assert_equal(metrics['fold'], (2.0, 2 ** 0.5))
@@ -3,6 +3,7 @@ from datasets import STS
 from nose.tools import assert_equal
 from nose.tools import assert_not_equal
 from nose.tools import assert_is_instance
+from nose.tools import assert_almost_equal
 
 def setup_dataset(cl):
     ret = cl()
@@ -206,6 +207,31 @@ class TestSTS(object):
         assert_equal(is_valid_validation_sim_range, True)
         assert_equal(is_valid_test_sim_range, True)
 
+    def test_encoded_batch_same_as_text_batch(self):
+        for kwargs in [dict(pad=35, seq_begin=True, seq_end=True),
+                       dict(keep_entities=True), dict(rescale=(5, 10)),
+                       dict(pad=35, keep_entities=True)]:
+            self.ds.train.close()
+            self.ds.train.open()
+            text_batch = self.ds.train.next_batch(100, **kwargs)
+            self.ds.train.close()
+            self.ds.train.open(encoded=True)
+            encoded_batch = self.ds.train.next_batch(100, **kwargs)
+            assert_equal(len(encoded_batch.s1), 100)
+            for text, encoded in zip(text_batch, encoded_batch):
+                assert_equal(len(text), len(encoded))
+                for t, e in zip(text, encoded):
+                    if isinstance(t, float):
+                        assert_almost_equal(t, e, places=5)
+                    else:
+                        assert_equal(list(t), list(e))
+
+    def test_remove_entities(self):
+        data = [['BOE', 'LOC', 'Paris', 'EOE', 'sells', 'BOE', 'PRODUCT',
+                 'EOE'], ['PERSON']]
+        assert_equal(self.ds.train.remove_entities(data), [['Paris', 'sells'],
+                                                           []])
+
     def validate_vocabulary(self, in_new_vocab, in_new_w2v, in_new_metadata):
         assert_equal(self.ds.w2v.shape[0], len(self.ds.w2i))
         assert_equal(len(self.ds.w2i), len(self.ds.i2w))
@@ -0,0 +1,166 @@
+import os
+import json
+import shutil
+import tempfile
+from nose.tools import *
+
+import datasets
+
+
+lines = ['The dog chased the cat.',
+         'The boy kicked the girl!',
+         'John kissed Mary (twice).']
+
+
+def test_tokenize_batch_same_as_tokenize():
+    for tokenizer in ['spacy', 'split', 'other']:
+        expected = [datasets.tokenize(l, tokenizer) for l in lines]
+        assert_equal(datasets.tokenize_batch(lines, tokenizer), expected)
+
+
+def test_tokenize_batch_multiprocess():
+    expected = [datasets.tokenize(l, 'spacy') for l in lines * 10]
+    assert_equal(datasets.tokenize_batch(lines * 10, 'spacy', n_process=2,
+                                         batch_size=4), expected)
+
+
+def test_iter_tokenize_streams_lines():
+    tokens = datasets.iter_tokenize(iter(lines), 'split', batch_size=2)
+    assert_equal(next(tokens), lines[0].split(' '))
+    assert_equal(len(list(tokens)), len(lines) - 1)
+
+
+def test_process_documents_single_pass():
+    text = 'John ate chocolate. Mary ate cake.'
+    tokens, sentences, entities = next(datasets.process_documents([text]))
+    assert_equal(tokens, datasets.tokenize(text))
+    assert_equal(len(sentences), 2)
+    assert_equal(sum(len(sentence) for sentence in sentences), len(tokens))
+    assert_equal(datasets.sentence_tokenizer(text), sentences)
+    for start, end, label in entities:
+        assert_less(start, end)
+        assert_not_equal(label, '')
+
+
+def test_lru_cache_drops_least_recently_used():
+    cache = datasets.LRUCache(2)
+    cache.put('a', 1)
+    cache.put('b', 2)
+    assert_equal(cache.get('a'), 1)
+    cache.put('c', 3)
+    assert_equal(len(cache), 2)
+    assert_equal(cache.get('b'), None)
+    assert_equal(cache.get('a'), 1)
+    assert_equal(cache.get('c'), 3)
+
+
+def test_mark_entities_uses_cache():
+    datasets._entity_cache.clear()
+    data = [['John', 'kissed', 'Mary'], ['the', 'dog', 'barked']]
+    marked = datasets.mark_entities(data)
+    assert_equal(marked[1], data[1])
+    assert_in('BOE', marked[0])
+    assert_equal(len(datasets._entity_cache), 2)
+    assert_equal(datasets.mark_entities(data + data[:1]), marked + marked[:1])
+    assert_equal(len(datasets._entity_cache), 2)
+
+
+class TestTokenCache(object):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'data.txt')
+        with open(self.path, 'w') as f:
+            f.write('\n'.join(lines) + '\n')
+        self.n_calls = 0
+
+    def teardown(self):
+        shutil.rmtree(self.directory)
+
+    def processor(self, rows):
+        self.n_calls += 1
+        return datasets.iter_tokenize((r.strip() for r in rows), 'split')
+
+    def test_cache_is_built_once(self):
+        path1 = datasets.build_token_cache(self.path, self.processor,
+                                           'split')
+        path2 = datasets.build_token_cache(self.path, self.processor,
+                                           'split')
+        assert_equal(path1, path2)
+        assert_equal(self.n_calls, 1)
+        with open(path1, 'r') as cf:
+            assert_equal([json.loads(l) for l in cf],
+                         [l.split(' ') for l in lines])
+
+    def test_cache_is_invalidated(self):
+        path1 = datasets.build_token_cache(self.path, self.processor,
+                                           'split')
+        with open(self.path, 'a') as f:
+            f.write('One more line\n')
+        path2 = datasets.build_token_cache(self.path, self.processor,
+                                           'split')
+        assert_not_equal(path1, path2)
+        assert_false(os.path.exists(path1))
+        assert_equal(self.n_calls, 2)
+
+    def test_token_dict(self):
+        cache = datasets.load_token_dict(self.path, lambda l: l.strip(),
+                                         'split')
+        tokens = datasets.tokenize_with_cache(lines + ['a new line'], cache,
+                                              'split')
+        assert_equal(tokens[-1], ['a', 'new', 'line'])
+        assert_in('a new line', cache)
+
+    def test_corpus_cache(self):
+        def sentences(f):
+            self.n_calls += 1
+            for i, line in enumerate(f):
+                yield {'words': line.split(), 'index': i}
+
+        path1 = datasets.build_corpus_cache(self.path, sentences)
+        path2 = datasets.build_corpus_cache(self.path, sentences)
+        assert_equal(path1, path2)
+        assert_equal(self.n_calls, 1)
+        cache = datasets.load_corpus_cache(path1)
+        assert_equal(list(datasets.corpus_tokens(cache, 'words')),
+                     [line.split() for line in lines])
+        assert_equal(list(datasets.corpus_tokens(cache, 'words', [2, 0])),
+                     [lines[2].split(), lines[0].split()])
+        w2i = {'PAD': 0, 'SEQ_BEGIN': 1, 'SEQ_END': 2, 'UNK': 3, 'the': 4}
+        ids = datasets.corpus_ids(cache, 'words', w2i)
+        assert_equal(ids.tolist(),
+                     [w2i.get(t, 3) for line in lines for t in line.split()])
+        assert_equal(cache['index'].tolist(), [0, 1, 2])
+        # 'The' and 'the' are different strings
+        assert_equal(len(cache['words_strings']), 12)
+
+    def read_epoch(self, reader):
+        epoch = []
+        while True:
+            read = reader.readline()
+            if read is None:
+                return epoch
+            epoch.append(read)
+
+    def test_line_offsets(self):
+        offsets = datasets.line_offsets(self.path)
+        assert_equal(len(offsets), len(lines) + 1)
+        with open(self.path, 'rb') as f:
+            data = f.read()
+        assert_equal(offsets[-1], len(data))
+        for i, line in enumerate(lines):
+            assert_equal(data[offsets[i]:offsets[i + 1]].decode('utf-8'),
+                         line + '\n')
+
+    def test_line_reader_orders(self):
+        cache_path = datasets.build_token_cache(self.path, self.processor,
+                                                'split')
+        for order in datasets.LineReader.orders:
+            reader = datasets.LineReader([self.path, cache_path], order,
+                                         buffer_size=2, seed=1)
+            for epoch in range(2):
+                read = self.read_epoch(reader)
+                assert_equal(sorted(row for row, _ in read),
+                             sorted(line + '\n' for line in lines))
+                for row, tokens in read:
+                    assert_equal(json.loads(tokens), row.strip().split(' '))
+            reader.close()
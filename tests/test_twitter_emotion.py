@@ -0,0 +1,47 @@
+import os
+import shutil
+import tempfile
+from nose.tools import *
+
+import datasets
+from datasets.twitter_emotion import DataSet
+
+
+w2i = {'PAD': 0, 'SEQ_BEGIN': 1, 'SEQ_END': 2, 'UNK': 3,
+       'happy': 4, 'tweet': 5}
+i2w = dict((i, w) for w, i in w2i.items())
+c2i = {'joy': 0, 'anger': 1}
+i2c = dict((i, c) for c, i in c2i.items())
+
+
+class TestIterEpoch(object):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'fold_0.txt')
+        with open(self.path, 'w') as f:
+            for i in range(12):
+                f.write('happy tweet {}\t{}\n'.format(i, i % 2))
+                if i == 4:
+                    f.write('a malformed line without an emotion\n')
+
+    def teardown(self):
+        shutil.rmtree(self.directory)
+
+    def test_every_valid_row_read_once(self):
+        dataset = DataSet([self.path] * 5, (w2i, i2w), (c2i, i2c), 2)
+        dataset.open()
+        batches = list(dataset.iter_epoch(5, tokenizer='split'))
+        assert_equal([len(batch.emotion) for batch in batches], [5, 5, 2])
+        assert_equal([e for batch in batches for e in batch.emotion],
+                     [i % 2 for i in range(12)])
+        assert_equal(dataset.epochs_completed, 0)
+
+    def test_ranks_read_their_shards(self):
+        dataset = DataSet([self.path] * 5, (w2i, i2w), (c2i, i2c), 2)
+        dataset.open()
+        texts = []
+        for rank in range(2):
+            for batch in dataset.iter_epoch(4, rank=rank, world_size=2,
+                                            raw=True, tokenizer='split'):
+                texts += [int(tokens[-1]) for tokens in batch.text]
+        assert_equal(texts, list(range(12)))
@@ -0,0 +1,179 @@
+import os
+import shutil
+import tempfile
+import numpy as np
+from nose.tools import *
+
+import datasets
+
+
+class TestShardedVocabularyBuilder(object):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'data.txt')
+        with open(self.path, 'w') as f:
+            for i in range(5000):
+                f.write('sentence {} has the words {} and {}\t{}\n'.format(
+                        i % 7, i % 13, i % 101, i))
+        self.shard_size = datasets.vocabulary_shard_size
+        datasets.vocabulary_shard_size = 1024
+
+    def teardown(self):
+        datasets.vocabulary_shard_size = self.shard_size
+        shutil.rmtree(self.directory)
+
+    def build(self, n_process, cache_name=None):
+        return datasets.vocabulary_builder([self.path], min_frequency=1,
+                    tokenizer='split', downcase=True,
+                    line_processor=lambda line: line.split('\t')[0],
+                    n_process=n_process, cache_name=cache_name)
+
+    def test_new_vocabulary_has_entity_tokens(self):
+        vocab_path, _, _ = datasets.new_vocabulary([self.path],
+                self.directory, min_frequency=1, tokenizer='split',
+                downcase=True, max_vocab_size=None, name='entities',
+                line_processor=lambda line: line.split('\t')[0],
+                n_process=1)
+        w2i, _ = datasets.load_vocabulary(vocab_path)
+        for token in datasets.entity_tokens:
+            assert_in(token, w2i)
+        assert_not_in('LOCPRODUCT', w2i)
+
+    def test_file_shards_cover_file(self):
+        shards = datasets.file_shards(self.path, 8)
+        assert_equal(shards[0][0], 0)
+        assert_equal(shards[-1][1], os.path.getsize(self.path))
+        lines = [l for s, e in shards
+                 for l in datasets.read_shard(self.path, s, e)]
+        with open(self.path, 'r') as f:
+            assert_equal(lines, list(f))
+
+    def test_sharded_same_as_serial(self):
+        assert_equal(self.build(n_process=4), self.build(n_process=1))
+
+    def test_sharded_from_cache_same_as_serial(self):
+        assert_equal(self.build(n_process=4, cache_name='text'),
+                     self.build(n_process=1))
+
+
+def test_preload_w2v():
+    w2i = {'PAD': 0, 'dog': 1, 'cat': 2, 'qwertzuiopasdfgh': 3}
+    w2v = datasets.preload_w2v(w2i, initialize='zeros')
+    assert_equal(w2v.dtype, np.float32)
+    assert_equal(w2v.shape, (4, 300))
+
+    vocab = datasets.get_spacy('en', components='vectors').vocab
+    assert_true(np.allclose(w2v[1], vocab['dog'].vector))
+    assert_true(np.allclose(w2v[2], vocab['cat'].vector))
+    assert_false(w2v[3].any())
+
+
+class TestLoadW2V(object):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'w2v.npy')
+
+    def teardown(self):
+        shutil.rmtree(self.directory)
+
+    def test_save_as_float32(self):
+        datasets.save_w2v(self.path, np.random.rand(10, 300))
+        w2v = datasets.load_w2v(self.path, mmap_mode='r')
+        assert_is_instance(w2v, np.memmap)
+        assert_equal(w2v.dtype, np.float32)
+
+    def test_float64_files_are_converted(self):
+        w2v = np.random.rand(10, 300)
+        np.save(self.path, w2v)
+        mapped = datasets.load_w2v(self.path, mmap_mode='r')
+        assert_equal(mapped.dtype, np.float32)
+        assert_true(os.path.exists(datasets.float32_w2v_path(self.path)))
+        assert_true(np.allclose(mapped, w2v))
+
+    def test_lazy_w2v(self):
+        class Dataset(object):
+            w2v = datasets.LazyW2V()
+
+        datasets.save_w2v(self.path, np.ones((10, 300)))
+        ds = Dataset()
+        ds.w2v_path = self.path
+        assert_false(hasattr(ds, '_w2v'))
+        assert_equal(ds.w2v.shape, (10, 300))
+        ds.w2v = np.zeros((2, 300))
+        assert_equal(ds.w2v.shape, (2, 300))
+
+
+class TestManifest(object):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.source = os.path.join(self.directory, 'source.txt')
+        self.output = os.path.join(self.directory, 'output.txt')
+        self.manifest_path = os.path.join(self.directory, 'manifest.json')
+        for path in [self.source, self.output]:
+            with open(path, 'w') as f:
+                f.write('some text\n')
+        manifest = datasets.build_manifest([self.source],
+                                           {'output': self.output},
+                                           split=(0.9, 0.2), seed=1)
+        datasets.save_manifest(self.manifest_path, manifest)
+
+    def teardown(self):
+        shutil.rmtree(self.directory)
+
+    def test_same_sources_and_params(self):
+        manifest = datasets.matching_manifest(self.manifest_path,
+                                              [self.source],
+                                              split=(0.9, 0.2), seed=1)
+        assert_equal(manifest['outputs']['output'][0], self.output)
+
+    def test_different_params(self):
+        assert_is_none(datasets.matching_manifest(
+                self.manifest_path, [self.source], split=(0.9, 0.2), seed=2))
+
+    def test_changed_source(self):
+        with open(self.source, 'a') as f:
+            f.write('more text\n')
+        assert_is_none(datasets.matching_manifest(
+                self.manifest_path, [self.source], split=(0.9, 0.2), seed=1))
+
+    def test_missing_output(self):
+        os.remove(self.output)
+        assert_is_none(datasets.matching_manifest(
+                self.manifest_path, [self.source], split=(0.9, 0.2), seed=1))
+
+
+class TestPack(object):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.pack_path = os.path.join(self.directory, 'corpus.pack')
+        self.classes = [os.path.join(self.directory, c) for c in ['a', 'b']]
+        self.paths = []
+        for label, directory in enumerate(self.classes):
+            os.makedirs(directory)
+            for i in range(3):
+                path = os.path.join(directory, '{}.txt'.format(i))
+                with open(path, 'w', encoding='utf8') as f:
+                    f.write('Sentence {} of class {}\n'.format(i, label))
+                self.paths.append(path)
+
+    def teardown(self):
+        shutil.rmtree(self.directory)
+
+    def test_pack_same_as_files(self):
+        texts = datasets.read_first_lines(self.paths, n_threads=4)
+        assert_equal(texts[4], 'Sentence 1 of class 1\n')
+        records = [(path, i // 3, text)
+                   for i, (path, text) in enumerate(zip(self.paths, texts))]
+        datasets.save_pack(self.pack_path, records, self.classes)
+        assert_equal(datasets.load_pack(self.pack_path, self.classes,
+                                        self.paths), records)
+
+    def test_stale_pack(self):
+        records = [(path, 0, 'text') for path in self.paths]
+        datasets.save_pack(self.pack_path, records, self.classes)
+        assert_is_none(datasets.load_pack(self.pack_path, self.classes,
+                                          self.paths[1:]))
+        os.remove(self.paths[0])
+        os.utime(self.classes[0], (0, 0))
+        assert_is_none(datasets.load_pack(self.pack_path, self.classes,
+                                          self.paths))
@@ -24,6 +24,9 @@ import collections
 import logging
 import progressbar
 
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import datasets
+
 parser = argparse.ArgumentParser(
     description="Generate vocabulary for a tokenized text file.")
 parser.add_argument(
@@ -117,10 +120,7 @@ word_with_counts = sorted(
 if args.max_vocab_size is not None:
   word_with_counts = word_with_counts[:args.max_vocab_size]
 
-entities = ['PERSON', 'NORP', 'FACILITY' , 'ORG' , 'GPE' , 'LOC' +
-                    'PRODUCT' , 'EVENT' , 'WORK_OF_ART' , 'LANGUAGE' ,
-                    'DATE' , 'TIME' , 'PERCENT' , 'MONEY' , 'QUANTITY' ,
-                    'ORDINAL' , 'CARDINAL' , 'BOE', 'EOE']
+entities = datasets.entity_tokens
 
 with open('vocab.txt', 'w') as vf, open('metadata.txt', 'w') as mf:
   mf.write('word\tfreq\n')
@@ -0,0 +1,68 @@
+import os
+import sys
+import json
+import argparse
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import datasets
+
+parser = argparse.ArgumentParser(
+    description="Profiles the distribution of the sequence lengths of a "
+                "dataset and proposes the boundaries of the length buckets "
+                "of `datasets.BucketSampler`.")
+parser.add_argument(
+    "dataset",
+    help="Name of the dataset class in the `datasets` package (e.g., "
+         "`TwitterEmotion`, `Gersen`, `Acner` or `STS`).")
+parser.add_argument(
+    "--split",
+    default="train",
+    help="Split of the dataset to profile.")
+parser.add_argument(
+    "--field",
+    help="Field of the batches whose lengths are profiled. By default, the "
+         "first field of the batches.")
+parser.add_argument(
+    "--batch_size",
+    type=int,
+    default=1000,
+    help="Number of examples read at a time.")
+parser.add_argument(
+    "--max_batches",
+    type=int,
+    default=0,
+    help="Maximum number of batches to read. By default, a whole epoch is "
+         "read.")
+parser.add_argument(
+    "--n_buckets",
+    type=int,
+    default=4,
+    help="Number of length buckets to propose.")
+parser.add_argument(
+    "--pad",
+    type=int,
+    help="Fixed length the dataset is currently padded to. By default, the "
+         "maximum length.")
+
+args = parser.parse_args()
+
+dataset = getattr(getattr(datasets, args.dataset)(), args.split)
+if hasattr(dataset, 'open'):
+    dataset.open()
+
+lengths, n_batches = [], 0
+while dataset.epochs_completed == 0:
+    batch = dataset.next_batch(args.batch_size, raw=True)
+    field = args.field or batch._fields[0]
+    lengths.extend(len(sequence) for sequence in getattr(batch, field))
+    n_batches += 1
+    if n_batches == args.max_batches:
+        break
+
+if hasattr(dataset, 'close'):
+    dataset.close()
+
+boundaries = datasets.bucket_boundaries(lengths, args.n_buckets)
+profile = datasets.length_profile(lengths, boundaries, args.pad)
+print(json.dumps(profile, indent=2, sort_keys=True))
+print("Proposed bucket boundaries: {}".format(boundaries))
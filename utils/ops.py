@@ -129,6 +129,31 @@ def get_regularizer(beta=0.001):
     return regularizer
 
 
+def sparse_sequence_loss(logits, labels, mask):
+    """
+    Returns the mean cross entropy of `logits` ([batch * time, n_classes])
+    and the int32 class IDs `labels` ([batch, time]) over the positions where
+    `mask` ([batch, time]) is True. The labels are one-hot encoded in the
+    graph, so they can be fed as IDs instead of one-hot vectors.
+    """
+    weights = tf.reshape(tf.cast(mask, tf.float32), [-1])
+    return tf.losses.sparse_softmax_cross_entropy(tf.reshape(labels, [-1]),
+                                                  logits, weights=weights)
+
+
+def sparse_sequence_accuracy(logits, labels, mask):
+    """
+    Returns the fraction of the positions where `mask` is True whose class
+    ID in `labels` is the most likely one in `logits` (see
+    `sparse_sequence_loss`).
+    """
+    weights = tf.reshape(tf.cast(mask, tf.float32), [-1])
+    correct = tf.equal(tf.cast(tf.argmax(logits, 1), tf.int32),
+                       tf.reshape(labels, [-1]))
+    return tf.reduce_sum(tf.cast(correct, tf.float32) * weights) / \
+           tf.maximum(tf.reduce_sum(weights), 1.0)
+
+
 def get_optimizer(name='adam'):
     if name == 'adam':
         return tf.train.AdamOptimizer